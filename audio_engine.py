@@ -0,0 +1,269 @@
+"""
+Plays every sound of a run through one persistent output stream. Sounds are
+decoded to PCM when the run is loaded, scheduled against the run clock, and
+mixed into the stream by the audio callback at the exact sample they are due,
+so neither onset nor cut-off depends on when the render loop gets around to
+it.
+"""
+import math
+import threading
+import time
+
+from prefetch import decode_sound
+from timing import get_time
+
+class PCMBuffer(object):
+    """A decoded sound, as float32 samples shaped (frames, channels)."""
+    def __init__(self, path, samples, sample_rate):
+        self.path = path
+        self.samples = samples
+        self.sample_rate = sample_rate
+
+    def __repr__(self):
+        return("PCMBuffer({0!r}, {1:.3f}s)".format(
+            self.path, len(self.samples) / float(self.sample_rate)
+        ))
+
+def convert(decoded, sample_rate, channels):
+    """
+    Converts a prefetch.DecodedSound to the stream's sample rate (by linear
+    interpolation) and channel count, once, so the callback only has to add.
+    """
+    import numpy
+    samples = decoded.samples
+    if(decoded.sample_rate != sample_rate):
+        n_in = len(samples)
+        n_out = int(round(n_in * sample_rate / float(decoded.sample_rate)))
+        positions = numpy.arange(n_out) * (decoded.sample_rate / float(sample_rate))
+        samples = numpy.column_stack([
+            numpy.interp(positions, numpy.arange(n_in), samples[:, c])
+            for c in range(samples.shape[1])
+        ])
+    if(samples.shape[1] == 1 and channels > 1):
+        samples = numpy.repeat(samples, channels, axis=1)
+    elif(samples.shape[1] != channels):
+        samples = samples[:, :channels]
+    return(numpy.ascontiguousarray(samples, dtype='float32'))
+
+def to_samples(seconds, sample_rate):
+    return(int(math.floor(seconds * sample_rate + .5)))
+
+class Voice(object):
+    """
+    One scheduled playback of a PCMBuffer. start and stop are run clock
+    times; onset is filled in with the run clock time of the first sample
+    actually written.
+    """
+    def __init__(self, buffer, start, stop, label):
+        self.buffer = buffer
+        self.start = start
+        self.stop = stop
+        self.label = label
+        self.onset = None
+        self.position = 0
+        self.remaining = None
+
+    @property
+    def latency(self):
+        if(self.onset is None):
+            return(None)
+        return(self.onset - self.start)
+
+class SoundDeviceOutput(object):
+    """An output stream on a sound card, through sounddevice (PortAudio)."""
+    def __init__(self, clock, sample_rate, channels, block_size, device=None,
+                 latency='low'):
+        self.clock = clock
+        self.sample_rate = sample_rate
+        self.channels = channels
+        self.block_size = block_size
+        self.device = device
+        self.latency = latency
+        self.stream = None
+
+    def start(self, render):
+        import sounddevice
+        clock = self.clock
+        def callback(outdata, frames, time_info, status):
+            # PortAudio gives the time the block reaches the DAC on its own
+            # clock; move it onto the run clock.
+            dac_time = clock.getTime() + (time_info.outputBufferDacTime - time_info.currentTime)
+            render(outdata, dac_time)
+        self.stream = sounddevice.OutputStream(
+            samplerate=self.sample_rate, blocksize=self.block_size,
+            channels=self.channels, dtype='float32', device=self.device,
+            latency=self.latency, callback=callback
+        )
+        self.stream.start()
+
+    def stop(self):
+        if(self.stream is not None):
+            self.stream.stop()
+            self.stream.close()
+            self.stream = None
+
+class NullOutput(object):
+    """
+    An output that plays to nowhere, for running and testing without sound
+    hardware. With realtime, a thread asks for a block every block period,
+    as a sound card would; otherwise blocks are only rendered by pump().
+    With record, every rendered block is kept in self.blocks.
+    """
+    def __init__(self, clock, sample_rate, channels, block_size, realtime=True,
+                 record=False):
+        self.clock = clock
+        self.sample_rate = sample_rate
+        self.channels = channels
+        self.block_size = block_size
+        self.realtime = realtime
+        self.record = record
+        self.blocks = []
+        self._render = None
+        self._stop = threading.Event()
+        self._thread = None
+
+    def start(self, render):
+        self._render = render
+        if(self.realtime):
+            self._thread = threading.Thread(target=self._run)
+            self._thread.daemon = True
+            self._thread.start()
+
+    def pump(self, n_blocks=1):
+        import numpy
+        for i in range(n_blocks):
+            outdata = numpy.zeros((self.block_size, self.channels), dtype='float32')
+            self._render(outdata, self.clock.getTime())
+            if(self.record):
+                self.blocks.append(outdata)
+
+    def stop(self):
+        self._stop.set()
+        if(self._thread is not None):
+            self._thread.join()
+            self._thread = None
+
+    def _run(self):
+        period = self.block_size / float(self.sample_rate)
+        next_block = get_time()
+        while(not self._stop.is_set()):
+            self.pump()
+            # Absolute schedule, so the block rate doesn't drift
+            next_block += period
+            remaining = next_block - get_time()
+            if(remaining > 0):
+                time.sleep(remaining)
+
+class AudioEngine(object):
+    """
+    Mixes scheduled Voices into a single output stream (SoundDeviceOutput or
+    NullOutput) that stays open for the whole session. Each output callback
+    supplies the run clock time its first sample will be heard, so a voice
+    due at time t starts at sample round((t - dac_time) * sample_rate) of
+    that block, and stops at the sample its stop time falls on. A voice
+    scheduled too late to start on time starts at the next block, and the
+    delay shows up as its latency.
+    """
+    def __init__(self, output, sample_rate=44100, channels=2):
+        self.output = output
+        self.sample_rate = sample_rate
+        self.channels = channels
+        self.buffers = {}
+        self.voices = []
+        self._pending = []
+        self._playing = []
+        self._lock = threading.Lock()
+
+    def preload(self, entries):
+        """Decodes every sound in a list of TimelineEvents."""
+        for entry in entries:
+            if(entry.kind == 'sound' and entry.stim_str not in self.buffers):
+                self.load(entry.stim_str)
+
+    def load(self, path, decoded=None):
+        if(path not in self.buffers):
+            if(decoded is None):
+                decoded = decode_sound(path)
+            self.buffers[path] = PCMBuffer(
+                path, convert(decoded, self.sample_rate, self.channels), self.sample_rate
+            )
+        return(self.buffers[path])
+
+    def start(self):
+        self.output.start(self.render)
+
+    def close(self):
+        self.output.stop()
+
+    def schedule(self, buffer, start, stop=None, label=None):
+        """
+        Plays buffer from run clock time start, cut off at stop (if given),
+        and returns the Voice.
+        """
+        voice = Voice(buffer, start, stop, label or buffer.path)
+        with self._lock:
+            self._pending.append(voice)
+            self.voices.append(voice)
+        return(voice)
+
+    def render(self, outdata, dac_time):
+        """The output callback: fills outdata with the block due at dac_time."""
+        outdata.fill(0)
+        frames = len(outdata)
+        with self._lock:
+            if(self._pending):
+                self._playing.extend(self._pending)
+                self._pending = []
+            playing = self._playing
+        finished = []
+        for voice in playing:
+            offset = 0
+            if(voice.onset is None):
+                offset = to_samples(voice.start - dac_time, self.sample_rate)
+                if(offset >= frames):
+                    continue
+                offset = max(offset, 0)
+                voice.onset = dac_time + offset / float(self.sample_rate)
+                voice.remaining = len(voice.buffer.samples)
+                if(voice.stop is not None):
+                    voice.remaining = max(0, min(
+                        voice.remaining,
+                        to_samples(voice.stop - voice.onset, self.sample_rate)
+                    ))
+            n = min(frames - offset, voice.remaining)
+            if(n > 0):
+                outdata[offset:offset + n] += voice.buffer.samples[voice.position:voice.position + n]
+                voice.position += n
+                voice.remaining -= n
+            if(voice.remaining == 0):
+                finished.append(voice)
+        if(finished):
+            with self._lock:
+                self._playing = [voice for voice in self._playing if voice not in finished]
+
+    def forget(self, keep=()):
+        """
+        Clears the voices of a finished run, including any still waiting to
+        start or playing, and drops every decoded sound except those whose
+        paths are in keep.
+        """
+        with self._lock:
+            self.voices = []
+            self._pending = []
+            self._playing = []
+        for path in list(self.buffers):
+            if(path not in keep):
+                del self.buffers[path]
+
+    def report(self):
+        """Prints the onset latency of every voice that has started."""
+        latencies = [voice.latency for voice in self.voices if voice.onset is not None]
+        for voice in self.voices:
+            if(voice.onset is not None):
+                print("AUDIO: {0} due {1:.4f}s, onset {2:.4f}s, latency {3:.2f} ms".format(
+                    voice.label, voice.start, voice.onset, voice.latency * 1000
+                ))
+        if(latencies):
+            print("AUDIO: onset latency mean {0:.2f} ms, max {1:.2f} ms".format(
+                sum(latencies) / len(latencies) * 1000, max(latencies) * 1000
+            ))
@@ -0,0 +1,316 @@
+"""
+Headless benchmarks for script loading and the per-frame cost of the
+presentation loop, and the import time of the main modules. Nothing here
+opens a window or imports PsychoPy.
+
+Synthetic scripts in the test_scripts/ format are generated at each size,
+with and without overlapping events, and the Timeline operations that
+EventList inherits are timed on them. The presentation loop is timed against
+a stub window, with the flip wrappers a run can attach. Each module in
+IMPORT_MODULES is imported in a fresh interpreter with -X importtime.
+Results are written
+as JSON, and a previous result file can be given to compare against:
+
+    python benchmark.py --output after.json --compare before.json
+"""
+import argparse
+import json
+import os
+import platform
+import random
+import shutil
+import subprocess
+import sys
+import tempfile
+
+from timeline import Timeline
+from timing import get_time
+from frame_timing import FlipRecorder
+from input_pipeline import KeyPoller
+from scheduler import FrameClock
+
+# Bump this whenever results stop being comparable with older files
+BENCHMARK_VERSION = 1
+
+DEFAULT_SIZES = [1000, 10000, 100000, 1000000]
+
+# Modules timed by the import benchmark, and the slow-to-import packages
+# they are kept from loading until a run actually needs them
+IMPORT_MODULES = ['timeline', 'event', 'fmri_go', 'run_plan', 'log_align', 'preflight']
+HEAVY_MODULES = ['psychopy', 'pyglet', 'wx', 'serial', 'sounddevice', 'moviepy', 'PIL']
+
+# Mix of stimulus lines in synthetic scripts
+STIM_LINES = [
+    '"pecan"',
+    '"walnut","#FF0000"',
+    'stimuli/image_{0}.png',
+    'stimuli/sound_{0}.wav',
+    'stimuli/movie_{0}.mp4',
+    'stimuli/movie_{0}.mp4,noAudio'
+]
+
+def generate_script(path, n_events, overlaps=False, n_files=50, seed=0):
+    """
+    Writes a script of n_events mixed text, image, sound and movie events,
+    with a gap before about a third of them (so nulls are needed). With
+    overlaps, about one event in a hundred starts before the one before it
+    ends. File stimuli cycle through n_files names per kind.
+    """
+    rng = random.Random(seed)
+    start_ms = 0
+    with open(path, 'w') as script:
+        script.write('NULL,"+"\n')
+        for i in range(n_events):
+            dur_ms = rng.choice([500, 1000, 2000, 2500])
+            line = rng.choice(STIM_LINES).format(rng.randrange(n_files))
+            script.write("{0},{1},{2}\n".format(format_ms(start_ms), format_ms(dur_ms), line))
+            start_ms += dur_ms
+            if(overlaps and rng.random() < .01):
+                start_ms -= 250
+            elif(rng.random() < .33):
+                start_ms += rng.choice([250, 500, 1000])
+    return(path)
+
+def format_ms(ms):
+    return("{0}.{1:03d}".format(ms // 1000, ms % 1000).rstrip('0').rstrip('.'))
+
+def best_time(function, repeat):
+    """Calls function() repeat times; returns the fastest time and last result."""
+    best = None
+    for i in range(repeat):
+        started = get_time()
+        result = function()
+        elapsed = get_time() - started
+        if(best is None or elapsed < best):
+            best = elapsed
+    return(best, result)
+
+def time_timeline(path, n_events, overlaps, repeat):
+    """Times reading, overlap checking, null creation and dur on one script."""
+    def read():
+        timeline = Timeline()
+        timeline.read_from_file(path)
+        return(timeline)
+
+    def create_nulls():
+        timeline = read()
+        # Overlap warnings go to /dev/null instead of flooding the terminal
+        stdout = sys.stdout
+        with open(os.devnull, 'w') as sys.stdout:
+            try:
+                started = get_time()
+                timeline.create_null_events()
+                elapsed = get_time() - started
+            finally:
+                sys.stdout = stdout
+        return(elapsed, timeline)
+
+    results = []
+    def add(name, seconds):
+        results.append({
+            'benchmark': name,
+            'events': n_events,
+            'overlaps': overlaps,
+            'seconds': seconds,
+            'us_per_event': seconds / n_events * 1e6
+        })
+
+    seconds, timeline = best_time(read, repeat)
+    add('read_from_file', seconds)
+    seconds, found = best_time(timeline.has_overlapping_events, repeat)
+    add('has_overlapping_events', seconds)
+    # Null creation changes the timeline, so each repeat reads it afresh
+    # and only the null creation itself is timed
+    null_times = [create_nulls() for i in range(repeat)]
+    add('create_null_events', min(t for t, filled in null_times))
+    filled = null_times[-1][1]
+    seconds, dur = best_time(filled.dur, repeat)
+    add('dur', seconds)
+    return(results)
+
+def import_profile(module):
+    """
+    Imports module in a fresh interpreter with -X importtime. Returns a dict
+    of the cumulative import time, in microseconds, of every module loaded.
+    """
+    process = subprocess.Popen(
+        [sys.executable, '-X', 'importtime', '-c', 'import ' + module],
+        cwd=os.path.dirname(os.path.abspath(__file__)),
+        stdout=subprocess.PIPE, stderr=subprocess.PIPE
+    )
+    stdout, stderr = process.communicate()
+    if(process.returncode != 0):
+        raise RuntimeError("import {0} failed:\n{1}".format(module, stderr.decode('utf-8')))
+    profile = {}
+    for line in stderr.decode('utf-8').splitlines():
+        # import time: self [us] | cumulative | imported package
+        if(not line.startswith('import time:') or 'cumulative' in line):
+            continue
+        fields = line[len('import time:'):].split('|')
+        profile[fields[2].strip()] = int(fields[1])
+    return(profile)
+
+def time_import(module, repeat):
+    """The fastest of repeat imports of module, and the heavy modules it loaded."""
+    profiles = [import_profile(module) for i in range(repeat)]
+    return({
+        'benchmark': 'import',
+        'module': module,
+        'ms': min(profile[module] for profile in profiles) / 1000.0,
+        'heavy': sorted(name for name in profiles[-1] if name in HEAVY_MODULES)
+    })
+
+class StubWindow(object):
+    """A window whose flips return immediately."""
+    def flip(self):
+        pass
+
+class StubStim(object):
+    def draw(self):
+        pass
+
+class FrameCountingClock(object):
+    """A run clock that advances one frame per read, so loops end on time."""
+    def __init__(self, frame_period):
+        self.frame_period = frame_period
+        self.t = 0.0
+
+    def getTime(self):
+        self.t += self.frame_period
+        return(self.t)
+
+def time_frame_loop(n_frames, attach, frame_rate=60.0):
+    """
+    Runs the non-slip loop `while clock.getTime() < end_time: draw; flip`
+    for n_frames against a stub window with the wrappers named in attach
+    ('recorder', 'keys', 'frame_clock') and returns the seconds per frame.
+    """
+    win = StubWindow()
+    stim = StubStim()
+    clock = FrameCountingClock(1.0 / frame_rate)
+    loop_clock = clock
+    if('recorder' in attach):
+        FlipRecorder(clock, frame_rate, capacity=n_frames + 10).attach(win)
+    if('keys' in attach):
+        KeyPoller(clock, lambda timeStamped=None: []).attach(win)
+    if('frame_clock' in attach):
+        frame_clock = FrameClock(clock, frame_rate)
+        frame_clock.attach(win)
+        loop_clock = frame_clock
+    end_time = n_frames / frame_rate
+    started = get_time()
+    while(loop_clock.getTime() < end_time):
+        stim.draw()
+        win.flip()
+    return((get_time() - started) / n_frames)
+
+FRAME_LOOP_CONFIGURATIONS = [
+    ('bare', ()),
+    ('keys', ('keys',)),
+    ('keys+recorder', ('keys', 'recorder')),
+    ('keys+recorder+frame_clock', ('keys', 'recorder', 'frame_clock'))
+]
+
+def run_suite(sizes=DEFAULT_SIZES, repeat=3, n_frames=100000, workdir=None,
+              import_modules=IMPORT_MODULES):
+    """Runs every benchmark and returns the results as a JSON-able dict."""
+    cleanup = workdir is None
+    if(cleanup):
+        workdir = tempfile.mkdtemp()
+    results = []
+    try:
+        for n_events in sizes:
+            for overlaps in (False, True):
+                path = os.path.join(workdir, "synthetic_{0}_{1}.txt".format(
+                    n_events, 'overlaps' if overlaps else 'clean'
+                ))
+                generate_script(path, n_events, overlaps)
+                results += time_timeline(path, n_events, overlaps, repeat)
+    finally:
+        if(cleanup):
+            shutil.rmtree(workdir)
+
+    frame_loop = []
+    for name, attach in FRAME_LOOP_CONFIGURATIONS:
+        seconds = min(time_frame_loop(n_frames, attach) for i in range(repeat))
+        frame_loop.append({
+            'benchmark': 'frame_loop',
+            'configuration': name,
+            'frames': n_frames,
+            'us_per_frame': seconds * 1e6
+        })
+
+    imports = [time_import(module, repeat) for module in import_modules]
+
+    return({
+        'version': BENCHMARK_VERSION,
+        'python': platform.python_version(),
+        'platform': platform.platform(),
+        'timeline': results,
+        'frame_loop': frame_loop,
+        'imports': imports
+    })
+
+def result_key(result):
+    if(result['benchmark'] == 'frame_loop'):
+        return(('frame_loop', result['configuration']))
+    if(result['benchmark'] == 'import'):
+        return(('import', result['module']))
+    return((result['benchmark'], result['events'], result['overlaps']))
+
+def compare(old, new):
+    """
+    Returns (key, old, new, ratio) for every benchmark in both result dicts,
+    where ratio > 1 means the new version is slower.
+    """
+    if(old.get('version') != new.get('version')):
+        raise ValueError("Benchmark results are from different versions")
+    measures = {'frame_loop': 'us_per_frame', 'import': 'ms'}
+    # Files from before the import benchmark have no 'imports'
+    old_results = dict((result_key(r), r) for r in
+                       old['timeline'] + old['frame_loop'] + old.get('imports', []))
+    rows = []
+    for result in new['timeline'] + new['frame_loop'] + new.get('imports', []):
+        key = result_key(result)
+        if(key in old_results):
+            measure = measures.get(key[0], 'seconds')
+            before, after = old_results[key][measure], result[measure]
+            rows.append((key, before, after, after / before if before else float('inf')))
+    return(rows)
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description=__doc__,
+                                     formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--sizes', type=int, nargs='+', default=DEFAULT_SIZES,
+                        help="numbers of events in the synthetic scripts")
+    parser.add_argument('--repeat', type=int, default=3)
+    parser.add_argument('--frames', type=int, default=100000)
+    parser.add_argument('--output', default='benchmark.json')
+    parser.add_argument('--compare', help="an earlier result file to compare with")
+    args = parser.parse_args()
+
+    suite = run_suite(args.sizes, args.repeat, args.frames)
+    with open(args.output, 'w') as output:
+        json.dump(suite, output, indent=2, sort_keys=True)
+    for result in suite['timeline']:
+        print("{0:24} {1:>8} events {2:8} {3:10.4f}s {4:8.3f} us/event".format(
+            result['benchmark'], result['events'],
+            'overlaps' if result['overlaps'] else 'clean',
+            result['seconds'], result['us_per_event']
+        ))
+    for result in suite['frame_loop']:
+        print("frame_loop {0:28} {1:8.3f} us/frame".format(
+            result['configuration'], result['us_per_frame']
+        ))
+    for result in suite['imports']:
+        print("import {0:32} {1:8.1f} ms{2}".format(
+            result['module'], result['ms'],
+            '  (loads {0})'.format(', '.join(result['heavy'])) if result['heavy'] else ''
+        ))
+    if(args.compare):
+        with open(args.compare) as old_file:
+            old = json.load(old_file)
+        print("Compared with {0} (time new / old):".format(args.compare))
+        for key, before, after, ratio in compare(old, suite):
+            print("{0:60} {1:6.2f}x".format(' '.join(str(part) for part in key), ratio))
+    print("Wrote {0}".format(args.output))
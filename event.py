@@ -1,74 +1,107 @@
-from psychopy import core, data, visual, event, sound, gui
-import os
-import decimal
+import collections
 
-def create_event_for_stim(event_strings, win):
+from stim_cache import StimulusCache, stim_key
+from movie_stream import MovieStream
+from timeline import Timeline, TimelineEvent, Overlap, parse_event_strings, from_us
+
+# PsychoPy's visual and sound modules bring in the windowing and audio
+# stacks, which are slow to import. Each event class imports what it needs
+# when it builds a stimulus, so parsing a script, and any event kind a run
+# doesn't use, costs nothing.
+
+def create_event_for_stim(event_strings, win, cache=None):
     """
     Takes an array of 'event strings,' usually parsed from an experiment
     script, and figures out what class of event is appropriate (e.g., TextEvent,
     ImageEvent, etc.), creates the correct event, and returns it.
+
+    If a StimulusCache is given, the event reuses any stimulus already loaded
+    for the same file or text.
     """
-    if(event_strings[0] != None):
-        event_start = decimal.Decimal(event_strings[0])
-    else:
-        event_start = None
-
-    if(event_strings[1] != None):
-        event_dur = decimal.Decimal(event_strings[1])
-    else:
-        event_dur = None
-
-    stim_strings = event_strings[2:]
-
-    # Are we dealing with a text stim or a file stim?
-    # If the stim begins and ends with double quotes, then it's text.
-    if((stim_strings[0][0] == '"') and (stim_strings[0][-1] == '"')):
-        # If the following field begins with a hash, then it's colored text
-        if(len(stim_strings) == 2 and stim_strings[1][0]=='#'):
-            text_color = stim_strings[1]
-        else:
-            text_color = '#FFFFFF'
-        new_event = TextEvent(
-            event_start, event_dur,
-            stim_strings[0][1:-1], # Strip the quotes
-            win,
-            text_color
-        )
-    # If we do not begin and end with quotes, then we assume we are dealing
-    # with a file stim (this if/elif structure is inelegant).
-    elif((stim_strings[0][0] != '"') and (stim_strings[0][-1] != '"')):
-        filename, stim_ext = os.path.splitext(stim_strings[0])
-        if(stim_ext in ['.mp4', '.mov']):
-            new_event = MovieEvent(
-                event_start, event_dur, stim_strings, win
-            )
-        elif(stim_ext in ['.jpg', '.jpeg', '.tif', '.png']):
-            new_event = ImageEvent(
-                event_start, event_dur, stim_strings[0], win
-            )
-        elif(stim_ext in ['.wav', '.aif']):
-            new_event = SoundEvent(
-                event_start, event_dur, stim_strings[0], win
-            )
-        else:
-            print("stim_ext not found: {0}".format(stim_ext))
-            print("stim_strings: {0}".format(stim_strings))
-    else:
-        print("Confusing stim_strings: {0}".format(stim_strings))
-    return(new_event)
+    return(materialize(parse_event_strings(event_strings), win, cache))
+
+def materialize(entry, win, cache=None, asset=None, movie_buffer=None, audio=None,
+                textures=None):
+    """
+    Builds the displayable Event (and its PsychoPy stimulus) for a
+    TimelineEvent. asset is the file already decoded by a Prefetcher, if any.
+    With a movie_buffer (in frames), silent movies are streamed instead of
+    being loaded into a MovieStim3. With an AudioEngine, sounds are played
+    through it instead of through sound.Sound. With a TextTextureCache, text
+    is drawn from prebuilt textures instead of TextStims.
+    """
+    if(entry.kind == 'text'):
+        return(TextEvent(entry.start_us, entry.dur_us, entry.stim_str, win,
+                         entry.color, cache, textures))
+    elif(entry.kind == 'image'):
+        return(ImageEvent(entry.start_us, entry.dur_us, entry.stim_str, win, cache,
+                          asset))
+    elif(entry.kind == 'sound'):
+        return(SoundEvent(entry.start_us, entry.dur_us, entry.stim_str, win, cache,
+                          asset, audio))
+    elif(entry.kind == 'movie' and entry.no_audio and movie_buffer):
+        return(StreamingMovieEvent(entry.start_us, entry.dur_us, entry.stim_str, win,
+                                   movie_buffer))
+    elif(entry.kind == 'movie'):
+        return(MovieEvent(entry.start_us, entry.dur_us, entry.stim_str, win,
+                          entry.no_audio, cache))
+    raise ValueError("Unknown event kind: {0}".format(entry.kind))
+
+def script_time(us):
+    """Script time in seconds, for runs shown on the run clock as is."""
+    return(us / 1e6)
 
 class Event(object):
-    def __init__(self, start, dur, stim_str, win):
-        self.start = start
-        self.dur = dur
+    # Times are integer microseconds, as in the timeline. start and dur give
+    # them in exact Decimal seconds.
+    def __init__(self, start_us, dur_us, stim_str, win):
+        self.start_us = start_us
+        self.dur_us = dur_us
         self.stim_str = stim_str
         self.win = win
 
+    @property
+    def start(self):
+        return(from_us(self.start_us))
+
+    @property
+    def dur(self):
+        return(from_us(self.dur_us))
+
+    def load_stim(self, cache, key, factory):
+        """Creates the stimulus, going through the cache if there is one."""
+        if(cache is None):
+            return(factory())
+        return(cache.get(key, factory))
+
+    def release(self):
+        """Frees anything the stimulus holds beyond ordinary memory."""
+        pass
+
+    def cue(self, to_clock=None):
+        """
+        Called as soon as the event has been built, with the run clock
+        running, for events that can be scheduled ahead of their onset.
+        to_clock converts a script time in integer microseconds to the run
+        clock time it is shown at, as the render loop does for deadlines.
+        """
+        pass
+
 class TextEvent(Event):
-    def __init__(self, start, dur, stim_str, win, text_color='#FFFFFF'):
+    def __init__(self, start, dur, stim_str, win, text_color='#FFFFFF',
+                 cache=None, textures=None):
         super(TextEvent, self).__init__(start, dur, stim_str, win)
-        self.stim = visual.TextStim(win, pos=[0,0], text=self.stim_str,
-                                    color=text_color, wrapWidth=2)
+        # Prebuilt textures are drawn like images, without laying out text
+        if(textures is not None):
+            self.stim = textures.get(stim_str, text_color)
+        else:
+            from psychopy import visual
+            self.stim = self.load_stim(
+                cache,
+                stim_key('text', stim_str, text_color),
+                lambda: visual.TextStim(win, pos=[0,0], text=stim_str,
+                                        color=text_color, wrapWidth=2)
+            )
 
     def display(self):
         self.stim.draw()
@@ -79,9 +112,17 @@ class MultiPositionedTextEvent(Event):
         super(MultiPositionedTextEvent, self).__init__(start, dur, stim)
 
 class ImageEvent(Event):
-    def __init__(self, start, dur, stim_str, win):
+    def __init__(self, start, dur, stim_str, win, cache=None, decoded=None):
         super(ImageEvent, self).__init__(start, dur, stim_str, win)
-        self.stim = visual.ImageStim(self.win, pos=[0,0], image=self.stim_str)
+        # A prefetched, already decoded image saves reading the file here
+        if(decoded is None):
+            decoded = stim_str
+        from psychopy import visual
+        self.stim = self.load_stim(
+            cache,
+            stim_key('image', stim_str),
+            lambda: visual.ImageStim(win, pos=[0,0], image=decoded)
+        )
 
     def display(self):
         self.stim.draw()
@@ -91,20 +132,50 @@ class ImageEvent(Event):
 # some audio files better than others. Certain AIFF files don't work.
 
 class SoundEvent(Event):
-    def __init__(self, start, dur, stim_str, win):
+    def __init__(self, start, dur, stim_str, win, cache=None, decoded=None,
+                 audio=None):
         super(SoundEvent, self).__init__(start, dur, stim_str, win)
-        self.stim = sound.Sound(stim_str)
+        # With an AudioEngine, the sound is one of the PCM buffers decoded
+        # when the run was loaded, and is scheduled by cue() instead of
+        # being started and stopped from the render loop.
+        self.audio = audio
+        if(audio is not None):
+            self.stim = audio.load(stim_str, decoded)
+        else:
+            from psychopy import sound
+            if(decoded is None):
+                factory = lambda: sound.Sound(stim_str)
+            else:
+                # A prefetched DecodedSound is already PCM
+                factory = lambda: sound.Sound(value=decoded.samples,
+                                              sampleRate=decoded.sample_rate)
+            self.stim = self.load_stim(cache, stim_key('sound', stim_str), factory)
 
-    def display(self, clock, end_time, on_screen):
-        self.stim.play()
-        while(clock.getTime() < end_time):
-            on_screen.display()
-        self.stim.stop()
+    def cue(self, to_clock=None):
+        if(to_clock is None):
+            to_clock = script_time
+        if(self.audio is not None):
+            self.voice = self.audio.schedule(
+                self.stim, to_clock(self.start_us), to_clock(self.start_us + self.dur_us)
+            )
+
+    def display(self, clock, end_time, on_screen, hold=None):
+        # hold(on_screen, end_time), if given, shows the screen once and waits
+        # instead of redrawing it every frame.
+        if(self.audio is None):
+            self.stim.play()
+        if(hold is not None):
+            hold(on_screen, end_time)
+        else:
+            while(clock.getTime() < end_time):
+                on_screen.display()
+        if(self.audio is None):
+            self.stim.stop()
 
-# Note: If a single movie is loaded multiple times in a script, multiple
-# MovieEvent objects will be created, each occupying their own memory location.
-# This could possibly get expensive. Consider releasing the objects after use?
-# Consider reusing objects for events that are loaded multiple times?
+# Note: If a single movie is loaded multiple times in a script, the
+# MovieEvents share one MovieStim3 through the StimulusCache. A shared movie
+# may already have been played (or cut off) by an earlier event, so it is
+# rewound before it is displayed again instead of being decoded from scratch.
 
 # Note: PsychoPy depends on avbin for media decoding, and avbin likes some
 # movies and not others. I experienced crashing when playing movies with empty
@@ -113,80 +184,149 @@ class SoundEvent(Event):
 # working smoothly.
 
 class MovieEvent(Event):
-    def __init__(self, start, dur, stim_strings, win):
-        stim_str = stim_strings[0]
-        no_audio = False
-        if len(stim_strings) == 2 and stim_strings[1] == "noAudio":
-            no_audio = True
+    def __init__(self, start, dur, stim_str, win, no_audio=False, cache=None):
         super(MovieEvent, self).__init__(start, dur, stim_str, win)
-        self.stim = visual.MovieStim3(self.win,
-                                      self.stim_str,
+        from psychopy import visual
+        self.stim = self.load_stim(
+            cache,
+            stim_key('movie', stim_str, no_audio=no_audio),
+            lambda: visual.MovieStim3(win,
+                                      stim_str,
                                       flipVert=False,
                                       noAudio=no_audio,
                                       loop=False)
+        )
+
+    def rewind(self):
+        """Returns a previously played movie to its first frame."""
+        from psychopy import visual
+        self.stim.pause()
+        self.stim.seek(0)
+        self.stim.status = visual.NOT_STARTED
+
+    def release(self):
+        # Unloads the movie and closes the decoder
+        self.stim.stop()
 
     def display(self, clock, end_time):
+        from psychopy import visual
+        if(self.stim.status != visual.NOT_STARTED):
+            self.rewind()
         # Terminate and hand control back to fmri_go.py if either the movie ends
         # or we run out of time on the global clock.
         while((self.stim.status != visual.FINISHED) and (clock.getTime() < end_time)):
             self.stim.draw()
             self.win.flip()
 
-class EventList:
-    def __init__(self, win):
-        self.events = []
-        self.null_event = None
-        self.win = win
+class StreamingMovieEvent(Event):
+    """
+    A silent movie decoded frame by frame on a worker thread (see
+    movie_stream.py) instead of by MovieStim3. Decoding starts when the event
+    is built, a few events before its onset, and the decoder is closed as
+    soon as the movie has been shown. Each refresh shows the frame due at
+    that moment; frames that are already late are skipped. Until the first
+    frame has been decoded, on_screen (the null event) is shown instead.
+    """
+    def __init__(self, start, dur, stim_str, win, buffer_frames=30):
+        super(StreamingMovieEvent, self).__init__(start, dur, stim_str, win)
+        self.stream = MovieStream(stim_str, buffer_frames)
+        self.stream.start()
+        from psychopy import visual
+        self.stim = visual.ImageStim(win, pos=[0,0], image=None, flipVert=True)
+
+    def release(self):
+        self.stream.close()
 
-    def read_from_file(self, path):
-        """Parse the script file and populate the global event array"""
-        lines = [line.strip() for line in open(path)]
-        for line in lines:
-            splitline = line.split(',')
-            if(splitline[0] == "NULL"):
-                self.null_event = splitline[1]
+    def display(self, clock, end_time, on_screen=None):
+        onset = clock.getTime()
+        has_frame = False
+        while((not self.stream.finished) and (clock.getTime() < end_time)):
+            frame = self.stream.frame_at(clock.getTime() - onset)
+            if(frame is not None):
+                self.stim.image = frame
+                has_frame = True
+            if(has_frame):
+                self.stim.draw()
+                self.win.flip()
+            elif(on_screen is not None):
+                on_screen.display()
             else:
-                new_event = create_event_for_stim(splitline, self.win)
-                self.events.append(new_event)
-                self.sort_by_start()
+                self.win.flip()
+        self.release()
+        if(self.stream.ring.dropped):
+            print("{0}: dropped {1} late frames".format(self.stim_str,
+                                                        self.stream.ring.dropped))
+
+class EventList(Timeline):
+    """
+    A Timeline that can turn its events into displayable stimuli. Parsing,
+    null creation and overlap checks happen on the lightweight timeline;
+    stimuli are only built by iter_materialized(), just ahead of display.
+    """
+    def __init__(self, win, cache=None, movie_buffer=None, audio=None, textures=None):
+        super(EventList, self).__init__()
+        self.win = win
+        # Frames buffered ahead when streaming silent movies; None plays
+        # them with MovieStim3
+        self.movie_buffer = movie_buffer
+        # AudioEngine that plays the sounds, if not sound.Sound
+        self.audio = audio
+        # TextTextureCache that text is drawn from, if not TextStims
+        self.textures = textures
+        # Maps script times (integer microseconds) to the run clock, for
+        # events cued ahead of time. Frame-locked and resynchronized runs
+        # replace it with their own mapping.
+        self.to_clock = script_time
+        # Events for repeated files or strings share their stimuli
+        if(cache is None):
+            cache = StimulusCache()
+        self.cache = cache
 
-    def sort_by_start(self):
-        self.events.sort(key=lambda event: event.start)
+    def iter_materialized(self, lookahead=2, prefetcher=None, keep=()):
+        """
+        Yields a displayable Event for each timeline event, in order. Stimuli
+        are built `lookahead` events ahead of the one being displayed, from
+        the prefetcher's decoded data if one is given, and cued as soon as
+        they are built. Once an event has been displayed and its stimulus is
+        not used again later in the timeline, the stimulus is released and
+        dropped from the cache, unless its key is in keep (e.g. because the
+        next run of a session uses it too).
+        """
+        last_use = {}
+        for index, entry in enumerate(self.events):
+            last_use[entry.key()] = index
 
-    def dur(self):
-        self.sort_by_start()
-        return(self.events[-1].start + self.events[-1].dur)
-
-    def create_null_events(self):
-        new_nulls = []
-        for i in range(1, len(self.events)):
-            first_event = self.events[i - 1]
-            second_event = self.events[i]
-            null_start = first_event.start + first_event.dur
-            null_dur = second_event.start - null_start
-
-            new_null_event = create_event_for_stim([null_start, null_dur, self.null_event], self.win)
-
-            if(new_null_event.dur < 0):
-                print "WARNING: Overlapping events detected while creating null events"
-                print "new_null_event.dur = {0}".format(new_null_event.dur)
-
-            # Append the null to a separate list
-            if(new_null_event.dur > 0):
-                new_nulls.append(new_null_event)
-
-        # Append all the new nulls to the event list
-        for new_null_event in new_nulls:
-            self.events.append(new_null_event)
-            # Sort the event list again
-            self.sort_by_start()
-
-    def has_overlapping_events(self):
-        overlap = False
-        for i in range(1, len(self.events)):
-            first_event = self.events[i - 1]
-            second_event = self.events[i]
-            first_event_end = first_event.start + first_event.dur
-            if(first_event_end > second_event.start):
-                overlap = True
-        return(overlap)
\ No newline at end of file
+        upcoming = collections.deque()
+        for index, entry in enumerate(self.events):
+            asset = None
+            if(prefetcher is not None and prefetcher.wants(index)):
+                asset = prefetcher.take(index, self.to_clock(entry.start_us))
+            event = materialize(entry, self.win, self.cache, asset,
+                                self.movie_buffer, self.audio, self.textures)
+            event.cue(self.to_clock)
+            upcoming.append((index, entry, event))
+            if(len(upcoming) > lookahead):
+                shown_index, shown_entry, shown = upcoming.popleft()
+                yield shown
+                self.release_after_display(shown_index, shown_entry, shown, last_use, keep)
+        while(upcoming):
+            shown_index, shown_entry, shown = upcoming.popleft()
+            yield shown
+            self.release_after_display(shown_index, shown_entry, shown, last_use, keep)
+
+    def null_display(self):
+        """
+        An Event that shows the NULL stimulus, to keep on screen while a
+        movie or sound has nothing else to show. Build it once per run.
+        """
+        return(materialize(self.null_entry(), self.win, self.cache,
+                           textures=self.textures))
+
+    def release_after_display(self, index, entry, event, last_use, keep=()):
+        key = entry.key()
+        if(isinstance(event, StreamingMovieEvent)):
+            # Each streamed showing has its own decoder
+            event.release()
+        elif(last_use[key] == index and key not in keep):
+            event.release()
+            self.cache.discard(key)
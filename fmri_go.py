@@ -3,17 +3,43 @@
 
 #from psychopy import core, data, visual, event, sound, gui
 
-from psychopy.hardware.emulator import launchScan
-import psychopy as psy
-
-import serial
-import random
 import math
 import multiprocessing
-import time
 import sys
 
 from event import *
+from prefetch import Prefetcher
+from frame_timing import FlipRecorder
+from scheduler import FrameClock, measure_frame_rate
+from timing import wait_until, run_clock_origin, get_time
+from serial_input import SerialReader
+from scanner_emulator import open_pty, run_emulator
+from log_writer import LogWriter
+from input_pipeline import KeyPoller, LOG_STOP, LOG_QUIT
+from ipc_ring import RecordRing, SOURCE_SERIAL, decode_key
+from monitor import Monitor, make_views
+from audio_engine import AudioEngine, SoundDeviceOutput, NullOutput
+from session import Preloader, parse_run_numbers
+from text_cache import TextTextureCache
+from resync import ResyncEngine
+
+# PsychoPy (with its windowing, GUI and audio stacks) and pyserial are slow
+# to import, and the logging process and tools that import this file only
+# need some of them, if any. PsychoPy is imported by import_psychopy() when
+# the experiment starts, sound only if a run uses psychopy.sound (see
+# event.py), the scanner emulator only in psychopy-simulation mode,
+# pyserial only at serial locations and numpy (for run plans) only when a
+# run is loaded.
+psy = None
+
+def import_psychopy():
+    global psy
+    import psychopy.core
+    import psychopy.event
+    import psychopy.gui
+    import psychopy.visual
+    psy = psychopy
+    return(psy)
 
 # This is a configuration object for PsychoPy's LaunchScan
 # that determines what the scanner trigger value should be
@@ -35,120 +61,351 @@ fmri_settings = {
 serial_settings = {
     'mount': '/dev/tty.USA19H142P1.1',
     'baud': 115200,
-    'timeout': .0001
+    'timeout': .0001,
+    'poll_timeout': .1   # longest the logger sleeps before checking for stop
+}
+
+# Settings for the software scanner used in usb-serial-simulation mode (see
+# scanner_emulator.py). Pulses go out every TR on an absolute schedule, with
+# Gaussian jitter (sd in seconds, clipped to max_jitter), optional dropped or
+# doubled pulses and a clock drift (fractional TR error). Simulated responses
+# follow each stimulus onset with probability response_prob after an
+# ex-Gaussian reaction time.
+emulator_settings = {
+    'TR': fmri_settings['TR'],
+    'sync': fmri_settings['sync'],
+    'jitter': .0005,
+    'max_jitter': .002,
+    'drop_prob': 0.0,
+    'double_prob': 0.0,
+    'drift': 0.0,
+    'keys': ['1', '2', '3', '4'],
+    'response_prob': .8,
+    'rt_mu': .5,
+    'rt_sigma': .1,
+    'rt_tau': .2,
+    'seed': None
+}
+
+# The script for each run. {0} is replaced with the run number, so each run
+# of a session plays its own script.
+script_settings = {
+    'path': 'collective_thought/session{0}.txt'
+}
+
+# Stimuli that appear on more than one line of a script are loaded once and
+# shared. Once the cache grows past this budget, the least recently used
+# stimuli are dropped from it. With text_textures, every distinct text (and
+# a text NULL) is rendered to a texture once, as its run is loaded, and
+# drawn as an image from then on (see text_cache.py).
+cache_settings = {
+    'budget_mb': 1024,
+    'lookahead': 2,      # number of events built ahead of the one on screen
+    'text_textures': True
+}
+
+# With flip_on_change, static text/image/null frames are drawn and flipped
+# once, and we then sleep until the next onset instead of redrawing every
+# refresh. The last `spin` seconds before the onset are busy-waited for
+# accuracy. Input is polled every poll_interval seconds while waiting.
+# With frame_locked, the refresh rate is measured before the scan, every
+# event gets a whole number of frames, and events are timed by counting
+# flips (see scheduler.py). Frames are then redrawn every refresh, so
+# flip_on_change is ignored. nominal_frame_rate is used if the refresh rate
+# can't be measured.
+render_settings = {
+    'flip_on_change': False,
+    'poll_interval': .005,
+    'spin': .002,
+    'frame_locked': False,
+    'nominal_frame_rate': 60.0
+}
+
+# With stream, movies marked noAudio are decoded frame by frame on a worker
+# thread, buffer_frames ahead of the screen, and their decoder is closed as
+# soon as they have been shown (see movie_stream.py). Movies with sound are
+# always played with MovieStim3.
+movie_settings = {
+    'stream': False,
+    'buffer_frames': 30
+}
+
+# With engine, every sound is decoded when the run is loaded and played
+# through one output stream that stays open for the whole run, starting and
+# stopping at the exact sample of its onset and end (see audio_engine.py).
+# device is a sounddevice device name or number (None for the default);
+# null_output plays to nowhere, for machines without sound hardware.
+audio_settings = {
+    'engine': False,
+    'sample_rate': 44100,
+    'channels': 2,
+    'block_size': 256,
+    'device': None,
+    'null_output': False
+}
+
+# Log records are buffered in memory and written out once flush_records have
+# piled up or flush_interval seconds have passed. With binary, a binary copy
+# of each log is written next to the CSV (see log_writer.py). Input passes
+# between the processes through shared-memory rings of ring_records records
+# (see ipc_ring.py), which the keyboard logger reads every poll_interval
+# seconds.
+log_settings = {
+    'flush_records': 256,
+    'flush_interval': 1.0,
+    'binary': False,
+    'ring_records': 65536,
+    'poll_interval': .01
+}
+
+# While a run is on, the logging process keeps rolling statistics on TR
+# pulses and responses (see monitor.py) and shows them every interval
+# seconds. view is 'udp' (watch with `python monitor.py --port 5005` in
+# another terminal), 'terminal' (printed by the logging process) or 'both'.
+monitor_settings = {
+    'enabled': True,
+    'view': 'udp',
+    'port': 5005,
+    'interval': .5
+}
+
+# With resync, every TR pulse read from the serial port refits the offset
+# and skew between the scanner's clock and the run clock (see resync.py),
+# and each event's deadline is moved to where the scanner will be at that
+# point in the script. A pulse more than outlier_ms off the fit is left out.
+# The correction applied at each TR is written to the run's _resync.txt.
+# Only used at serial locations, and not with frame_locked.
+resync_settings = {
+    'enabled': False,
+    'window': 64,
+    'outlier_ms': 4.0
+}
+
+# Image, sound and movie files are read and decoded ahead of time on worker
+# threads. depth is the most decoded files held in memory at once.
+prefetch_settings = {
+    'depth': 8,
+    'workers': 2
 }
 
 # This function is used in a multiprocess-based "thread."
 # Calling PyGame-based functions in the "thread" causes problems, so this is
 # a little baroque.
-# t0 is the start time.
-def log_serial_input(filename, tr_filename, t0):
+# One logging process serves every run of a session. Between runs it sleeps
+# on the control pipe, leaving the serial port free for the main process to
+# wait for the next trigger. Each run starts with a (filename, tr_filename,
+# t0, mount) command and ends with LOG_STOP; LOG_QUIT ends the session.
+# Everything read from the serial port is also pushed to ring, so the main
+# process sees TR pulses and responses without reading the port itself.
+def serial_logger(control, ring):
+    while(True):
+        command = control.recv()
+        if(command == LOG_QUIT):
+            break
+        filename, tr_filename, t0, mount = command
+        log_serial_input(filename, tr_filename, t0, mount, control, ring)
+
+# t0 is the timing.get_time() at which the run clock was reset, so logged
+# times are on the same clock as the stimuli. Logs until LOG_STOP arrives on
+# the control pipe, then flushes and closes its logs.
+def log_serial_input(filename, tr_filename, t0, mount, control, ring):
     global fmri_settings
     global serial_settings
+    global log_settings
     print("Running log_serial_input...")
-    ser = serial.Serial(serial_settings['mount'], serial_settings['baud'], timeout = serial_settings['timeout'])
+    import serial
+    ser = serial.Serial(mount, serial_settings['baud'], timeout = 0)
     ser.flushInput()
+    reader = SerialReader(ser, t0)
+
+    logfile = open_log_writer(filename)
+    tr_logfile = open_log_writer(tr_filename)
+    monitor = open_monitor()
+    while(not control.poll()):
+        # Sleeps until input arrives; the timeout only bounds how long it
+        # takes to notice the end of the run.
+        for t_now, char in reader.read(serial_settings['poll_timeout']):
+            ring.push(t_now, SOURCE_SERIAL, ord(char))
+            if(char == fmri_settings['sync']):
+                tr_logfile.write(t_now, char)
+            else:
+                logfile.write(t_now, char)
+            if monitor:
+                monitor.record(t_now, char)
+        logfile.tick()
+        tr_logfile.tick()
+        if monitor:
+            monitor.tick(get_time() - t0)
+    # The LOG_STOP that ended the run
+    control.recv()
+    ser.close()
+    logfile.close()
+    tr_logfile.close()
+    if monitor:
+        monitor.close(get_time() - t0)
+
+def open_monitor():
+    global fmri_settings
+    global monitor_settings
+    if not monitor_settings['enabled']:
+        return(None)
+    return(Monitor(fmri_settings['TR'], fmri_settings['sync'],
+                   make_views(monitor_settings), monitor_settings['interval']))
+
+def open_log_writer(filename):
+    global log_settings
+    return(LogWriter(
+        filename,
+        binary=log_settings['binary'],
+        flush_records=log_settings['flush_records'],
+        flush_interval=log_settings['flush_interval']
+    ))
 
-    with open(filename, 'a') as logfile:
-        logfile.write("time,input\n")
-    with open(tr_filename, 'a') as tr_logfile:
-        tr_logfile.write("time,input\n")
-    # This while(True) construction should give any reasonable person pause,
-    # because it could create zombie processes. This function is explicitly
-    # flagged as a logging daemon. But maybe there's a better way, so we don't
-    # need to terminate later? I.e., the "poison pill" method.
+# This function is designed for testing logging during simulation mode. Actual
+# logging should use the serial_logger function above. During simulations,
+# a KeyPoller in the main process collects keys (including the TR 5s from the
+# PsychoPy scanner simulator) after every flip, timestamped on the run clock,
+# and pushes them to a shared-memory ring that is read here. Each run starts
+# with a (filename, tr_filename, t0) command on the control pipe and ends
+# with LOG_STOP; LOG_QUIT ends the session.
+def keyboard_logger(control, ring):
     while(True):
-        char = ser.read()
-        if(char):
+        command = control.recv()
+        if(command == LOG_QUIT):
+            break
+        filename, tr_filename, t0 = command
+        log_keyboard_input(filename, tr_filename, t0, control, ring)
+
+def log_keyboard_input(filename, tr_filename, t0, control, ring):
+    global fmri_settings
+    global log_settings
+    logfile = open_log_writer(filename)
+    tr_logfile = open_log_writer(tr_filename)
+    monitor = open_monitor()
+    running = True
+    while(running):
+        # The main process sends LOG_STOP after the last keys of the run have
+        # been pushed, so draining once more after it logs everything.
+        if(control.poll(log_settings['poll_interval'])):
+            control.recv()
+            running = False
+        for t_now, source, code in ring.drain():
+            char = decode_key(code)
             if(char == fmri_settings['sync']):
-                log_filename = tr_filename
+                tr_logfile.write(t_now, char)
             else:
-                log_filename = filename
-            with open(log_filename, 'a') as tr_logfile:
-                t_now = time.time() - t0
-                tr_logfile.write("{0},{1}\n".format(t_now, char))
+                logfile.write(t_now, char)
+            if monitor:
+                monitor.record(t_now, char)
+        logfile.tick()
+        tr_logfile.tick()
+        if monitor:
+            monitor.tick(get_time() - t0)
+    logfile.close()
+    tr_logfile.close()
+    if monitor:
+        monitor.close(get_time() - t0)
+
+def read_trigger(ser):
+    """
+    Reads one character from the serial port, or '' on a timeout. pyserial
+    returns bytes on Python 3, which never equal fmri_settings['sync'], so
+    they are decoded as latin-1, as SerialReader does.
+    """
+    return(ser.read().decode('latin-1'))
 
-def fake_scanner_serial_output():
+def stop_logging(log_proc, log_commands):
+    """
+    Asks the logging process to write out everything it has and waits for
+    it to finish, instead of terminating it with records still in memory.
     """
-    Simulates a fake scanner by sending serial information out from one mount
-    point to another mount point. Used to test scripts outside of the scan
-    facility.
+    log_commands.send(LOG_QUIT)
+    log_commands.close()
+    log_proc.join()
 
-    This could be dramatically improved and currently drifts quite a bit from
-    TR to TR. See psychopy.hardware.emulator.SyncGenerator.
+def script_path_for(run_number):
+    global script_settings
+    return(script_settings['path'].format(run_number))
 
-    https://github.com/psychopy/psychopy/blob/master/psychopy/hardware/emulator.py
+def load_run(run_number, win, stim_cache, movie_buffer, audio, textures):
     """
-    global fmri_settings
-    print("Running fake scanner serial output...")
-    ser = serial.Serial('/dev/tty.USA19H141P1.1', 115200)
-    while(True):
-        b = ser.write(fmri_settings['sync'])
-        time.sleep(fmri_settings['TR'])
-
-def fake_button_pressing():
+    Reads a run's script into an EventList and renders its text, if there
+    is a TextTextureCache. Other stimuli are only built as the run is shown.
     """
-    Simulates a fake subject that randomly presses buttons 1-4.
+    script_path = script_path_for(run_number)
+    print("Set script path: {0}".format(script_path))
+
+    # Reading the script only builds the timeline. The EventList needs to know
+    # about the Window so it can build each stimulus shortly before display.
+    events = EventList(win, stim_cache, movie_buffer, audio, textures)
+    # The compiled plan (parsed script with nulls inserted and overlaps
+    # found) is cached next to the script and reused until the script or
+    # any of its files change. See run_plan.py to precompile a whole study.
+    from run_plan import load_plan
+    load_plan(script_path).fill(events)
+
+    for overlap in events.overlaps:
+        print("WARNING: Overlapping events detected in input: {0} at {1} starts before {2} at {3} ends".format(
+            overlap.second.stim_str, overlap.second.start,
+            overlap.first.stim_str, overlap.first.start
+        ))
+
+    # Text is rendered here, on the main thread, since it draws to the window
+    if textures is not None:
+        textures.prerender(events.events + [events.null_entry()])
+    return(events)
+
+def preload_run(events, audio, clock):
     """
-    global fmri_settings
-    print("Running fake scanner serial output...")
-    ser = serial.Serial('/dev/tty.USA19H142P1.1', 115200)
-    while(True):
-        keys = ['1', '2', '3', '4']
-        keys_index = random.randrange(0,4)
-        key = keys[keys_index]
-        b = ser.write(key)
-        time.sleep(random.randrange(5,16))
-
-# This function is designed for testing logging during simulation mode. Actual
-# logging should use the log_serial_input function above. During simulations,
-# the pressed keys are dumped from psychopy.event.getKeys() between each event
-# presentation, so log timings will not be accurate. This includes TR 5s from
-# the PsychoPy scanner simulator; they all are logged in clumps between events.
-# The only way to avoid this would be to implement callbacks to dump getKeys()
-# between every flip() but this would require extensive restructuring and isn't
-# necessary for testing during simulations right now.
-def log_keyboard_input(filename, tr_filename, t0, shared_keys):
-    global fmri_settings
-    with open(filename, 'a') as logfile:
-        logfile.write("time,input\n")
-    with open(tr_filename, 'a') as tr_logfile:
-        tr_logfile.write("time,input\n")
-    while(True):
-        if(len(shared_keys) > 0):
-            for index in range(len(shared_keys)):
-                char = shared_keys.pop()
-                if(char == fmri_settings['sync']):
-                    log_filename = tr_filename
-                else:
-                    log_filename = filename
-                with open(log_filename, 'a') as logfile:
-                    t_now = time.time() - t0
-                    logfile.write("{0},{1}\n".format(t_now, char))
+    Decodes a run's sounds (with the audio engine) and starts decoding its
+    image, sound and movie files in the background. The render loop picks up
+    the decoded data as it builds each stimulus. Returns the Prefetcher.
+    """
+    global prefetch_settings
+    prefetch_kinds = ['image', 'sound', 'movie']
+    if audio:
+        audio.preload(events.events)
+        # Sounds have already been decoded
+        prefetch_kinds.remove('sound')
+    prefetcher = Prefetcher(
+        events.events, clock,
+        depth=prefetch_settings['depth'],
+        workers=prefetch_settings['workers'],
+        kinds=prefetch_kinds
+    )
+    prefetcher.start()
+    return(prefetcher)
 
 def run_experiment():
     global serial_settings
     global fmri_settings
+    global cache_settings
+    global render_settings
+    global emulator_settings
+    global movie_settings
+    global audio_settings
+    global log_settings
+
+    import_psychopy()
 
     # These are not "group" fields because of a bug in wxWidgets:
     # https://groups.google.com/forum/#!topic/psychopy-users/0wVjYIcXQsk
     # This is a sub-optimal workaround to-be-improved-upon.
     config_dialog = psy.gui.Dlg(title="Configure Run")
     config_dialog.addField("Participant accession number:", "deleteme")
-    config_dialog.addField("Run number:")
+    config_dialog.addField("Run number(s) (e.g. 2 or 1-3,5):")
     config_dialog.addField("Location mode (dbic/serial/psychopy):", "dbic")
     config_dialog.addField("Window mode (window/external):", "external")
+    config_dialog.addField("Frame timing report (yes/no):", "no")
     config_dialog.show()
 
     # Configure!
     if config_dialog.OK:
         subject_id = config_dialog.data[0]
-        run_number = int(config_dialog.data[1])
-
-        # Set the script path
-        # This could be more flexible, but this is how it is going to work now.
-        script_path = "collective_thought/session1.txt".format(run_number)
-        print("Set script path: {0}".format(script_path))
+        # Several runs make a session: one window, logging process, cache
+        # and audio stream for all of them, with each run loaded in the
+        # background while the one before it is on screen.
+        run_numbers = parse_run_numbers(config_dialog.data[1])
 
         # Specify our location
         # (For now this just controls how we handle receipt of the _first_
@@ -167,6 +424,9 @@ def run_experiment():
             windowed = True
         elif config_dialog.data[3] == u'external':
             windowed = False
+
+        # Optionally record every flip and write a timing report for QA
+        record_timing = (config_dialog.data[4] == u'yes')
     else:
         sys.exit("Canceled at configuration dialog.")
 
@@ -182,7 +442,7 @@ def run_experiment():
     else:
         # At DBIC, with Mac OS X, the scanner projector likes 1280x1024, 60Hz
         # As of 2016-11-06
-        win = visual.Window(
+        win = psy.visual.Window(
             [1280, 1024],
             monitor='testMonitor',
             screen=0,
@@ -196,52 +456,198 @@ def run_experiment():
     loading_message.draw()
     win.flip()
 
-    # This global will hold all of the events we will display
-    # The EventList needs to know about the Window so we can preload the stimuli
-    events = EventList(win)
-    events.read_from_file(script_path)
+    # Shared by every run of the session
+    # Events built ahead of the one on screen hold their stimuli, so those
+    # are never evicted
+    stim_cache = StimulusCache(budget=cache_settings['budget_mb'] * 1024 * 1024,
+                               keep_newest=cache_settings['lookahead'] + 1)
+    if cache_settings['text_textures']:
+        textures = TextTextureCache(win)
+    else:
+        textures = None
+    if movie_settings['stream']:
+        movie_buffer = movie_settings['buffer_frames']
+    else:
+        movie_buffer = None
+    if audio_settings['engine']:
+        if audio_settings['null_output']:
+            audio_output = NullOutput(clock, audio_settings['sample_rate'],
+                                      audio_settings['channels'], audio_settings['block_size'])
+        else:
+            audio_output = SoundDeviceOutput(clock, audio_settings['sample_rate'],
+                                             audio_settings['channels'], audio_settings['block_size'],
+                                             audio_settings['device'])
+        audio = AudioEngine(audio_output, audio_settings['sample_rate'],
+                            audio_settings['channels'])
+    else:
+        audio = None
 
-    if(events.has_overlapping_events()):
-        print("WARNING: Overlapping events detected in input")
+    frame_locked = render_settings['frame_locked']
+    if record_timing or frame_locked:
+        # Measure the refresh rate before the scan starts, so dropped frames
+        # can be recognized
+        frame_rate = measure_frame_rate(win, render_settings['nominal_frame_rate'])
+    else:
+        frame_rate = None
+
+    if location == "usb-serial-simulation":
+        # The scanner emulator writes sync pulses and simulated button
+        # presses to a pty, which we (and the logging process) read in place
+        # of the Lumina box's serial port. One pty serves the whole session.
+        sim_fd, sim_slave_fd, serial_settings['mount'] = open_pty()
+    else:
+        sim_fd = None
 
-    events.create_null_events()
+    # Spawn a second process to do TR and input logging for every run
+    if location == "dbic" or location == "usb-serial-simulation":
+        # Serial input comes back from the logging process through the ring
+        scanner_ring = RecordRing(log_settings['ring_records'])
+        log_control, log_commands = multiprocessing.Pipe(duplex=False)
+        log_proc = multiprocessing.Process(target=serial_logger, args=(log_control, scanner_ring))
+        # Keys are only checked for 'q'; responses come in over serial
+        key_poller = KeyPoller(clock, psy.event.getKeys)
+    elif location == "psychopy-simulation":
+        scanner_ring = None
+        key_ring = RecordRing(log_settings['ring_records'])
+        log_control, log_commands = multiprocessing.Pipe(duplex=False)
+        log_proc = multiprocessing.Process(target=keyboard_logger, args=(log_control, key_ring))
+        key_poller = KeyPoller(clock, psy.event.getKeys, key_ring)
+    log_proc.daemon = True
+    log_proc.start()
 
-    if(events.has_overlapping_events()):
-        print("WARNING: Overlapping events detected after creating null events")
+    # Open the audio stream before the first scan starts
+    events = load_run(run_numbers[0], win, stim_cache, movie_buffer, audio, textures)
+    preloader = Preloader(preload_run, events, audio, clock)
+    if audio:
+        audio.start()
+
+    for position, run_number in enumerate(run_numbers):
+        prefetcher = preloader.result()
+        # Read the next run now and start decoding its files in the
+        # background, so they are decoded while this one is on screen and
+        # the scanner isn't kept waiting between runs. Its stimuli are kept
+        # in the cache at the end of this run.
+        if position + 1 < len(run_numbers):
+            next_events = load_run(run_numbers[position + 1], win, stim_cache,
+                                   movie_buffer, audio, textures)
+            next_preloader = Preloader(preload_run, next_events, audio, clock)
+            keep = set(entry.key() for entry in next_events.events)
+            keep.add(next_events.null_entry().key())
+        else:
+            next_events = None
+            keep = set()
+        quit_pressed = present_run(
+            subject_id, run_number, location, win, clock, events, prefetcher,
+            key_poller, log_proc, log_commands, scanner_ring, audio, frame_rate,
+            record_timing, sim_fd, keep
+        )
+        if quit_pressed:
+            if audio:
+                audio.close()
+            win.close()
+            psy.core.quit()
+        if audio:
+            audio.forget(keep=set(stim_str for kind, stim_str, color, no_audio in keep))
+        if textures is not None:
+            textures.report()
+            textures.forget(keep)
+        if next_events is None:
+            break
+        # Only joined once this run is over
+        events = next_events
+        preloader = next_preloader
+
+    # Stop the log process when we get to the end
+    stop_logging(log_proc, log_commands)
+    if audio:
+        audio.close()
+
+def present_run(subject_id, run_number, location, win, clock, events, prefetcher,
+                key_poller, log_proc, log_commands, scanner_ring, audio, frame_rate,
+                record_timing, sim_fd, keep):
+    """
+    Waits for the scanner, shows one run and writes its logs and reports.
+    Stimuli whose keys are in keep are left in the cache for the next run.
+    scanner_ring, if any, carries serial input from the logging process.
+    Returns True if 'q' was pressed, after stopping the logging process.
+    """
+    global serial_settings
+    global fmri_settings
+    global cache_settings
+    global render_settings
+    global emulator_settings
+    global resync_settings
 
     # Specify the TR duration
     tr_dur = fmri_settings['TR']
 
     # Find the duration of the event list in TRs/volumes
-    fmri_settings['volumes'] = math.ceil(float(events.dur()) / tr_dur)
+    fmri_settings['volumes'] = math.ceil(events.total_dur_us / 1e6 / tr_dur)
+
+    frame_locked = render_settings['frame_locked']
+    if frame_locked:
+        frame_clock = FrameClock(clock, frame_rate)
+        frame_clock.plan(events.events)
+        frames_filename = u'{0}_run_{1}_frames.txt'.format(subject_id, run_number)
+
+    if record_timing:
+        recorder = FlipRecorder(
+            clock, frame_rate,
+            capacity=int(events.total_dur_us / 1e6 * frame_rate * 1.2) + 1000
+        )
+        timing_filename = u'{0}_run_{1}_timing.txt'.format(subject_id, run_number)
 
+    if resync_settings['enabled'] and scanner_ring is not None and not frame_locked:
+        resync = ResyncEngine(tr_dur, window=resync_settings['window'],
+                              outlier_threshold=resync_settings['outlier_ms'] / 1000.0)
+        resync_filename = u'{0}_run_{1}_resync.txt'.format(subject_id, run_number)
+    else:
+        resync = None
+
+    # Sounds are cued a few events ahead, and have to follow the same clock
+    # as the deadlines of the events on screen
+    if frame_locked:
+        events.to_clock = frame_clock.time_of
+    elif resync:
+        events.to_clock = lambda us: resync.to_local(us / 1e6)
+    else:
+        events.to_clock = script_time
+
+    # Shown after movies that end early and while sounds play. It is built
+    # once, before the scan, rather than for every movie and sound.
+    null_display = events.null_display()
 
     if location == "psychopy-simulation":
         # The experiment starts in sync with the first scanner trigger.
         # To test, set mode='Test'
         # To scan, set mode='Scan'
+        from psychopy.hardware.emulator import launchScan
         vol = launchScan(win, fmri_settings, globalClock=clock, mode='Test')
 
     elif location == "usb-serial-simulation":
         wait_stim = psy.visual.TextStim(win, pos=[0,0], text="Waiting for fake scanner")
+
         # Wait till trigger
+        import serial
         ser = serial.Serial(serial_settings['mount'], serial_settings['baud'])
         ser.flushInput()
 
-        sim_proc = multiprocessing.Process(target=fake_scanner_serial_output)
+        null_key = events.null_entry().key()
+        onsets = [entry.start_us / 1e6 for entry in events.events if entry.key() != null_key]
+        sim_stop = multiprocessing.Event()
+        sim_proc = multiprocessing.Process(
+            target=run_emulator,
+            args=(sim_fd, emulator_settings, int(fmri_settings['volumes']), onsets, sim_stop)
+        )
         sim_proc.daemon = True
         sim_proc.start()
 
-        sim_buttons = multiprocessing.Process(target=fake_button_pressing)
-        sim_buttons.daemon = True
-        sim_buttons.start()
-
         trigger = ''
         while trigger != fmri_settings['sync']:
             wait_stim.draw()
             win.flip()
             print("Initiating blocking ser.read()...")
-            trigger = ser.read()
+            trigger = read_trigger(ser)
             print("Serial readout: {0}".format(trigger))
         # We close this serial object now because
         # further serial input will be read by a different process
@@ -250,97 +656,191 @@ def run_experiment():
     elif location == "dbic":
         wait_stim = psy.visual.TextStim(win, pos=[0,0], text="Waiting for scanner")
         # Wait till trigger
+        import serial
         ser = serial.Serial(serial_settings['mount'], serial_settings['baud'], timeout = serial_settings['timeout'])
         ser.flushInput()
         trigger = ''
         while trigger != fmri_settings['sync']:
             wait_stim.draw()
             win.flip()
-            trigger = ser.read()
+            trigger = read_trigger(ser)
         # We close this serial object now because
         # further serial input will be read by a different process
         ser.close()
 
-    t0 = time.time()
-
-    mgr = multiprocessing.Manager()
-    shared_keys = mgr.list()
+    # Reset the clock after getting the scanner trigger. The logging process
+    # stamps input relative to the same moment.
+    clock.reset()
+    t0 = run_clock_origin(clock)
 
-    # Spawn a second process to do TR and input logging
+    # Start this run's logs, dropping any serial input left over from the
+    # end of the last run first
+    if scanner_ring is not None:
+        scanner_ring.drain()
     if location == "dbic" or location == "usb-serial-simulation":
         log_filename = u'{0}_run_{1}_log.txt'.format(subject_id, run_number)
         log_tr_filename = u'{0}_run_{1}_tr_log.txt'.format(subject_id, run_number)
-        log_proc = multiprocessing.Process(target=log_serial_input, args=(log_filename, log_tr_filename, t0))
+        log_commands.send((log_filename, log_tr_filename, t0, serial_settings['mount']))
     elif location == "psychopy-simulation":
         log_filename = u'{0}_run_{1}_key_log.txt'.format(subject_id, run_number)
         log_tr_filename = u'{0}_run_{1}_tr_key_log.txt'.format(subject_id, run_number)
-        log_proc = multiprocessing.Process(target=log_keyboard_input, args=(log_filename, log_tr_filename, t0, shared_keys))
-    log_proc.daemon = True
-    log_proc.start()
-
-    # Reset the clock after getting the scanner trigger
-    clock.reset()
+        log_commands.send((log_filename, log_tr_filename, t0))
 
     # This script uses "non-slip" timing, presenting stimuli relative to the
     # clock time when the first scanner trigger was received. This should ensure
     # a minimum of drift without locking the stimuli to each TR.
     # http://www.psychopy.org/general/timing/nonSlipTiming.html
-    end_time = 0
-    for event in events.events:
-        print event.stim
-        end_time += event.dur
-        print end_time
+    if record_timing:
+        recorder.attach(win)
+
+    # Keys are polled after every flip of every event type, so they are
+    # logged as they happen rather than in a clump after each event.
+    key_poller.attach(win)
+
+    # In frame-locked mode, events are timed on the frame clock, which
+    # counts the flips made from here on.
+    if frame_locked:
+        frame_clock.attach(win)
+        display_clock = frame_clock
+    else:
+        display_clock = clock
+
+    def hold(on_screen, end_time):
+        """
+        Shows on_screen once, then waits for end_time without redrawing,
+        waking only to collect keys.
+        """
+        if(clock.getTime() < end_time):
+            on_screen.display()
+            if record_timing:
+                recorder.mark_hold()
+            wait_until(clock, end_time, key_poller.poll,
+                       render_settings['poll_interval'], render_settings['spin'])
+
+    if render_settings['flip_on_change'] and not frame_locked:
+        hold_static = hold
+    else:
+        hold_static = None
+
+    # Event times are summed exactly in integer microseconds. The float
+    # end_time compared against the clock on every frame is computed from
+    # that sum once per event, so it never accumulates rounding error.
+    end_us = 0
+    end_time = 0.0
+    quit_pressed = False
+    # (time, source, code) of everything read from the serial port this run
+    scanner_input = []
+    sync_code = ord(fmri_settings['sync'])
+
+    def read_scanner():
+        records = scanner_ring.drain()
+        scanner_input.extend(records)
+        if resync:
+            for t, source, code in records:
+                if(code == sync_code):
+                    resync.pulse(t)
+    for index, event in enumerate(events.iter_materialized(
+            lookahead=cache_settings['lookahead'], prefetcher=prefetcher, keep=keep)):
+        print(event.stim)
+        if record_timing:
+            recorder.mark_onset(index, event.stim_str, end_time)
+        end_us += event.dur_us
+        if frame_locked:
+            end_time = frame_clock.begin(index)
+        elif resync:
+            # The deadline is script time on the scanner's clock, moved onto
+            # the run clock with the fit to the pulses so far
+            read_scanner()
+            end_time = resync.to_local(end_us / 1e6)
+        else:
+            end_time = end_us / 1e6
+        print(end_time)
 
         # Movies require special handling
-        if(event.__class__ == MovieEvent):
+        if(event.__class__ in (MovieEvent, StreamingMovieEvent)):
             # We pass the global clock and the end_time to the MovieEvent to
             # handle timing. The MovieEvent will cut off the movie early if the
             # movie file is longer than the duration specified in the script file.
-            event.display(clock, end_time)
+            if(event.__class__ == StreamingMovieEvent):
+                # The null event stays up until the first frame is decoded
+                event.display(display_clock, end_time, null_display)
+            else:
+                event.display(display_clock, end_time)
 
             # If a MovieEvent ends earlier than the duration specified in the script
             # file, we display a null event for the remaining time in order to
             # maintain continuity (no blank screens).
-            post_movie_null = create_event_for_stim([None, None, events.null_event], win)
-            while(clock.getTime() < end_time):
-                post_movie_null.display()
+            if hold_static:
+                hold_static(null_display, end_time)
+            else:
+                while(display_clock.getTime() < end_time):
+                    null_display.display()
 
         # Sounds require special handling
         elif(event.__class__ == SoundEvent):
             # SoundEvents also need to know the end_time so the sound can be cut off
             # early if the sound file is too long.
 
-            # We also need a null event to draw to the screen while we're playing
-            # the sound
-            sound_null = create_event_for_stim([None, None, events.null_event], win)
-
-            event.display(clock, end_time, sound_null)
+            # The null event is drawn to the screen while we're playing the sound
+            event.display(display_clock, end_time, null_display, hold_static)
+        elif hold_static:
+            hold_static(event, end_time)
         else:
-            while(clock.getTime() < end_time):
+            while(display_clock.getTime() < end_time):
                 event.display()
 
-        # Move all the keys pressed during the event to shared_keys only _after_
-        # the event is over.
-        now_keys = psy.event.getKeys()
-        if(len(now_keys) > 0):
-            shared_keys += now_keys
+        key_poller.poll()
+        now_keys = key_poller.take_event_keys()
+        if scanner_ring is not None:
+            read_scanner()
 
         # If 'q' was pressed during an event, terminate the experiment after
         # that event ends.
         if('q' in now_keys):
-            log_proc.terminate()
-            print("--- Quit experiment because 'q' was pressed. ---")
-            with open(log_filename, 'a') as logfile:
-                logfile.write("--- Quit experiment because 'q' was pressed. ---")
-            with open(log_tr_filename, 'a') as logfile:
-                logfile.write("--- Quit experiment because 'q' was pressed. ---")
-            if location == "usb-serial-simulation":
-                sim_proc.terminate()
-                sim_buttons.terminate()
-            win.close()
-            psy.core.quit()
-
-    log_proc.terminate()    # Terminate the log process when we get to the end
+            quit_pressed = True
+            break
+
+    # Stop this run's logging, and leave the window as it was for the next run
+    if frame_locked:
+        frame_clock.detach(win)
+    key_poller.detach(win)
+    if record_timing:
+        recorder.detach(win)
+    log_commands.send(LOG_STOP)
+    if quit_pressed:
+        stop_logging(log_proc, log_commands)
+    if location == "usb-serial-simulation":
+        sim_stop.set()
+        sim_proc.join()
+    prefetcher.stop()
+    prefetcher.report()
+    if audio:
+        audio.report()
+    if scanner_ring is not None:
+        read_scanner()
+        print("Received {0} TR pulses and {1} other serial inputs".format(
+            sum(1 for t, source, code in scanner_input if code == sync_code),
+            sum(1 for t, source, code in scanner_input if code != sync_code)
+        ))
+        if scanner_ring.dropped:
+            print("WARNING: {0} serial inputs didn't fit in the ring".format(scanner_ring.dropped))
+    if record_timing:
+        recorder.write_report(timing_filename)
+    if frame_locked:
+        frame_clock.write_report(frames_filename)
+    if resync:
+        resync.write_log(resync_filename)
+        print("Resync: skew {0:.1f} ppm, offset {1:.2f} ms, {2} outlying pulses".format(
+            (resync.skew - 1) * 1e6, resync.offset * 1000,
+            sum(1 for c in resync.corrections if c.outlier)
+        ))
+    if quit_pressed:
+        print("--- Quit experiment because 'q' was pressed. ---")
+        with open(log_filename, 'a') as logfile:
+            logfile.write("--- Quit experiment because 'q' was pressed. ---")
+        with open(log_tr_filename, 'a') as logfile:
+            logfile.write("--- Quit experiment because 'q' was pressed. ---")
+    return(quit_pressed)
 
 if __name__ == '__main__':
     run_experiment()
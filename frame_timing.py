@@ -0,0 +1,113 @@
+"""
+Opt-in recording of when every frame was actually flipped, for checking
+stimulus timing after a run.
+"""
+import array
+
+# A flip interval longer than this many frame periods means at least one
+# frame was dropped.
+DROPPED_FRAME_THRESHOLD = 1.5
+
+# Width of the bins in the flip interval histogram, in milliseconds
+HISTOGRAM_BIN_MS = 1.0
+
+class FlipRecorder(object):
+    """
+    Records a timestamp (on the run clock) after every win.flip(), into an
+    array allocated before the run starts. Events call mark_onset() before
+    they are displayed, so the first flip after the mark is the actual onset
+    of the event.
+    """
+    def __init__(self, clock, frame_rate=60.0, capacity=100000):
+        self.clock = clock
+        self.frame_period = 1.0 / frame_rate
+        self.flip_times = array.array('d', [0.0]) * capacity
+        self.count = 0
+        # (index, stim_str, planned onset, number of the onset flip)
+        self.onsets = []
+        # Numbers of flips that followed a deliberate wait (see mark_hold)
+        self.holds = set()
+
+    def attach(self, win):
+        """Wraps win.flip() so every flip is recorded."""
+        original_flip = win.flip
+        def flip(*args, **kwargs):
+            result = original_flip(*args, **kwargs)
+            self.record(self.clock.getTime())
+            return(result)
+        win.flip = flip
+        self._original_flip = original_flip
+
+    def detach(self, win):
+        """Undoes attach(). Detach in the reverse order of attaching."""
+        win.flip = self._original_flip
+
+    def record(self, t):
+        if(self.count == len(self.flip_times)):
+            # Only happens if the run is much longer than planned for
+            self.flip_times.extend(array.array('d', [0.0]) * len(self.flip_times))
+        self.flip_times[self.count] = t
+        self.count += 1
+
+    def mark_onset(self, index, stim_str, planned):
+        self.onsets.append((index, stim_str, float(planned), self.count))
+
+    def mark_hold(self):
+        """
+        Marks the gap before the next flip as deliberate (a static frame
+        being held), so it isn't counted as dropped frames.
+        """
+        self.holds.add(self.count)
+
+    def intervals(self):
+        flip_times = self.flip_times
+        return([flip_times[i] - flip_times[i - 1] for i in range(1, self.count)
+                if i not in self.holds])
+
+    def dropped_frames(self, intervals):
+        dropped = 0
+        for interval in intervals:
+            if(interval > DROPPED_FRAME_THRESHOLD * self.frame_period):
+                dropped += int(round(interval / self.frame_period)) - 1
+        return(dropped)
+
+    def onset_errors(self):
+        """Returns (index, stim_str, planned, actual, error) for each onset."""
+        errors = []
+        for index, stim_str, planned, flip_number in self.onsets:
+            if(flip_number < self.count):
+                actual = self.flip_times[flip_number]
+                errors.append((index, stim_str, planned, actual, actual - planned))
+        return(errors)
+
+    def histogram(self, intervals):
+        bins = {}
+        for interval in intervals:
+            bin_start = int(interval * 1000 // HISTOGRAM_BIN_MS)
+            bins[bin_start] = bins.get(bin_start, 0) + 1
+        return(sorted(bins.items()))
+
+    def write_report(self, filename):
+        intervals = self.intervals()
+        errors = self.onset_errors()
+        abs_errors = [abs(error[4]) for error in errors]
+        with open(filename, 'w') as report:
+            report.write("# Frame timing report\n")
+            report.write("flips,{0}\n".format(self.count))
+            report.write("frame_period_ms,{0:.3f}\n".format(self.frame_period * 1000))
+            report.write("dropped_frames,{0}\n".format(self.dropped_frames(intervals)))
+            if(abs_errors):
+                report.write("onset_error_max_ms,{0:.3f}\n".format(max(abs_errors) * 1000))
+                report.write("onset_error_mean_ms,{0:.3f}\n".format(
+                    sum(abs_errors) / len(abs_errors) * 1000
+                ))
+            report.write("# Flip interval histogram\n")
+            report.write("interval_ms,flips\n")
+            for bin_start, flips in self.histogram(intervals):
+                report.write("{0:g},{1}\n".format(bin_start * HISTOGRAM_BIN_MS, flips))
+            report.write("# Onsets\n")
+            report.write("index,stim,planned,actual,error_ms\n")
+            for index, stim_str, planned, actual, error in errors:
+                report.write("{0},{1},{2:.6f},{3:.6f},{4:.3f}\n".format(
+                    index, stim_str, planned, actual, error * 1000
+                ))
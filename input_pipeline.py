@@ -0,0 +1,54 @@
+"""
+Collects key presses on every frame, timestamped on the run clock, and
+passes them to the logging process through a shared-memory RecordRing.
+"""
+from ipc_ring import SOURCE_KEYBOARD, encode_key
+
+# Control messages sent to the logging process over its control pipe.
+# LOG_STOP ends a run, once every record of the run has been pushed.
+LOG_STOP = None
+
+# Sent to the logging process when the session is over
+LOG_QUIT = 'quit'
+
+class KeyPoller(object):
+    """
+    Polls get_keys(timeStamped=clock) after every flip (see attach) and
+    whenever poll() is called, e.g. while a static frame is being held. Each
+    key is pushed to ring as a (time, SOURCE_KEYBOARD, code) record, which
+    the logging process reads straight out of shared memory. With no ring,
+    keys are only kept for take_event_keys().
+    """
+    def __init__(self, clock, get_keys, ring=None):
+        self.clock = clock
+        self.get_keys = get_keys
+        self.ring = ring
+        self.event_keys = []
+
+    def attach(self, win):
+        """Wraps win.flip() so keys are polled after every flip."""
+        original_flip = win.flip
+        def flip(*args, **kwargs):
+            result = original_flip(*args, **kwargs)
+            self.poll()
+            return(result)
+        win.flip = flip
+        self._original_flip = original_flip
+
+    def detach(self, win):
+        """Undoes attach(). Detach in the reverse order of attaching."""
+        win.flip = self._original_flip
+
+    def poll(self):
+        keys = self.get_keys(timeStamped=self.clock)
+        if(keys):
+            for key, t in keys:
+                self.event_keys.append(key)
+                if(self.ring is not None):
+                    self.ring.push(t, SOURCE_KEYBOARD, encode_key(key))
+
+    def take_event_keys(self):
+        """Returns the names of the keys pressed since the last call."""
+        keys = self.event_keys
+        self.event_keys = []
+        return(keys)
@@ -0,0 +1,108 @@
+"""
+A fixed-size ring of (time, source, code) records in shared memory, for
+passing input events between the render process and the logging process
+without pickling, locks or a server process.
+"""
+import ctypes
+from multiprocessing.sharedctypes import RawArray
+
+DEFAULT_CAPACITY = 65536
+
+# Where a record came from
+SOURCE_KEYBOARD = 1
+SOURCE_SERIAL = 2
+
+# Key names longer than one character get codes from this table. Single
+# characters are coded as their character code.
+KEY_NAMES = [
+    'space', 'return', 'escape', 'tab', 'backspace', 'delete',
+    'left', 'right', 'up', 'down',
+    'lshift', 'rshift', 'lctrl', 'rctrl', 'lalt', 'ralt',
+    'num_0', 'num_1', 'num_2', 'num_3', 'num_4',
+    'num_5', 'num_6', 'num_7', 'num_8', 'num_9'
+]
+KEY_NAME_BASE = 0x110000
+UNKNOWN_KEY = -1
+
+def encode_key(name):
+    if(len(name) == 1):
+        return(ord(name))
+    if(name in KEY_NAMES):
+        return(KEY_NAME_BASE + KEY_NAMES.index(name))
+    return(UNKNOWN_KEY)
+
+def decode_key(code):
+    if(code == UNKNOWN_KEY):
+        return('?')
+    if(code >= KEY_NAME_BASE):
+        return(KEY_NAMES[code - KEY_NAME_BASE])
+    try:
+        return(unichr(code))
+    except NameError:
+        # Python 3
+        return(chr(code))
+
+class RecordRing(object):
+    """
+    A single-producer, single-consumer queue of (time, source, code) records
+    in shared memory. Create it before starting the other process and pass
+    it in the Process args; one process may only push() and the other may
+    only drain().
+
+    The producer writes a record into its slot and only then advances the
+    written count; the consumer reads slots up to that count and then
+    advances the read count. Each count has one writer and is published
+    with a single store to an aligned 64-bit word, so it is never seen half
+    written, and no lock is needed: a lock shared with the logger could
+    stall the render loop whenever the logger is descheduled while holding
+    it. When the ring is full, push() drops the record and counts it
+    rather than overwriting records not yet read.
+
+    Python has no memory fence, so nothing but the order of the stores
+    keeps a record ahead of the count that publishes it. x86 never
+    reorders stores; CPUs that do (ARM) could in principle let the logger
+    read a slot a moment before its contents arrive.
+    """
+    def __init__(self, capacity=DEFAULT_CAPACITY):
+        self.capacity = capacity
+        self._times = RawArray(ctypes.c_double, capacity)
+        self._sources = RawArray(ctypes.c_int32, capacity)
+        self._codes = RawArray(ctypes.c_int32, capacity)
+        # Records written (the head), records read (the tail), records
+        # dropped. The consumer only ever writes the tail.
+        self._counts = RawArray(ctypes.c_uint64, 3)
+
+    def __len__(self):
+        return(self._counts[0] - self._counts[1])
+
+    @property
+    def dropped(self):
+        return(self._counts[2])
+
+    def push(self, t, source, code):
+        """Adds a record. Returns False if the ring was full."""
+        counts = self._counts
+        written = counts[0]
+        if(written - counts[1] >= self.capacity):
+            counts[2] += 1
+            return(False)
+        slot = written % self.capacity
+        self._times[slot] = t
+        self._sources[slot] = source
+        self._codes[slot] = code
+        counts[0] = written + 1
+        return(True)
+
+    def drain(self):
+        """Returns every record written since the last drain, oldest first."""
+        counts = self._counts
+        read = counts[1]
+        written = counts[0]
+        capacity = self.capacity
+        times, sources, codes = self._times, self._sources, self._codes
+        records = []
+        for n in range(read, written):
+            slot = n % capacity
+            records.append((times[slot], sources[slot], codes[slot]))
+        counts[1] = written
+        return(records)
@@ -0,0 +1,312 @@
+"""
+Aligns a run's response and TR logs with its script after the scan, and
+writes a BIDS events file and a per-volume timing file next to the logs:
+
+    <subject>_run_<n>_events.tsv    one row per stimulus and per response
+    <subject>_run_<n>_volumes.tsv   one row per volume (TR)
+
+Logs and the compiled run plan (see run_plan.py) are loaded into numpy
+arrays, and each response is matched to the event on screen and the volume
+being acquired with a single searchsorted over the sorted onsets, rather
+than a loop over rows.
+
+Run as a script to align every run in a study directory, across all cores:
+
+    python log_align.py study/ --script collective_thought/session1.txt
+
+--script may contain {subject} and {run}, which are filled in from each
+log's name, e.g. --script 'scripts/{subject}_run_{run}.txt'.
+"""
+import argparse
+import collections
+import multiprocessing
+import os
+import re
+import struct
+import sys
+
+import numpy
+
+from log_writer import BINARY_INPUT_BYTES, binary_filename_for
+from run_plan import load_plan
+from timeline import parse_event_strings
+
+# Response logs written by fmri_go, at serial and keyboard locations. TR
+# logs sit beside them with 'tr_' before the last part of the name.
+LOG_NAME = re.compile(r'^(?P<subject>.+)_run_(?P<run>\d+)_(?P<log>log|key_log)\.txt$')
+
+# Alignment of one run, for the summary line printed by align_study()
+RunSummary = collections.namedtuple(
+    'RunSummary', ['log_filename', 'events', 'responses', 'volumes', 'unmatched']
+)
+
+def tr_filename_for(log_filename):
+    directory, filename = os.path.split(log_filename)
+    match = LOG_NAME.match(filename)
+    return(os.path.join(directory, u'{0}_run_{1}_tr_{2}.txt'.format(
+        match.group('subject'), match.group('run'), match.group('log')
+    )))
+
+def output_prefix_for(log_filename):
+    directory, filename = os.path.split(log_filename)
+    match = LOG_NAME.match(filename)
+    return(os.path.join(directory, u'{0}_run_{1}'.format(
+        match.group('subject'), match.group('run')
+    )))
+
+def read_csv_log(filename):
+    """
+    Returns the (times, inputs) of a CSV log as a float64 array and a string
+    array. Headers (there is one per time the file was opened) and the note
+    written when 'q' ends a run are skipped.
+    """
+    times = []
+    inputs = []
+    with open(filename) as log:
+        for line in log:
+            line = line.strip()
+            if(not line or line == 'time,input' or line.startswith('---')):
+                continue
+            t, value = line.split(',', 1)
+            times.append(float(t))
+            inputs.append(value)
+    return(numpy.array(times, dtype='<f8'), numpy.array(inputs, dtype=str))
+
+def read_binary_log(filename):
+    """
+    Like log_writer.read_binary_log(), but returns (times, inputs) arrays,
+    reading each block's fields straight into numpy.
+    """
+    times = []
+    inputs = []
+    with open(filename, 'rb') as binary_file:
+        data = binary_file.read()
+    position = 0
+    while(position + 4 <= len(data)):
+        count = struct.unpack_from('<I', data, position)[0]
+        position += 4
+        times.append(numpy.frombuffer(data, dtype='<f8', count=count, offset=position))
+        position += 8 * count
+        inputs.append(numpy.frombuffer(data, dtype='S{0}'.format(BINARY_INPUT_BYTES),
+                                       count=count, offset=position))
+        position += BINARY_INPUT_BYTES * count
+    if(not times):
+        return(numpy.zeros(0, dtype='<f8'), numpy.zeros(0, dtype=str))
+    return(numpy.concatenate(times),
+           numpy.char.decode(numpy.concatenate(inputs), 'utf-8'))
+
+def read_log(filename):
+    """Reads a log, from its binary copy if there is one."""
+    binary_filename = binary_filename_for(filename)
+    if(os.path.exists(binary_filename)):
+        return(read_binary_log(binary_filename))
+    return(read_csv_log(filename))
+
+def assign(starts, ends, times):
+    """
+    For each time, the index of the interval [starts[i], ends[i]) holding
+    it, or -1. starts must be sorted; where intervals overlap, the one that
+    started last among those holding the time wins.
+
+    The interval that started last before each time is found with one
+    searchsorted. If it has already ended, an earlier, longer one may
+    still be running (e.g. a movie around a short cue); the running
+    maximum of the ends tells which times that can happen for, and only
+    those are scanned back.
+    """
+    if(not len(starts)):
+        return(numpy.full(len(times), -1, dtype=numpy.intp))
+    index = numpy.searchsorted(starts, times, side='right') - 1
+    clipped = numpy.maximum(index, 0)
+    started = index >= 0
+    assigned = numpy.where(started & (times < ends[clipped]), index, -1)
+    reach = numpy.maximum.accumulate(ends)
+    for k in numpy.flatnonzero(started & (assigned < 0) & (times < reach[clipped])).tolist():
+        i = index[k]
+        while(ends[i] <= times[k]):
+            i -= 1
+        assigned[k] = i
+    return(assigned)
+
+def first_in_group(groups, n):
+    """For each of n groups, the position of its first member in groups, or -1."""
+    first = numpy.full(n, -1, dtype=numpy.intp)
+    matched = numpy.flatnonzero(groups >= 0)
+    found, position = numpy.unique(groups[matched], return_index=True)
+    first[found] = matched[position]
+    return(first)
+
+def format_number(value):
+    return('n/a' if numpy.isnan(value) else '{0:.6f}'.format(value))
+
+def align_run(log_filename, plan, tr_filename=None, output_prefix=None, null_event=True):
+    """
+    Aligns one run's logs with its RunPlan and writes the events and volumes
+    files. Null events are left out of the events file unless null_event.
+    Returns a RunSummary.
+    """
+    if(tr_filename is None):
+        tr_filename = tr_filename_for(log_filename)
+    if(output_prefix is None):
+        output_prefix = output_prefix_for(log_filename)
+
+    response_times, response_inputs = read_log(log_filename)
+    order = numpy.argsort(response_times, kind='stable')
+    response_times = response_times[order]
+    response_inputs = response_inputs[order]
+    pulse_times, pulse_inputs = read_log(tr_filename)
+
+    events = plan.events
+    starts = events['start_us'] / 1e6
+    durations = events['dur_us'] / 1e6
+    ends = starts + durations
+    assets = plan.assets
+    asset_index = events['asset']
+
+    # Volume 0 starts with the trigger, at time 0 on the run clock. The
+    # last volume is taken to last as long as the typical one before it.
+    volume_starts = numpy.concatenate(([0.0], numpy.sort(pulse_times)))
+    if(len(volume_starts) > 1):
+        last_dur = numpy.median(numpy.diff(volume_starts))
+    else:
+        last_dur = ends.max() if len(ends) else 0.0
+    volume_ends = numpy.append(volume_starts[1:], volume_starts[-1] + last_dur)
+
+    response_events = assign(starts, ends, response_times)
+    response_volumes = assign(volume_starts, volume_ends, response_times)
+    first_response = first_in_group(response_events, len(events))
+    volume_events = assign(starts, ends, volume_starts)
+    volume_responses = numpy.bincount(response_volumes[response_volumes >= 0],
+                                      minlength=len(volume_starts))
+
+    response_time = numpy.full(len(events), numpy.nan)
+    has_response = first_response >= 0
+    response_time[has_response] = (response_times[first_response[has_response]]
+                                   - starts[has_response])
+
+    null_key = null_asset(plan)
+    shown = numpy.ones(len(events), dtype=bool)
+    if(not null_event):
+        shown = asset_index != null_key
+
+    rows = []
+    for i in numpy.flatnonzero(shown).tolist():
+        kind, stim_str, color, no_audio = assets[asset_index[i]]
+        if(kind == 'text'):
+            stim_file, value = 'n/a', stim_str
+        else:
+            stim_file, value = stim_str, 'n/a'
+        if(asset_index[i] == null_key):
+            kind = 'null'
+        response = response_inputs[first_response[i]] if has_response[i] else 'n/a'
+        rows.append((starts[i], '{0:.6f}'.format(durations[i]), kind, stim_file, value,
+                     response, format_number(response_time[i])))
+    for t, value in zip(response_times.tolist(), response_inputs.tolist()):
+        rows.append((t, '0', 'response', 'n/a', value, 'n/a', 'n/a'))
+    # Stable, so a response at an event's onset comes after the event
+    rows.sort(key=lambda row: row[0])
+
+    with open(output_prefix + '_events.tsv', 'w') as tsv:
+        tsv.write("onset\tduration\ttrial_type\tstim_file\tvalue\tresponse\tresponse_time\n")
+        tsv.write(''.join(
+            '{0:.6f}\t{1}\t{2}\t{3}\t{4}\t{5}\t{6}\n'.format(*row) for row in rows
+        ))
+
+    with open(output_prefix + '_volumes.tsv', 'w') as tsv:
+        tsv.write("volume\tonset\tduration\tstimulus\tresponses\n")
+        tsv.write(''.join(
+            '{0}\t{1:.6f}\t{2:.6f}\t{3}\t{4}\n'.format(
+                volume, onset, end - onset,
+                assets[asset_index[event]][1] if event >= 0 else 'n/a', responses
+            )
+            for volume, (onset, end, event, responses) in enumerate(zip(
+                volume_starts.tolist(), volume_ends.tolist(),
+                volume_events.tolist(), volume_responses.tolist()
+            ))
+        ))
+
+    return(RunSummary(log_filename, int(shown.sum()), len(response_times),
+                      len(volume_starts), int((response_events < 0).sum())))
+
+def null_asset(plan):
+    """The index of the plan's null stimulus in plan.assets, or -1."""
+    if(plan.null_event is None):
+        return(-1)
+    key = parse_event_strings([None, None, plan.null_event]).key()
+    if(key not in plan.assets):
+        return(-1)
+    return(plan.assets.index(key))
+
+def find_logs(paths):
+    """Expands directories in paths into the response logs inside them."""
+    logs = []
+    for path in paths:
+        if(os.path.isdir(path)):
+            for directory, subdirectories, filenames in os.walk(path):
+                for filename in sorted(filenames):
+                    if(LOG_NAME.match(filename)):
+                        logs.append(os.path.join(directory, filename))
+        else:
+            logs.append(path)
+    return(logs)
+
+def script_for(log_filename, script_pattern):
+    match = LOG_NAME.match(os.path.basename(log_filename))
+    return(script_pattern.format(subject=match.group('subject'), run=match.group('run')))
+
+# Each worker process gets the plans once, when it starts, rather than with
+# every run
+_worker_plans = {}
+
+def _init_worker(plans):
+    _worker_plans.update(plans)
+
+def _align_task(task):
+    log_filename, script_path, null_event = task
+    try:
+        return(align_run(log_filename, _worker_plans[script_path], null_event=null_event))
+    except (ValueError, IOError, IndexError) as e:
+        return(RunSummary(log_filename, None, None, None, str(e)))
+
+def align_study(paths, script_pattern, jobs=None, null_event=True):
+    """
+    Aligns every run whose response log is in paths, in parallel over jobs
+    processes (all cores by default), printing a line per run. Each script
+    is compiled (or loaded from its cached plan) once, up front. Returns the
+    number of runs that failed.
+    """
+    tasks = [(log_filename, script_for(log_filename, script_pattern), null_event)
+             for log_filename in find_logs(paths)]
+    plans = {}
+    for script_path in sorted(set(task[1] for task in tasks)):
+        plans[script_path] = load_plan(script_path)
+    problems = 0
+    pool = multiprocessing.Pool(jobs, initializer=_init_worker, initargs=(plans,))
+    try:
+        chunksize = max(1, len(tasks) // (4 * (jobs or multiprocessing.cpu_count())))
+        for summary in pool.imap_unordered(_align_task, tasks, chunksize):
+            if(summary.events is None):
+                print("FAIL {0}: {1}".format(summary.log_filename, summary.unmatched))
+                problems += 1
+            else:
+                print("OK   {0}: {1} events, {2} responses ({3} outside any event), "
+                      "{4} volumes".format(summary.log_filename, summary.events,
+                                           summary.responses, summary.unmatched,
+                                           summary.volumes))
+    finally:
+        pool.close()
+        pool.join()
+    return(problems)
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description=__doc__,
+                                     formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('paths', nargs='+', help="response logs or study directories")
+    parser.add_argument('--script', required=True,
+                        help="script of each run; may contain {subject} and {run}")
+    parser.add_argument('--jobs', type=int, default=None,
+                        help="worker processes (default: one per core)")
+    parser.add_argument('--no-null', action='store_true',
+                        help="leave null events out of the events files")
+    args = parser.parse_args()
+    sys.exit(1 if align_study(args.paths, args.script, args.jobs, not args.no_null) else 0)
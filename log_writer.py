@@ -0,0 +1,97 @@
+"""
+Buffered writers for the response and TR logs.
+"""
+import struct
+import time
+
+# Width of the input column in binary logs. Inputs are single characters or
+# key names, so anything longer is truncated.
+BINARY_INPUT_BYTES = 8
+
+def binary_filename_for(filename):
+    """The binary log written next to a CSV log, e.g. x_log.txt -> x_log.bin"""
+    if(filename.endswith('.txt')):
+        filename = filename[:-len('.txt')]
+    return(filename + '.bin')
+
+def as_bytes(value):
+    if(not isinstance(value, bytes)):
+        value = u'{0}'.format(value).encode('utf-8')
+    return(value[:BINARY_INPUT_BYTES].ljust(BINARY_INPUT_BYTES, b'\0'))
+
+class LogWriter(object):
+    """
+    Keeps one log file open for the whole run and buffers (time, input)
+    records in memory, writing them out in batches once flush_records have
+    piled up or flush_interval seconds have passed, and on close().
+
+    If binary is true, the same records also go to a binary file beside the
+    CSV. It is written in blocks, one per flush: a little-endian uint32 record
+    count, then that many float64 times, then that many fixed-width input
+    fields. read_binary_log() reads it back.
+    """
+    def __init__(self, filename, binary=False, flush_records=256,
+                 flush_interval=1.0):
+        self.filename = filename
+        self.flush_records = flush_records
+        self.flush_interval = flush_interval
+        self.records = []
+        self.logfile = open(filename, 'a')
+        self.logfile.write("time,input\n")
+        self.logfile.flush()
+        if(binary):
+            self.binary_file = open(binary_filename_for(filename), 'ab')
+        else:
+            self.binary_file = None
+        self.last_flush = time.time()
+
+    def write(self, t, value):
+        self.records.append((t, value))
+        if(len(self.records) >= self.flush_records):
+            self.flush()
+
+    def tick(self):
+        """Flushes if flush_interval has passed. Call this while idle."""
+        if(self.records and time.time() - self.last_flush >= self.flush_interval):
+            self.flush()
+
+    def flush(self):
+        records = self.records
+        self.records = []
+        self.last_flush = time.time()
+        if(not records):
+            return
+        self.logfile.write(''.join(
+            "{0},{1}\n".format(t, value) for t, value in records
+        ))
+        self.logfile.flush()
+        if(self.binary_file is not None):
+            count = len(records)
+            self.binary_file.write(struct.pack('<I', count))
+            self.binary_file.write(struct.pack(
+                '<{0}d'.format(count), *[float(t) for t, value in records]
+            ))
+            self.binary_file.write(b''.join(as_bytes(value) for t, value in records))
+            self.binary_file.flush()
+
+    def close(self):
+        self.flush()
+        self.logfile.close()
+        if(self.binary_file is not None):
+            self.binary_file.close()
+
+def read_binary_log(filename):
+    """Returns the (time, input) records of a binary log written by LogWriter."""
+    records = []
+    with open(filename, 'rb') as binary_file:
+        while(True):
+            header = binary_file.read(4)
+            if(len(header) < 4):
+                break
+            count = struct.unpack('<I', header)[0]
+            times = struct.unpack('<{0}d'.format(count), binary_file.read(8 * count))
+            inputs = binary_file.read(BINARY_INPUT_BYTES * count)
+            for i in range(count):
+                value = inputs[i * BINARY_INPUT_BYTES:(i + 1) * BINARY_INPUT_BYTES]
+                records.append((times[i], value.rstrip(b'\0').decode('utf-8')))
+    return(records)
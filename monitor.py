@@ -0,0 +1,205 @@
+"""
+Live statistics on TR pulses and responses during a run, kept by the
+logging process as it logs, so the render loop does no extra work.
+
+Each update is a small JSON snapshot. It can be written to the logging
+process's terminal, or sent as a UDP datagram to a local port and shown
+in another terminal with:
+
+    python monitor.py --port 5005
+"""
+import argparse
+import collections
+import json
+import math
+import socket
+import sys
+
+DEFAULT_PORT = 5005
+
+# A gap between pulses shorter than this fraction of a TR is a doubled pulse
+DOUBLE_PULSE_FRACTION = .5
+
+# Flag the scanner as late once no pulse has come for this many TRs
+LATE_TRS = 1.5
+
+class RunStats(object):
+    """
+    Incremental statistics for one run, updated in constant time per record.
+
+    Pulses are numbered by rounding their time to whole TRs, counting the
+    trigger at time 0 as pulse 0, so missing pulses show up as gaps in the
+    numbering. A least-squares line through (pulse number, time), kept as
+    running sums, gives the measured TR; its slope relative to the nominal
+    TR is the drift between the scanner clock and the PsychoPy clock.
+    """
+    def __init__(self, tr, window=20, response_window=60.0):
+        self.tr = tr
+        self.pulses = 0
+        self.doubles = 0
+        self.missing = 0
+        self.last_pulse = None
+        self.last_number = 0
+        self.offset = 0.0
+        # Running sums for the least-squares fit, starting with the trigger
+        self._n = 1
+        self._sx = self._sy = self._sxx = self._sxy = 0.0
+        self._intervals = collections.deque(maxlen=window)
+        self.responses = 0
+        self.response_window = response_window
+        self._recent_responses = collections.deque()
+
+    def pulse(self, t):
+        previous = self.last_pulse if self.last_pulse is not None else 0.0
+        if(self.last_pulse is not None and t - previous < DOUBLE_PULSE_FRACTION * self.tr):
+            self.doubles += 1
+            return
+        number = int(math.floor(t / self.tr + .5))
+        if(number > self.last_number + 1):
+            self.missing += number - self.last_number - 1
+        self._intervals.append(t - previous)
+        self.pulses += 1
+        self.last_pulse = t
+        self.last_number = number
+        self.offset = t - number * self.tr
+        self._n += 1
+        self._sx += number
+        self._sy += t
+        self._sxx += number * number
+        self._sxy += number * t
+
+    def response(self, t):
+        self.responses += 1
+        self._recent_responses.append(t)
+
+    def measured_tr(self):
+        denominator = self._n * self._sxx - self._sx * self._sx
+        if(denominator == 0):
+            return(None)
+        return((self._n * self._sxy - self._sx * self._sy) / denominator)
+
+    def snapshot(self, now):
+        recent = self._recent_responses
+        while(recent and recent[0] < now - self.response_window):
+            recent.popleft()
+        measured_tr = self.measured_tr()
+        intervals = self._intervals
+        return({
+            'time': now,
+            'pulses': self.pulses,
+            'missing': self.missing,
+            'doubles': self.doubles,
+            'measured_tr': measured_tr,
+            'recent_tr': sum(intervals) / len(intervals) if intervals else None,
+            'drift_ppm': (measured_tr / self.tr - 1) * 1e6 if measured_tr else None,
+            'offset_ms': self.offset * 1000,
+            'since_pulse': now - self.last_pulse if self.last_pulse is not None else now,
+            'late': (now - (self.last_pulse or 0.0)) > LATE_TRS * self.tr,
+            'responses': self.responses,
+            'responses_per_min': len(recent) * 60.0 / self.response_window
+        })
+
+def format_snapshot(snapshot):
+    """One status line for a terminal."""
+    def number(value, spec):
+        return('-' if value is None else format(value, spec))
+    return("t={0:8.2f}s  TRs {1:4d}  missing {2:3d}  doubled {3:3d}  "
+           "TR {4}s (recent {5}s)  drift {6} ppm  offset {7} ms  "
+           "responses {8:4d} ({9:.0f}/min){10}".format(
+               snapshot['time'], snapshot['pulses'], snapshot['missing'],
+               snapshot['doubles'], number(snapshot['measured_tr'], '.4f'),
+               number(snapshot['recent_tr'], '.4f'), number(snapshot['drift_ppm'], '.0f'),
+               number(snapshot['offset_ms'], '.2f'), snapshot['responses'],
+               snapshot['responses_per_min'],
+               '  NO PULSE FOR {0:.1f}s'.format(snapshot['since_pulse']) if snapshot['late'] else ''
+           ))
+
+class TerminalView(object):
+    def __init__(self, stream=None):
+        self.stream = stream or sys.stdout
+
+    def show(self, snapshot):
+        self.stream.write("MONITOR " + format_snapshot(snapshot) + "\n")
+        self.stream.flush()
+
+    def close(self):
+        pass
+
+class UdpView(object):
+    """Sends each snapshot as a JSON datagram. Nothing waits for a reader."""
+    def __init__(self, port=DEFAULT_PORT, host='127.0.0.1'):
+        self.address = (host, port)
+        self.socket = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+
+    def show(self, snapshot):
+        try:
+            self.socket.sendto(json.dumps(snapshot).encode('utf-8'), self.address)
+        except socket.error:
+            pass
+
+    def close(self):
+        self.socket.close()
+
+class Monitor(object):
+    """
+    Feeds a run's input records into RunStats and shows a snapshot on each
+    view at most every `interval` seconds, when tick() is called.
+    """
+    def __init__(self, tr, sync, views, interval=.5):
+        self.stats = RunStats(tr)
+        self.sync = sync
+        self.views = views
+        self.interval = interval
+        self._next_update = 0.0
+
+    def record(self, t, char):
+        if(char == self.sync):
+            self.stats.pulse(t)
+        else:
+            self.stats.response(t)
+
+    def tick(self, now):
+        if(now >= self._next_update):
+            self.update(now)
+
+    def update(self, now):
+        snapshot = self.stats.snapshot(now)
+        for view in self.views:
+            view.show(snapshot)
+        self._next_update = now + self.interval
+
+    def close(self, now):
+        self.update(now)
+        for view in self.views:
+            view.close()
+
+def make_views(settings):
+    """Builds the views named in a dict like fmri_go.monitor_settings."""
+    views = []
+    if(settings['view'] in ('terminal', 'both')):
+        views.append(TerminalView())
+    if(settings['view'] in ('udp', 'both')):
+        views.append(UdpView(settings['port']))
+    return(views)
+
+def listen(port=DEFAULT_PORT, host='127.0.0.1'):
+    """Prints every snapshot sent to port, one line each."""
+    receiver = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+    receiver.bind((host, port))
+    print("Listening for the run monitor on {0}:{1}".format(host, port))
+    try:
+        while(True):
+            data, address = receiver.recvfrom(65536)
+            print(format_snapshot(json.loads(data.decode('utf-8'))))
+    finally:
+        receiver.close()
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description=__doc__,
+                                     formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--port', type=int, default=DEFAULT_PORT)
+    args = parser.parse_args()
+    try:
+        listen(args.port)
+    except KeyboardInterrupt:
+        pass
@@ -0,0 +1,137 @@
+"""
+Streams movie frames from a decoder thread through a small ring buffer, so
+a movie only holds decoder state and a few frames while it is on screen.
+"""
+import collections
+import threading
+
+# Frames decoded ahead of the one on screen
+DEFAULT_BUFFER_FRAMES = 30
+
+def open_decoder(path):
+    """
+    Opens path with moviepy's ffmpeg reader (the decoder MovieStim3 uses,
+    without avbin). The reader has fps, nframes, read_frame() and close().
+    """
+    from moviepy.video.io.ffmpeg_reader import FFMPEG_VideoReader
+    return(FFMPEG_VideoReader(path))
+
+def to_texture(frame):
+    """Converts 8-bit RGB pixels to the -1 to 1 floats ImageStim takes."""
+    return(frame.astype('float32') / 127.5 - 1)
+
+class FrameRing(object):
+    """
+    A bounded queue of (time, frame) between one decoding thread and the
+    render thread. put() blocks while the ring is full.
+    """
+    def __init__(self, capacity):
+        self.capacity = capacity
+        self.dropped = 0
+        self._frames = collections.deque()
+        self._condition = threading.Condition()
+        self._closed = False
+        self._done = False
+
+    def put(self, t, frame):
+        """Adds a frame. Returns False if the ring was closed meanwhile."""
+        with self._condition:
+            while(len(self._frames) >= self.capacity and not self._closed):
+                self._condition.wait()
+            if(self._closed):
+                return(False)
+            self._frames.append((t, frame))
+            return(True)
+
+    def finish(self):
+        """Called by the decoding thread after the last frame."""
+        with self._condition:
+            self._done = True
+
+    def close(self):
+        """Wakes the decoding thread and drops any buffered frames."""
+        with self._condition:
+            self._closed = True
+            self._frames.clear()
+            self._condition.notify_all()
+
+    @property
+    def finished(self):
+        """True once every frame has been decoded and taken."""
+        with self._condition:
+            return(self._done and not self._frames)
+
+    def frame_at(self, t):
+        """
+        Returns the latest frame due by time t (seconds from the start of the
+        movie), or None if no new frame is due yet. Older due frames are
+        skipped and counted as dropped rather than shown late.
+        """
+        with self._condition:
+            frame = None
+            while(self._frames and self._frames[0][0] <= t):
+                if(frame is not None):
+                    self.dropped += 1
+                frame = self._frames.popleft()[1]
+            if(frame is not None):
+                self._condition.notify_all()
+            return(frame)
+
+    def __len__(self):
+        with self._condition:
+            return(len(self._frames))
+
+class MovieStream(object):
+    """
+    Decodes the frames of a movie on a worker thread into a FrameRing of
+    buffer_frames frames. The decoder is opened by start() and closed by
+    close() (or when the last frame has been read), so a stream holds no
+    decoder state before or after its event.
+    """
+    def __init__(self, path, buffer_frames=DEFAULT_BUFFER_FRAMES, decoder=open_decoder,
+                 convert=to_texture):
+        self.path = path
+        self.ring = FrameRing(buffer_frames)
+        self._decoder = decoder
+        self._convert = convert
+        self._reader = None
+        self._thread = None
+        self._lock = threading.Lock()
+
+    def start(self):
+        self._reader = self._decoder(self.path)
+        self._thread = threading.Thread(target=self._work, args=(self._reader,))
+        self._thread.daemon = True
+        self._thread.start()
+
+    def frame_at(self, t):
+        return(self.ring.frame_at(t))
+
+    @property
+    def finished(self):
+        return(self.ring.finished)
+
+    def close(self):
+        self.ring.close()
+        if(self._thread is not None):
+            self._thread.join()
+            self._thread = None
+        self._close_reader()
+
+    def _close_reader(self):
+        with self._lock:
+            if(self._reader is not None):
+                self._reader.close()
+                self._reader = None
+
+    def _work(self, reader):
+        try:
+            for n in range(reader.nframes):
+                frame = self._convert(reader.read_frame())
+                if(not self.ring.put(n / float(reader.fps), frame)):
+                    return
+        except Exception as e:
+            print("WARNING: Stopped decoding {0}: {1}".format(self.path, e))
+        finally:
+            self.ring.finish()
+        self._close_reader()
@@ -0,0 +1,239 @@
+"""
+Reads and decodes upcoming stimulus files on background threads, so the
+render loop only has to hand ready data to PsychoPy.
+"""
+import collections
+import struct
+import threading
+import wave
+
+from timing import get_time
+
+# Read size used when warming movie files into the OS page cache
+MOVIE_CHUNK_BYTES = 4 * 1024 * 1024
+
+DecodedSound = collections.namedtuple('DecodedSound', ['samples', 'sample_rate'])
+
+# A prefetched asset that was not ready by the scheduled start of its event.
+# onset is that start and ready_at the clock time when the asset became
+# available; both are in run clock seconds. waited is how long the render
+# thread was held up in take(), 0 if the asset was late but there by then.
+Miss = collections.namedtuple('Miss', ['index', 'stim_str', 'onset', 'ready_at', 'waited'])
+
+def decode_image(path):
+    """Decodes an image file to pixels. ImageStim accepts the PIL image as is."""
+    from PIL import Image
+    image = Image.open(path)
+    image.load()
+    return(image)
+
+def extended_to_float(data):
+    """Converts the 80-bit IEEE extended float of an AIFF sample rate."""
+    exponent, mantissa = struct.unpack('>HQ', data)
+    sign = -1 if exponent & 0x8000 else 1
+    exponent &= 0x7FFF
+    if(exponent == 0 and mantissa == 0):
+        return(0.0)
+    return(sign * mantissa * 2.0 ** (exponent - 16383 - 63))
+
+def read_aiff(path):
+    """
+    Reads the PCM frames of an AIFF or uncompressed AIFF-C file. Returns
+    (channels, sample width, sample rate, frames, byte order), as the wave
+    module gives them for a WAV. The aifc module that used to do this was
+    removed in Python 3.13.
+    """
+    with open(path, 'rb') as aiff_file:
+        data = aiff_file.read()
+    if(data[:4] != b'FORM' or data[8:12] not in (b'AIFF', b'AIFC')):
+        raise ValueError("{0} is not an AIFF file".format(path))
+    byte_order = '>'
+    comm = None
+    frames = None
+    position = 12
+    while(position + 8 <= len(data)):
+        chunk_id, size = struct.unpack_from('>4sI', data, position)
+        body = data[position + 8:position + 8 + size]
+        if(chunk_id == b'COMM'):
+            channels, n_frames, bits = struct.unpack_from('>hIh', body)
+            comm = (channels, n_frames, (bits + 7) // 8, extended_to_float(body[8:18]))
+            if(data[8:12] == b'AIFC'):
+                compression = body[18:22]
+                if(compression == b'sowt'):
+                    byte_order = '<'
+                elif(compression != b'NONE'):
+                    raise ValueError("Unsupported AIFF-C compression {0!r} in {1}".format(
+                        compression, path))
+        elif(chunk_id == b'SSND'):
+            offset = struct.unpack_from('>I', body)[0]
+            frames = body[8 + offset:]
+        # Chunks are padded to an even length
+        position += 8 + size + (size & 1)
+    if(comm is None or frames is None):
+        raise ValueError("{0} has no COMM or SSND chunk".format(path))
+    channels, n_frames, width, sample_rate = comm
+    return((channels, width, int(sample_rate), frames[:n_frames * channels * width],
+            byte_order))
+
+def decode_sound(path):
+    """
+    Decodes a .wav or .aif file to floating point PCM in the range -1 to 1,
+    shaped (frames, channels).
+    """
+    import numpy
+    aiff = path.lower().endswith('.aif')
+    if(aiff):
+        channels, width, sample_rate, frames, byte_order = read_aiff(path)
+    else:
+        reader = wave.open(path, 'rb')
+        try:
+            channels = reader.getnchannels()
+            width = reader.getsampwidth()
+            sample_rate = reader.getframerate()
+            frames = reader.readframes(reader.getnframes())
+        finally:
+            reader.close()
+        byte_order = '<'
+
+    if(width == 1 and not aiff):
+        # 8-bit WAV is unsigned
+        samples = numpy.frombuffer(frames, dtype='u1').astype('float32')
+        samples = (samples - 128) / 128.0
+    elif(width == 1):
+        # 8-bit AIFF is signed
+        samples = numpy.frombuffer(frames, dtype='i1').astype('float32') / 128.0
+    elif(width in (2, 4)):
+        dtype = '{0}i{1}'.format(byte_order, width)
+        samples = numpy.frombuffer(frames, dtype=dtype).astype('float32')
+        samples /= float(2 ** (8 * width - 1))
+    else:
+        raise ValueError("Unsupported sample width {0} in {1}".format(width, path))
+    return(DecodedSound(samples.reshape(-1, channels), sample_rate))
+
+def warm_movie(path):
+    """
+    MovieStim3 opens movies by filename, so the best we can do ahead of time
+    is read the file once to get it into the OS page cache.
+    """
+    with open(path, 'rb') as movie_file:
+        while(movie_file.read(MOVIE_CHUNK_BYTES)):
+            pass
+    return(path)
+
+DECODERS = {
+    'image': decode_image,
+    'sound': decode_sound,
+    'movie': warm_movie
+}
+
+class Prefetcher(object):
+    """
+    Decodes the file stimuli of a timeline ahead of time on a pool of worker
+    threads. At most `depth` decoded assets are held at once; a slot is freed
+    each time the render thread take()s one. Only the first use of each
+    stimulus is prefetched, since later uses come from the StimulusCache.
+    Only the kinds of stimulus in `kinds` are prefetched.
+    """
+    def __init__(self, entries, clock, depth=8, workers=2, kinds=None):
+        if(kinds is None):
+            kinds = DECODERS.keys()
+        self.clock = clock
+        self.depth = depth
+        self.misses = []
+        # Times take() had to wait for an asset that was still ready before
+        # its onset. These cost the render thread time, but no frames.
+        self.waits = 0
+        self._entries = entries
+        self._wanted = collections.deque()
+        seen = set()
+        for index, entry in enumerate(entries):
+            if(entry.kind in kinds and entry.key() not in seen):
+                seen.add(entry.key())
+                self._wanted.append(index)
+        self._pending = set(self._wanted)
+        self._ready = {}
+        self._ready_at = {}
+        self._condition = threading.Condition()
+        self._slots = threading.Semaphore(depth)
+        self._stopped = False
+        self._threads = [
+            threading.Thread(target=self._work) for i in range(workers)
+        ]
+        for thread in self._threads:
+            thread.daemon = True
+
+    def start(self):
+        for thread in self._threads:
+            thread.start()
+
+    def stop(self):
+        with self._condition:
+            self._stopped = True
+            self._condition.notify_all()
+        # Wake workers waiting on a slot so they can exit
+        for thread in self._threads:
+            self._slots.release()
+
+    def wants(self, index):
+        return(index in self._pending)
+
+    def take(self, index, onset=None):
+        """
+        Returns the decoded asset for the event at index, waiting for it if it
+        isn't ready yet. Returns None if the worker failed to decode it, so
+        the caller can load it the slow way.
+
+        Every asset that became ready after its event's onset (the run
+        clock time it is shown at, by default its script time) is a Miss,
+        whether or not take() had to wait for it. Events are built a few
+        events ahead, so a wait that ends before the onset is not a Miss.
+        """
+        entry = self._entries[index]
+        if(onset is None):
+            onset = entry.start_us / 1e6
+        with self._condition:
+            waited = 0.0
+            if(index not in self._ready):
+                waited_from = get_time()
+                while(index not in self._ready and not self._stopped):
+                    self._condition.wait()
+                waited = get_time() - waited_from
+            ready_at = self._ready_at.pop(index, None)
+            if(ready_at is None):
+                # Stopped before the worker got to it
+                ready_at = self.clock.getTime()
+            if(ready_at > onset):
+                self.misses.append(Miss(index, entry.stim_str, onset, ready_at, waited))
+            elif(waited):
+                self.waits += 1
+            asset = self._ready.pop(index, None)
+            self._pending.discard(index)
+        self._slots.release()
+        return(asset)
+
+    def report(self):
+        """Prints a summary of any prefetch misses."""
+        for miss in self.misses:
+            print("PREFETCH MISS: {0} (event {1}) waited {2:.4f}s, ready {3:.4f}s after onset".format(
+                miss.stim_str, miss.index, miss.waited, miss.ready_at - miss.onset
+            ))
+        if(self.waits):
+            print("Prefetch: waited for {0} assets that were still ready in time".format(self.waits))
+
+    def _work(self):
+        while(True):
+            self._slots.acquire()
+            with self._condition:
+                if(self._stopped or not self._wanted):
+                    return
+                index = self._wanted.popleft()
+            entry = self._entries[index]
+            try:
+                asset = DECODERS[entry.kind](entry.stim_str)
+            except Exception as e:
+                print("WARNING: Could not prefetch {0}: {1}".format(entry.stim_str, e))
+                asset = None
+            with self._condition:
+                self._ready[index] = asset
+                self._ready_at[index] = self.clock.getTime()
+                self._condition.notify_all()
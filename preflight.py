@@ -0,0 +1,277 @@
+"""
+Checks a study before it goes to the scanner. Every script is parsed, then
+every image, sound and movie it uses is opened and decoded on a pool of
+worker processes, and checked against the script lines that use it:
+
+    - the file exists and decodes
+    - sounds and movies last at least as long as their scripted duration
+      (longer ones are cut off, which is fine)
+    - movies shown with sound have an audio track
+    - images fit in the window
+
+What is learned about each file is cached by its SHA-1, and the SHA-1 by
+path, size and mtime, so checking a large media library again only opens
+the files that changed. The cache is kept in the study directory, like
+the compiled run plans:
+
+    python preflight.py collective_thought/ --window 1280x1024
+"""
+import argparse
+import collections
+import json
+import multiprocessing
+import os
+import sys
+
+from prefetch import decode_sound
+from run_plan import find_scripts, hash_file
+from timeline import Timeline, from_us
+
+# Bump this whenever the probes change what they find
+CACHE_VERSION = 1
+
+# Name of the probe cache, in the first directory checked
+CACHE_FILENAME = 'preflight_cache.json'
+
+# At DBIC, the scanner projector likes 1280x1024
+DEFAULT_WINDOW = (1280, 1024)
+
+# Media this much shorter than scripted are still fine
+DURATION_TOLERANCE = .05
+
+# One line of the report. level is 'FAIL' or 'WARN'.
+Problem = collections.namedtuple('Problem', ['level', 'path', 'message'])
+
+Report = collections.namedtuple(
+    'Report', ['scripts', 'files', 'hashed', 'probed', 'problems']
+)
+
+def probe_image(path):
+    from PIL import Image
+    image = Image.open(path)
+    image.load()
+    return({'width': image.size[0], 'height': image.size[1]})
+
+def probe_sound(path):
+    decoded = decode_sound(path)
+    return({'duration': len(decoded.samples) / float(decoded.sample_rate),
+            'channels': decoded.samples.shape[1]})
+
+def probe_movie(path):
+    """
+    Reads the stream info with moviepy's ffmpeg parser (as MovieStim3 does),
+    then decodes the first frame to be sure the video codec is usable.
+    """
+    from moviepy.video.io.ffmpeg_reader import FFMPEG_VideoReader, ffmpeg_parse_infos
+    infos = ffmpeg_parse_infos(path)
+    reader = FFMPEG_VideoReader(path)
+    try:
+        reader.read_frame()
+    finally:
+        reader.close()
+    return({'duration': infos['duration'],
+            'width': infos['video_size'][0], 'height': infos['video_size'][1],
+            'has_audio': bool(infos.get('audio_found'))})
+
+PROBES = {
+    'image': probe_image,
+    'sound': probe_sound,
+    'movie': probe_movie
+}
+
+def _hash_task(path):
+    try:
+        return((path, hash_file(path), None))
+    except IOError as e:
+        return((path, None, str(e)))
+
+def _probe_task(task):
+    kind, path = task
+    try:
+        return((task, PROBES[kind](path)))
+    except Exception as e:
+        # Decoders fail in all sorts of ways on bad files
+        return((task, {'error': '{0}: {1}'.format(e.__class__.__name__, e)}))
+
+class ProbeCache(object):
+    """
+    files maps a path to its [size, mtime, sha1], and results maps
+    'kind:sha1' to what the probe found, so a file that was only touched or
+    moved is not opened again.
+    """
+    def __init__(self, path=None):
+        self.path = path
+        self.files = {}
+        self.results = {}
+        if(path and os.path.exists(path)):
+            try:
+                with open(path) as cache_file:
+                    data = json.load(cache_file)
+                if(data.get('version') == CACHE_VERSION):
+                    self.files = data['files']
+                    self.results = data['results']
+            except (ValueError, KeyError, IOError) as e:
+                print("WARNING: Ignoring unreadable cache {0}: {1}".format(path, e))
+
+    def known_hash(self, path, stat):
+        entry = self.files.get(path)
+        if(entry and entry[0] == stat.st_size and entry[1] == stat.st_mtime):
+            return(entry[2])
+        return(None)
+
+    def save(self):
+        if(not self.path):
+            return
+        temporary_path = self.path + '.tmp'
+        with open(temporary_path, 'w') as cache_file:
+            json.dump({'version': CACHE_VERSION, 'files': self.files,
+                       'results': self.results}, cache_file)
+        os.rename(temporary_path, self.path)
+
+def cache_path_for(paths):
+    """The default probe cache: in the first study directory in paths."""
+    first = paths[0]
+    if(not os.path.isdir(first)):
+        first = os.path.dirname(first)
+    return(os.path.join(first, CACHE_FILENAME))
+
+def collect_uses(scripts):
+    """
+    Parses each script and returns (uses, problems): uses maps each
+    (kind, path) to the (script, entry) pairs that show it.
+    """
+    uses = collections.OrderedDict()
+    problems = []
+    for script_path in scripts:
+        timeline = Timeline()
+        try:
+            timeline.read_from_file(script_path)
+        except (ValueError, IOError) as e:
+            problems.append(Problem('FAIL', script_path, str(e)))
+            continue
+        for overlap in timeline.has_overlapping_events():
+            problems.append(Problem('WARN', script_path, "{0} at {1}s starts before {2} at {3}s ends".format(
+                overlap.second.stim_str, overlap.second.start,
+                overlap.first.stim_str, overlap.first.start
+            )))
+        for entry in timeline.events:
+            if(entry.kind != 'text'):
+                uses.setdefault((entry.kind, entry.stim_str), []).append((script_path, entry))
+    return(uses, problems)
+
+def check_use(kind, path, info, script_path, entry, window):
+    """Problems with showing a file, as probed, for one script line."""
+    where = "{0} (at {1}s in {2})".format(path, entry.start, script_path)
+    problems = []
+    scripted = float(from_us(entry.dur_us))
+    if(kind in ('sound', 'movie') and info['duration'] < scripted - DURATION_TOLERANCE):
+        problems.append(Problem('WARN', where, "lasts {0:.2f}s but is scripted for {1:.2f}s".format(
+            info['duration'], scripted
+        )))
+    if(kind == 'movie' and not entry.no_audio and not info['has_audio']):
+        problems.append(Problem('FAIL', where, "has no audio track; add noAudio to the script line"))
+    if(kind == 'image' and (info['width'] > window[0] or info['height'] > window[1])):
+        problems.append(Problem('WARN', where, "is {0}x{1}, larger than the {2}x{3} window".format(
+            info['width'], info['height'], window[0], window[1]
+        )))
+    return(problems)
+
+def preflight(paths, window=DEFAULT_WINDOW, jobs=None, cache_path=None,
+              pattern='*.txt'):
+    """
+    Checks every script in paths and every file they use, hashing and
+    probing files on jobs processes (all cores by default). Returns a
+    Report; hashed and probed count the files that weren't in the cache.
+    The cache is at cache_path, by default cache_path_for(paths); '' keeps
+    no cache.
+    """
+    if(cache_path is None):
+        cache_path = cache_path_for(paths)
+    scripts = find_scripts(paths, pattern)
+    uses, problems = collect_uses(scripts)
+    cache = ProbeCache(cache_path)
+
+    # Find the hash of every file, hashing only those that changed
+    hashes = {}
+    to_hash = []
+    stats = {}
+    for kind, path in uses:
+        if(path in stats):
+            continue
+        try:
+            stats[path] = os.stat(path)
+        except OSError:
+            stats[path] = None
+            continue
+        sha1 = cache.known_hash(path, stats[path])
+        if(sha1):
+            hashes[path] = sha1
+        else:
+            to_hash.append(path)
+
+    pool = multiprocessing.Pool(jobs)
+    try:
+        for path, sha1, error in pool.imap_unordered(_hash_task, to_hash):
+            if(error):
+                stats[path] = None
+                continue
+            hashes[path] = sha1
+            cache.files[path] = [stats[path].st_size, stats[path].st_mtime, sha1]
+
+        # Then probe the files whose contents haven't been probed before
+        to_probe = sorted(set(
+            (kind, path) for kind, path in uses
+            if path in hashes and '{0}:{1}'.format(kind, hashes[path]) not in cache.results
+        ))
+        for (kind, path), info in pool.imap_unordered(_probe_task, to_probe):
+            cache.results['{0}:{1}'.format(kind, hashes[path])] = info
+    finally:
+        pool.close()
+        pool.join()
+    cache.save()
+
+    for (kind, path), script_uses in uses.items():
+        if(path not in hashes):
+            problems.append(Problem('FAIL', path, "is missing or unreadable (used by {0})".format(
+                ', '.join(sorted(set(script for script, entry in script_uses)))
+            )))
+            continue
+        info = cache.results['{0}:{1}'.format(kind, hashes[path])]
+        if('error' in info):
+            problems.append(Problem('FAIL', path, "can't be decoded as {0}: {1}".format(
+                kind, info['error']
+            )))
+            continue
+        for script_path, entry in script_uses:
+            problems += check_use(kind, path, info, script_path, entry, window)
+
+    return(Report(len(scripts), len(stats), len(to_hash), len(to_probe), problems))
+
+def parse_window(text):
+    width, height = text.lower().split('x')
+    return((int(width), int(height)))
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description=__doc__,
+                                     formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('paths', nargs='+', help="scripts or study directories")
+    parser.add_argument('--pattern', default='*.txt',
+                        help="filename pattern of scripts in directories")
+    parser.add_argument('--window', type=parse_window, default=DEFAULT_WINDOW,
+                        help="window size as WIDTHxHEIGHT")
+    parser.add_argument('--jobs', type=int, default=None,
+                        help="worker processes (default: one per core)")
+    parser.add_argument('--cache', default=None,
+                        help="probe cache file (default: {0} in the first "
+                             "directory; '' for none)".format(CACHE_FILENAME))
+    args = parser.parse_args()
+    report = preflight(args.paths, args.window, args.jobs, args.cache, args.pattern)
+    for problem in report.problems:
+        print("{0} {1} {2}".format(problem.level, problem.path, problem.message))
+    print("Checked {0} scripts and {1} files ({2} hashed, {3} probed); "
+          "{4} failures, {5} warnings".format(
+              report.scripts, report.files, report.hashed, report.probed,
+              sum(1 for p in report.problems if p.level == 'FAIL'),
+              sum(1 for p in report.problems if p.level == 'WARN')
+          ))
+    sys.exit(1 if any(p.level == 'FAIL' for p in report.problems) else 0)
@@ -0,0 +1,114 @@
+"""
+Keeps stimulus deadlines locked to the scanner's clock by fitting every TR
+pulse, not just the first, instead of trusting the local clock for the
+whole run.
+"""
+import collections
+import math
+
+# One line of the resync log. pulse_time is when the pulse arrived on the
+# run clock; offset and skew are the fit after it, and correction is how far
+# the deadline at that pulse's scanner time was moved from the nominal one.
+Correction = collections.namedtuple(
+    'Correction', ['number', 'pulse_time', 'offset', 'skew', 'correction', 'outlier']
+)
+
+# Scale from the median absolute deviation to a Gaussian standard deviation
+MAD_TO_SD = 1.4826
+
+def fit_line(points):
+    """Least-squares (offset, skew) of local time against scanner time."""
+    n = len(points)
+    sx = sum(x for x, y in points)
+    sy = sum(y for x, y in points)
+    sxx = sum(x * x for x, y in points)
+    sxy = sum(x * y for x, y in points)
+    denominator = n * sxx - sx * sx
+    if(denominator == 0):
+        # A single point only fixes the offset
+        return((sy / n - sx / n, 1.0))
+    skew = (n * sxy - sx * sy) / denominator
+    return(((sy - skew * sx) / n, skew))
+
+def robust_fit(points, min_threshold):
+    """
+    Fits a line, drops the points more than 3 robust standard deviations
+    (and at least min_threshold seconds) away from it, and fits again.
+    """
+    offset, skew = fit_line(points)
+    if(len(points) < 4):
+        return((offset, skew))
+    residuals = [abs(y - (offset + skew * x)) for x, y in points]
+    mad = sorted(residuals)[len(residuals) // 2]
+    threshold = max(3 * MAD_TO_SD * mad, min_threshold)
+    kept = [point for point, residual in zip(points, residuals) if residual <= threshold]
+    if(len(kept) < len(points) and len(kept) >= 2):
+        offset, skew = fit_line(kept)
+    return((offset, skew))
+
+class ResyncEngine(object):
+    """
+    Maps scanner time (script time, counted from the trigger) to the run
+    clock, local = offset + skew * scanner. Every TR pulse is numbered by
+    where the current fit predicts it, and (number * TR, arrival time) is
+    added to a window of the last `window` pulses, starting with the trigger
+    at (0, 0). The line is refitted robustly after each pulse.
+
+    A pulse further than outlier_threshold seconds from the prediction is
+    logged but left out of the fit, unless `max_outliers` arrive in a row,
+    which means the clocks really did jump; the window then restarts from
+    those pulses.
+    """
+    def __init__(self, tr, window=64, outlier_threshold=.004, max_outliers=3):
+        self.tr = tr
+        self.outlier_threshold = outlier_threshold
+        self.max_outliers = max_outliers
+        self.points = collections.deque([(0.0, 0.0)], maxlen=window)
+        self.offset = 0.0
+        self.skew = 1.0
+        self.last_number = 0
+        self.corrections = []
+        self._outliers = []
+
+    def to_local(self, scanner_time):
+        """The run clock time at which the scanner reaches scanner_time."""
+        return(self.offset + self.skew * scanner_time)
+
+    def pulse(self, t):
+        """
+        Adds a TR pulse that arrived at run clock time t. Returns its
+        Correction, or None for a doubled pulse.
+        """
+        number = int(math.floor((t - self.offset) / self.skew / self.tr + .5))
+        if(number <= self.last_number):
+            return(None)
+        self.last_number = number
+        scanner_time = number * self.tr
+        outlier = abs(t - self.to_local(scanner_time)) > self.outlier_threshold
+        if(outlier):
+            self._outliers.append((scanner_time, t))
+            if(len(self._outliers) >= self.max_outliers):
+                self.points.clear()
+                self.points.extend(self._outliers)
+                self._outliers = []
+                self.refit()
+        else:
+            self._outliers = []
+            self.points.append((scanner_time, t))
+            self.refit()
+        correction = Correction(number, t, self.offset, self.skew,
+                                self.to_local(scanner_time) - scanner_time, outlier)
+        self.corrections.append(correction)
+        return(correction)
+
+    def refit(self):
+        self.offset, self.skew = robust_fit(list(self.points), self.outlier_threshold)
+
+    def write_log(self, filename):
+        with open(filename, 'w') as log:
+            log.write("tr,pulse_time,offset_ms,skew_ppm,correction_ms,outlier\n")
+            for c in self.corrections:
+                log.write("{0},{1:.6f},{2:.3f},{3:.1f},{4:.3f},{5}\n".format(
+                    c.number, c.pulse_time, c.offset * 1000, (c.skew - 1) * 1e6,
+                    c.correction * 1000, int(c.outlier)
+                ))
@@ -0,0 +1,246 @@
+"""
+Compiles experiment scripts into run plans: the parsed, null-filled and
+checked timeline stored as numpy arrays, cached next to the script. Loading
+a current plan skips parsing entirely.
+
+Run as a script to precompile and validate every script in a study:
+
+    python run_plan.py collective_thought/
+"""
+import argparse
+import fnmatch
+import hashlib
+import json
+import os
+import sys
+
+import numpy
+
+from timeline import Timeline, TimelineEvent, Overlap, from_us
+
+# Bump this whenever the plan file layout changes
+PLAN_VERSION = 1
+
+KINDS = ['text', 'image', 'sound', 'movie']
+
+EVENT_DTYPE = numpy.dtype([
+    ('start_us', '<i8'),
+    ('dur_us', '<i8'),
+    ('kind', 'u1'),
+    ('asset', '<i4')
+])
+
+# Log files and run reports (flip timing, frame-locked schedules, scanner
+# resync) live next to scripts and are also .txt, so they are skipped when
+# looking for scripts in a study directory.
+LOG_PATTERNS = ['*_log.txt', '*_timing.txt', '*_frames.txt', '*_resync.txt']
+
+def plan_path_for(script_path):
+    return(script_path + '.plan.npz')
+
+def hash_file(path):
+    digest = hashlib.sha1()
+    with open(path, 'rb') as f:
+        for block in iter(lambda: f.read(1024 * 1024), b''):
+            digest.update(block)
+    return(digest.hexdigest())
+
+def asset_mtime(kind, stim_str):
+    """The mtime of a file stimulus, 0 for text and -1 if the file is missing."""
+    if(kind == 'text'):
+        return(0)
+    try:
+        return(os.stat(stim_str).st_mtime)
+    except OSError:
+        return(-1)
+
+def as_text_array(value):
+    """Stores JSON-able data in an .npz without needing pickle to load it."""
+    return(numpy.frombuffer(json.dumps(value).encode('utf-8'), dtype='u1'))
+
+def from_text_array(array):
+    return(json.loads(array.tobytes().decode('utf-8')))
+
+class RunPlan(object):
+    """
+    A compiled script. events is a structured array (EVENT_DTYPE) with one
+    row per event, nulls included, and assets is the table of distinct
+    stimuli the rows point into, as (kind, stim_str, color, no_audio) keys.
+    """
+    def __init__(self, events, assets, asset_mtimes, null_event, overlaps,
+                 script_hash):
+        self.events = events
+        self.assets = assets
+        self.asset_mtimes = asset_mtimes
+        self.null_event = null_event
+        self.overlaps = overlaps
+        self.script_hash = script_hash
+
+    def missing_assets(self):
+        return([asset[1] for asset, mtime in zip(self.assets, self.asset_mtimes)
+                if mtime == -1])
+
+    def is_current(self, script_hash):
+        """True if the plan was compiled from this script and these assets."""
+        if(script_hash != self.script_hash):
+            return(False)
+        for (kind, stim_str, color, no_audio), mtime in zip(self.assets, self.asset_mtimes):
+            if(asset_mtime(kind, stim_str) != mtime):
+                return(False)
+        return(True)
+
+    def fill(self, timeline):
+        """
+        Fills a Timeline (or EventList) with the plan's events, as if the
+        script had been read and create_null_events() called.
+        """
+        entries = [
+            TimelineEvent(start_us, dur_us, kind, stim_str, color, no_audio)
+            for start_us, dur_us, (kind, stim_str, color, no_audio) in zip(
+                self.events['start_us'].tolist(),
+                self.events['dur_us'].tolist(),
+                [self.assets[asset] for asset in self.events['asset'].tolist()]
+            )
+        ]
+        timeline.events = entries
+        timeline.null_event = self.null_event
+        timeline.overlaps = [Overlap(entries[i], entries[j]) for i, j in self.overlaps]
+        timeline.total_dur_us = timeline.dur_us()
+        return(timeline)
+
+    def save(self, path):
+        # Write to a temporary file first, so a crash can't leave a broken plan
+        temporary_path = path + '.tmp.npz'
+        numpy.savez(
+            temporary_path,
+            version=numpy.array(PLAN_VERSION),
+            events=self.events,
+            asset_mtimes=numpy.array(self.asset_mtimes, dtype='<f8'),
+            overlaps=numpy.array(self.overlaps, dtype='<i4').reshape(-1, 2),
+            meta=as_text_array({
+                'assets': self.assets,
+                'null_event': self.null_event,
+                'script_hash': self.script_hash
+            })
+        )
+        try:
+            os.rename(temporary_path, path)
+        except OSError:
+            os.remove(temporary_path)
+            raise
+
+    @classmethod
+    def load(cls, path):
+        with numpy.load(path) as data:
+            if(int(data['version']) != PLAN_VERSION):
+                raise ValueError("{0} is from another plan version".format(path))
+            meta = from_text_array(data['meta'])
+            return(cls(
+                data['events'],
+                [tuple(asset) for asset in meta['assets']],
+                data['asset_mtimes'].tolist(),
+                meta['null_event'],
+                [tuple(pair) for pair in data['overlaps'].tolist()],
+                meta['script_hash']
+            ))
+
+def compile_script(script_path):
+    """Parses, null-fills and checks a script, and returns its RunPlan."""
+    script_hash = hash_file(script_path)
+    timeline = Timeline()
+    timeline.read_from_file(script_path)
+    timeline.create_null_events()
+
+    asset_index = {}
+    assets = []
+    events = numpy.zeros(len(timeline.events), dtype=EVENT_DTYPE)
+    event_index = {}
+    for i, entry in enumerate(timeline.events):
+        key = entry.key()
+        if(key not in asset_index):
+            asset_index[key] = len(assets)
+            assets.append(key)
+        events[i] = (entry.start_us, entry.dur_us,
+                     KINDS.index(entry.kind), asset_index[key])
+        event_index[id(entry)] = i
+
+    overlaps = [(event_index[id(overlap.first)], event_index[id(overlap.second)])
+                for overlap in timeline.overlaps]
+    asset_mtimes = [asset_mtime(kind, stim_str) for kind, stim_str, color, no_audio in assets]
+    return(RunPlan(events, assets, asset_mtimes, timeline.null_event, overlaps,
+                   script_hash))
+
+def load_plan(script_path):
+    """
+    Returns the RunPlan for a script, from the cached plan file if it is
+    still current, otherwise compiling it and updating the cache. The cache
+    is only an optimization: a plan file that can't be read is compiled
+    again, and one that can't be written is skipped.
+    """
+    path = plan_path_for(script_path)
+    if(os.path.exists(path)):
+        try:
+            plan = RunPlan.load(path)
+            if(plan.is_current(hash_file(script_path))):
+                return(plan)
+        except Exception as e:
+            # A truncated or corrupt npz fails in all sorts of ways
+            # (BadZipFile, EOFError, ...)
+            print("WARNING: Ignoring unreadable plan {0}: {1}: {2}".format(
+                path, e.__class__.__name__, e))
+    plan = compile_script(script_path)
+    try:
+        plan.save(path)
+    except (IOError, OSError) as e:
+        print("WARNING: Can't cache plan {0}: {1}".format(path, e))
+    return(plan)
+
+def find_scripts(paths, pattern='*.txt'):
+    """Expands directories in paths into the scripts inside them."""
+    scripts = []
+    for path in paths:
+        if(os.path.isdir(path)):
+            for directory, subdirectories, filenames in os.walk(path):
+                for filename in sorted(fnmatch.filter(filenames, pattern)):
+                    if(not any(fnmatch.fnmatch(filename, log) for log in LOG_PATTERNS)):
+                        scripts.append(os.path.join(directory, filename))
+        else:
+            scripts.append(path)
+    return(scripts)
+
+def precompile(paths, pattern='*.txt'):
+    """
+    Compiles and caches the plan of every script in paths, printing a line
+    per script. Returns the number of scripts with problems.
+    """
+    problems = 0
+    for script_path in find_scripts(paths, pattern):
+        try:
+            plan = compile_script(script_path)
+        except (ValueError, IOError) as e:
+            print("FAIL {0}: {1}".format(script_path, e))
+            problems += 1
+            continue
+        plan.save(plan_path_for(script_path))
+        missing = plan.missing_assets()
+        status = 'OK  '
+        if(missing or plan.overlaps):
+            status = 'FAIL'
+            problems += 1
+        end_us = int((plan.events['start_us'] + plan.events['dur_us']).max()) if len(plan.events) else 0
+        print("{0} {1}: {2} events, {3} assets, {4}s, {5} overlaps, {6} missing".format(
+            status, script_path, len(plan.events), len(plan.assets),
+            from_us(end_us), len(plan.overlaps), len(missing)
+        ))
+        for stim_str in missing:
+            print("    missing: {0}".format(stim_str))
+    return(problems)
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description=__doc__,
+                                     formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('paths', nargs='+', help="scripts or study directories")
+    parser.add_argument('--pattern', default='*.txt',
+                        help="filename pattern of scripts in directories")
+    args = parser.parse_args()
+    sys.exit(1 if precompile(args.paths, args.pattern) else 0)
@@ -0,0 +1,157 @@
+"""
+A software stand-in for the scanner and the button box. Sync pulses and
+button presses are written to a pty, so the usb-serial-simulation path can
+read them like the Lumina box on any Linux or Mac machine, without Keyspan
+adapters.
+
+Run as a script to check how accurately pulses are emitted on this machine:
+
+    python scanner_emulator.py --tr 0.5 --pulses 40
+"""
+import argparse
+import os
+import random
+import threading
+import time
+import tty
+
+from timing import get_time
+
+# How long before a scheduled write we stop sleeping and start spinning
+SPIN = .002
+
+# Gap between the two pulses of a doubled pulse
+DOUBLE_PULSE_GAP = .005
+
+def open_pty():
+    """
+    Opens a pty pair and returns (master_fd, slave_fd, slave_path). The
+    emulator writes to master_fd; slave_path can be opened with
+    serial.Serial(). Keep slave_fd open until the run is over, or the pty
+    may go away before the reader opens it.
+    """
+    master_fd, slave_fd = os.openpty()
+    tty.setraw(slave_fd)
+    return((master_fd, slave_fd, os.ttyname(slave_fd)))
+
+def sync_pulse_schedule(n_pulses, tr, sync='5', jitter=0.0, max_jitter=None,
+                        drop_prob=0.0, double_prob=0.0, drift=0.0, rng=random):
+    """
+    Returns [(time, char), ...] for n_pulses sync pulses, relative to the
+    first pulse. Pulse n is due at n * TR * (1 + drift), independent of when
+    earlier pulses actually went out, so errors don't accumulate. jitter is
+    the standard deviation of Gaussian timing noise, clipped to +/-
+    max_jitter (3 * jitter by default). Pulses are dropped with probability
+    drop_prob and sent twice with probability double_prob.
+    """
+    if(max_jitter is None):
+        max_jitter = 3 * jitter
+    schedule = []
+    for n in range(n_pulses):
+        if(rng.random() < drop_prob):
+            continue
+        t = n * tr * (1 + drift)
+        if(jitter > 0):
+            t += max(-max_jitter, min(max_jitter, rng.gauss(0, jitter)))
+        schedule.append((max(t, 0), sync))
+        if(rng.random() < double_prob):
+            schedule.append((max(t, 0) + DOUBLE_PULSE_GAP, sync))
+    return(schedule)
+
+def response_schedule(onsets, keys=('1', '2', '3', '4'), response_prob=.8,
+                      rt_mu=.5, rt_sigma=.1, rt_tau=.2, rng=random):
+    """
+    Returns [(time, key), ...] of simulated button presses. The participant
+    responds to each stimulus onset with probability response_prob, after an
+    ex-Gaussian reaction time (Gaussian mu/sigma plus an exponential tail
+    with mean tau), which is the usual shape of human RT distributions.
+    """
+    schedule = []
+    for onset in onsets:
+        if(rng.random() >= response_prob):
+            continue
+        rt = rng.gauss(rt_mu, rt_sigma)
+        if(rt_tau > 0):
+            rt += rng.expovariate(1.0 / rt_tau)
+        schedule.append((float(onset) + max(rt, .1), rng.choice(keys)))
+    return(schedule)
+
+def emit(fd, schedule, t0, stop=None):
+    """
+    Writes each (time, char) of schedule to fd at t0 + time on the get_time()
+    clock. Sleeps until shortly before each write and spins for the rest, so
+    every write is within a fraction of a millisecond of its schedule.
+    Returns the times (relative to t0) that each write actually happened.
+    """
+    emitted = []
+    for t, char in sorted(schedule):
+        target = t0 + t
+        while(True):
+            if(stop is not None and stop.is_set()):
+                return(emitted)
+            remaining = target - get_time()
+            if(remaining <= SPIN):
+                break
+            time.sleep(min(remaining - SPIN, .1))
+        while(get_time() < target):
+            pass
+        os.write(fd, char.encode('latin-1'))
+        emitted.append(get_time() - t0)
+    return(emitted)
+
+def run_emulator(fd, settings, n_pulses, onsets=(), stop=None):
+    """
+    Emits n_pulses sync pulses and simulated responses to the stimulus
+    onsets to fd, with the first pulse right away, stopping early if stop
+    is set. settings is a dict like fmri_go.emulator_settings.
+    """
+    rng = random.Random(settings.get('seed'))
+    schedule = sync_pulse_schedule(
+        n_pulses, settings['TR'], settings['sync'],
+        jitter=settings['jitter'], max_jitter=settings['max_jitter'],
+        drop_prob=settings['drop_prob'], double_prob=settings['double_prob'],
+        drift=settings['drift'], rng=rng
+    )
+    schedule += response_schedule(
+        onsets, settings['keys'], settings['response_prob'],
+        settings['rt_mu'], settings['rt_sigma'], settings['rt_tau'], rng=rng
+    )
+    emit(fd, schedule, get_time(), stop)
+
+def self_check(tr, n_pulses):
+    """
+    Emits n_pulses through a pty, reads them back on the other side and
+    returns (mean, max, drift) timing error in seconds. drift is the error of
+    the last pulse minus that of the first, which should stay near zero no
+    matter how many pulses are sent.
+    """
+    from serial_input import SerialReader
+
+    master_fd, slave_fd, slave_path = open_pty()
+    schedule = sync_pulse_schedule(n_pulses, tr)
+    try:
+        t0 = get_time()
+        writer = threading.Thread(target=emit, args=(master_fd, schedule, t0))
+        writer.start()
+        reader = SerialReader(slave_fd, t0)
+        received = []
+        while(len(received) < n_pulses):
+            received += [t for t, char in reader.read(timeout=tr + 1)]
+        writer.join()
+    finally:
+        os.close(master_fd)
+        os.close(slave_fd)
+    errors = [actual - scheduled for actual, (scheduled, char) in zip(received, schedule)]
+    return((sum(errors) / len(errors), max(errors), errors[-1] - errors[0]))
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description=__doc__,
+                                     formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--tr', type=float, default=.5)
+    parser.add_argument('--pulses', type=int, default=40)
+    args = parser.parse_args()
+    mean_error, max_error, drift = self_check(args.tr, args.pulses)
+    print("{0} pulses at TR {1}s".format(args.pulses, args.tr))
+    print("mean error: {0:.3f} ms".format(mean_error * 1000))
+    print("max error:  {0:.3f} ms".format(max_error * 1000))
+    print("drift:      {0:.3f} ms".format(drift * 1000))
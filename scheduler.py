@@ -0,0 +1,163 @@
+"""
+Frame-locked scheduling. Every event is given a whole number of display
+refreshes up front, and presentation is driven by counting flips instead of
+reading the clock after each one, so each onset lands on a predictable frame.
+"""
+import collections
+import math
+
+# A flip more than this many frame periods away from the frame it was
+# counted as means frames were dropped (or the refresh rate was measured
+# wrongly), and the frame count is corrected from the clock. Flips land on
+# vsyncs, so a real drop is off by about a whole frame; the margin over half
+# a frame keeps a drift near .5 from being corrected back and forth by
+# ordinary flip jitter.
+CORRECTION_THRESHOLD = .75
+
+# The planned frames of one event. Event i is shown on frames
+# [onset_frame, end_frame), counting the refresh at the trigger as frame 0.
+FrameBudget = collections.namedtuple(
+    'FrameBudget', ['index', 'stim_str', 'start_us', 'dur_us', 'onset_frame', 'end_frame']
+)
+
+def measure_frame_rate(win, nominal=60.0):
+    """
+    Measures the refresh rate of win, falling back to nominal if PsychoPy
+    can't get a stable measurement.
+    """
+    frame_rate = win.getActualFrameRate(nIdentical=20, nMaxFrames=240,
+                                        nWarmUpFrames=20, threshold=1)
+    if(frame_rate is None):
+        print("WARNING: Couldn't measure the refresh rate, assuming {0} Hz".format(nominal))
+        return(nominal)
+    return(frame_rate)
+
+def to_frames(us, frame_rate):
+    """The nearest whole frame to a time in integer microseconds."""
+    # floor(x + .5) rounds halves the same way on Python 2 and 3
+    return(int(math.floor(us * frame_rate / 1e6 + .5)))
+
+def frame_budgets(entries, frame_rate):
+    """
+    Returns a FrameBudget for each TimelineEvent. Onsets follow the running
+    sum of durations, as in the non-slip loop, and each end is rounded to
+    the nearest frame separately, so rounding never accumulates over a run.
+    """
+    budgets = []
+    end_us = 0
+    end_frame = 0
+    for index, entry in enumerate(entries):
+        onset_frame = end_frame
+        start_us = end_us
+        end_us += entry.dur_us
+        end_frame = to_frames(end_us, frame_rate)
+        budgets.append(FrameBudget(index, entry.stim_str, start_us, entry.dur_us,
+                                   onset_frame, end_frame))
+    return(budgets)
+
+class FrameClock(object):
+    """
+    A stand-in for the run clock whose getTime() is the planned time of the
+    next flip, frame * frame period. Loops of the form
+    `while clock.getTime() < end_time: draw; flip` then show exactly the
+    frames up to end_time = begin(index), however late each flip returns.
+
+    After every flip (see attach), the real flip time on the run clock is
+    compared with the frame it was counted as. Only if it is off by more
+    than CORRECTION_THRESHOLD frames, i.e. frames were dropped, is the frame
+    count reset from the clock, and the correction noted against the event.
+
+    Frames are numbered from the trigger, run clock time 0, so whole frames
+    lost before the first flip (waiting for the trigger, building the first
+    stimuli) are corrected like any other dropped frames rather than
+    delaying the whole run. The trigger is not synchronized with the
+    display, though: the phase of the vsyncs within a frame is taken from
+    the first flip, so that offset is never mistaken for drift.
+    """
+    def __init__(self, clock, frame_rate):
+        self.clock = clock
+        self.frame_rate = frame_rate
+        self.frame_period = 1.0 / frame_rate
+        self.frame = 0
+        # Run clock time of the vsync of frame 0: within a frame after the
+        # trigger, set by the first flip
+        self.origin = None
+        self.budgets = []
+        # Frames skipped (or repeated, if negative) by clock corrections,
+        # per event index
+        self.corrections = {}
+        self.current = None
+
+    def plan(self, entries):
+        self.budgets = frame_budgets(entries, self.frame_rate)
+        return(self.budgets)
+
+    def attach(self, win):
+        """Wraps win.flip() so flips are counted. Attach after the trigger."""
+        original_flip = win.flip
+        def flip(*args, **kwargs):
+            result = original_flip(*args, **kwargs)
+            self.count_flip(self.clock.getTime())
+            return(result)
+        win.flip = flip
+        self._original_flip = original_flip
+
+    def detach(self, win):
+        """Undoes attach(). Detach in the reverse order of attaching."""
+        win.flip = self._original_flip
+
+    def count_flip(self, t):
+        if(self.origin is None):
+            # Whole frames since the trigger are drift; the rest is phase
+            frames_late = max(0, int(math.floor(t / self.frame_period)))
+            self.origin = t - frames_late * self.frame_period
+        drift = (t - self.origin) / self.frame_period - self.frame
+        if(abs(drift) > CORRECTION_THRESHOLD):
+            off = int(math.floor(drift + .5))
+            self.frame += off
+            if(self.current is not None):
+                self.corrections[self.current] = self.corrections.get(self.current, 0) + off
+        self.frame += 1
+
+    def getTime(self):
+        return(self.frame * self.frame_period)
+
+    def time_of(self, us):
+        """
+        The run clock time of the frame a script time (integer
+        microseconds) is rounded to, as the budgets round event ends.
+        """
+        return(to_frames(us, self.frame_rate) * self.frame_period)
+
+    def begin(self, index):
+        """Starts event index and returns its end_time on this clock."""
+        self.current = index
+        return(self.budgets[index].end_frame * self.frame_period)
+
+    def write_report(self, filename):
+        """
+        Writes, for each event, the onset and duration the script asked for,
+        the onset and frame count it was given and the quantization error
+        between them, plus any clock corrections made while it was shown.
+        """
+        frame_period = self.frame_period
+        with open(filename, 'w') as report:
+            report.write("# Frame-locked schedule\n")
+            report.write("frame_rate,{0:.4f}\n".format(self.frame_rate))
+            report.write("frames,{0}\n".format(self.frame))
+            report.write("corrected_frames,{0}\n".format(
+                sum(abs(off) for off in self.corrections.values())
+            ))
+            report.write("index,stim,planned_onset,frame_onset,onset_error_ms,"
+                         "planned_dur,frames,dur_error_ms,corrections\n")
+            for budget in self.budgets:
+                onset = budget.onset_frame * frame_period
+                frames = budget.end_frame - budget.onset_frame
+                planned_onset = budget.start_us / 1e6
+                planned_dur = budget.dur_us / 1e6
+                report.write("{0},{1},{2:.6f},{3:.6f},{4:.3f},{5:.6f},{6},{7:.3f},{8}\n".format(
+                    budget.index, budget.stim_str, planned_onset, onset,
+                    (onset - planned_onset) * 1000, planned_dur, frames,
+                    (frames * frame_period - planned_dur) * 1000,
+                    self.corrections.get(budget.index, 0)
+                ))
@@ -0,0 +1,41 @@
+"""
+Reads the scanner's serial port (TR pulses and button box input) without
+busy-polling.
+"""
+import os
+import select
+
+from timing import get_time
+
+class SerialReader(object):
+    """
+    Waits on a serial port's file descriptor with select(), so the reading
+    process sleeps until bytes arrive, then reads everything available in one
+    call. port can be a pyserial Serial (or anything else with fileno()) or a
+    plain file descriptor, such as one end of a pty.
+
+    Each byte is stamped with get_time() - t0 taken as soon as select()
+    returns. With t0 from timing.run_clock_origin(), that is the time on the
+    PsychoPy clock used for stimuli. Bytes that arrive together in one burst
+    share a timestamp.
+    """
+    def __init__(self, port, t0, chunk_bytes=4096):
+        if(isinstance(port, int)):
+            self.fd = port
+        else:
+            self.fd = port.fileno()
+        self.t0 = t0
+        self.chunk_bytes = chunk_bytes
+
+    def read(self, timeout=None):
+        """
+        Waits up to timeout seconds (forever if None) for input and returns a
+        list of (time, char) records, which is empty if nothing arrived.
+        """
+        ready, writable, errored = select.select([self.fd], [], [], timeout)
+        if(not ready):
+            return([])
+        t_now = get_time() - self.t0
+        data = os.read(self.fd, self.chunk_bytes)
+        # latin-1 maps every byte to the character with the same code
+        return([(t_now, char) for char in data.decode('latin-1')])
@@ -0,0 +1,54 @@
+"""
+Helpers for running several scans in one session, with one window and one
+logging process, loading each run while the one before it is on screen.
+"""
+import sys
+import threading
+
+def parse_run_numbers(text):
+    """
+    Parses the run numbers typed into the configuration dialog: a single
+    run ("2"), a list ("1,2,4") or ranges ("1-3,5"), in the order given.
+    """
+    runs = []
+    for part in str(text).split(','):
+        part = part.strip()
+        if(not part):
+            continue
+        if('-' in part):
+            first, last = part.split('-', 1)
+            runs.extend(range(int(first), int(last) + 1))
+        else:
+            runs.append(int(part))
+    if(not runs):
+        raise ValueError("No run numbers in {0!r}".format(text))
+    return(runs)
+
+class Preloader(object):
+    """
+    Calls load(*args) on a background thread. result() waits for it to
+    finish and returns what it returned, re-raising anything it raised.
+    """
+    def __init__(self, load, *args):
+        self._load = load
+        self._args = args
+        self._result = None
+        self._error = None
+        self._thread = threading.Thread(target=self._run)
+        self._thread.daemon = True
+        self._thread.start()
+
+    def _run(self):
+        try:
+            self._result = self._load(*self._args)
+        except Exception:
+            self._error = sys.exc_info()
+
+    def done(self):
+        return(not self._thread.is_alive())
+
+    def result(self):
+        self._thread.join()
+        if(self._error is not None):
+            raise self._error[1]
+        return(self._result)
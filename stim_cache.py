@@ -0,0 +1,99 @@
+import collections
+import os
+
+# Rough cost of a text stimulus. TextStim renders each string to its own
+# texture, so this is a guess at a typical texture rather than len(text).
+TEXT_STIM_COST = 256 * 1024
+
+# Default memory budget for the cache, in bytes.
+DEFAULT_BUDGET = 1024 * 1024 * 1024
+
+def stim_key(kind, stim_str, color=None, no_audio=False):
+    """
+    Builds the cache key for a stimulus. Two script lines with the same key
+    can safely share a single PsychoPy stimulus object.
+    """
+    return((kind, stim_str, color, no_audio))
+
+def estimate_cost(key):
+    """
+    Estimates how much memory the stimulus for a key will occupy. For file
+    stims we use the size on disk, which undercounts decoded images but is
+    cheap and keeps large files from crowding out everything else.
+    """
+    kind, stim_str = key[0], key[1]
+    if(kind == 'text'):
+        return(TEXT_STIM_COST)
+    try:
+        return(os.path.getsize(stim_str))
+    except OSError:
+        return(0)
+
+def release_stim(stim):
+    """
+    Frees what a stimulus holds beyond ordinary memory. MovieStim3.stop()
+    unloads the movie and closes its decoder; text and images hold nothing
+    that needs closing.
+    """
+    stop = getattr(stim, 'stop', None)
+    if(stop is not None):
+        stop()
+
+class StimulusCache(object):
+    """
+    Holds PsychoPy stimulus objects so that a stimulus used on many lines of a
+    script is only loaded once. Entries are evicted least-recently-used first
+    once the estimated size of the cache goes over budget (in bytes), and
+    release()d as they go. The keep_newest most recently used entries are
+    never evicted, since events built ahead of display still hold them.
+    """
+    def __init__(self, budget=DEFAULT_BUDGET, keep_newest=1, release=release_stim):
+        self.budget = budget
+        self.keep_newest = keep_newest
+        self.release = release
+        self.size = 0
+        self.hits = 0
+        self.misses = 0
+        self._entries = collections.OrderedDict()
+
+    def __len__(self):
+        return(len(self._entries))
+
+    def __contains__(self, key):
+        return(key in self._entries)
+
+    def get(self, key, factory):
+        """
+        Returns the stimulus for key, calling factory() to create it if it is
+        not already cached.
+        """
+        if(key in self._entries):
+            # Re-insert to mark as most recently used
+            entry = self._entries.pop(key)
+            self._entries[key] = entry
+            self.hits += 1
+            return(entry[0])
+
+        self.misses += 1
+        stim = factory()
+        cost = estimate_cost(key)
+        self._entries[key] = (stim, cost)
+        self.size += cost
+        self._evict()
+        return(stim)
+
+    def discard(self, key):
+        if(key in self._entries):
+            stim, cost = self._entries.pop(key)
+            self.size -= cost
+
+    def clear(self):
+        self._entries.clear()
+        self.size = 0
+
+    def _evict(self):
+        # Always keep the newest entries, even if they alone are over budget.
+        while(self.size > self.budget and len(self._entries) > self.keep_newest):
+            key, (stim, cost) = self._entries.popitem(last=False)
+            self.size -= cost
+            self.release(stim)
@@ -0,0 +1,75 @@
+import time
+import unittest
+
+import numpy
+
+import audio_engine
+from prefetch import DecodedSound
+
+class FakeClock(object):
+    def __init__(self):
+        self.t = 0.0
+
+    def getTime(self):
+        return(self.t)
+
+class TestAudioEngine(unittest.TestCase):
+
+    def setUp(self):
+        self.clock = FakeClock()
+        # 1 kHz with 10-sample blocks keeps sample times easy to read
+        self.output = audio_engine.NullOutput(self.clock, 1000, 1, 10,
+                                              realtime=False, record=True)
+        self.engine = audio_engine.AudioEngine(self.output, 1000, 1)
+        self.engine.start()
+        self.buffer = self.engine.load('ones.wav', DecodedSound(
+            numpy.ones((100, 1), dtype='float32'), 1000
+        ))
+
+    def pump(self, n_blocks):
+        for i in range(n_blocks):
+            self.output.pump()
+            self.clock.t += .01
+        return(numpy.concatenate(self.output.blocks)[:, 0])
+
+    def test_starts_and_stops_on_the_scheduled_samples(self):
+        voice = self.engine.schedule(self.buffer, .015, .042)
+        played = self.pump(6)
+        self.assertEqual(0, played[:15].sum())
+        self.assertEqual(27, played[15:42].sum())
+        self.assertEqual(0, played[42:].sum())
+        self.assertAlmostEqual(0, voice.latency)
+
+    def test_late_voice_starts_at_next_block(self):
+        self.pump(2)
+        voice = self.engine.schedule(self.buffer, .005)
+        played = self.pump(1)
+        self.assertEqual(10, played[20:].sum())
+        self.assertAlmostEqual(.015, voice.latency)
+
+    def test_forget_stops_scheduled_and_playing_voices(self):
+        self.engine.schedule(self.buffer, .005)
+        self.engine.schedule(self.buffer, .05)
+        self.pump(1)
+        self.engine.forget()
+        self.assertEqual({}, self.engine.buffers)
+        played = self.pump(10)
+        self.assertEqual(5, played.sum())
+
+    def test_converts_sample_rate_and_channels(self):
+        decoded = DecodedSound(numpy.zeros((500, 1), dtype='float32'), 500)
+        samples = audio_engine.convert(decoded, 1000, 2)
+        self.assertEqual((1000, 2), samples.shape)
+
+class TestNullOutput(unittest.TestCase):
+
+    def test_realtime_output_keeps_asking_for_blocks(self):
+        blocks = []
+        output = audio_engine.NullOutput(FakeClock(), 1000, 1, 10)
+        output.start(lambda outdata, dac_time: blocks.append(len(outdata)))
+        time.sleep(.1)
+        output.stop()
+        self.assertGreater(len(blocks), 5)
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,47 @@
+import json
+import os
+import shutil
+import tempfile
+import unittest
+
+import benchmark
+from timeline import Timeline
+
+class TestBenchmark(unittest.TestCase):
+
+    def setUp(self):
+        self.tmpdir = tempfile.mkdtemp()
+
+    def tearDown(self):
+        shutil.rmtree(self.tmpdir)
+
+    def read(self, n_events, overlaps):
+        path = os.path.join(self.tmpdir, 'synthetic.txt')
+        benchmark.generate_script(path, n_events, overlaps)
+        timeline = Timeline()
+        timeline.read_from_file(path)
+        return(timeline)
+
+    def test_generated_scripts_parse(self):
+        timeline = self.read(1000, False)
+        self.assertEqual(1000, len(timeline.events))
+        self.assertEqual(set(['text', 'image', 'sound', 'movie']),
+                         set(event.kind for event in timeline.events))
+        self.assertEqual([], timeline.has_overlapping_events())
+
+    def test_generated_scripts_can_overlap(self):
+        self.assertTrue(self.read(1000, True).has_overlapping_events())
+
+    def test_suite_results_are_json_and_comparable(self):
+        suite = benchmark.run_suite(sizes=[100], repeat=1, n_frames=100,
+                                    workdir=self.tmpdir, import_modules=['timeline'])
+        suite = json.loads(json.dumps(suite))
+        self.assertEqual(8, len(suite['timeline']))
+        self.assertEqual(len(benchmark.FRAME_LOOP_CONFIGURATIONS), len(suite['frame_loop']))
+        rows = benchmark.compare(suite, suite)
+        self.assertEqual(['timeline'], [r['module'] for r in suite['imports']])
+        self.assertEqual(13, len(rows))
+        self.assertTrue(all(before == after for key, before, after, ratio in rows))
+
+if __name__ == '__main__':
+    unittest.main()
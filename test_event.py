@@ -1,5 +1,6 @@
 from psychopy import core, data, visual, event, sound, gui
 import event
+import text_cache
 import unittest
 
 class TestEvent(unittest.TestCase):
@@ -7,63 +8,65 @@ class TestEvent(unittest.TestCase):
     def setUp(self):
         pass
     
-    def test_create_null_events_creates_correct_start_times(self):
+    def test_repeated_text_shares_one_stimulus(self):
         win = visual.Window([800, 600], monitor='testMonitor')
         events = event.EventList(win)
-        events.read_from_file('test_scripts/test_script.txt')
-        events.create_null_events()
-        
-        #NULL,"+"
-        #0,2,"pecan"
-        #6,3,"walnut"
-        #13,2,"apricot"
-        #15,2,"melon"
-
-        # null at 0 + 2 for 6 - 2
-        # null at 6 + 3 for 13 - (6+3) 
+        events.read_from_file('test_scripts/test_script_with_overlap.txt')
+        shown = list(events.iter_materialized())
+        self.assertEqual([e.stim_str for e in events.events], [e.stim_str for e in shown])
+        self.assertIs(shown[0].stim, shown[1].stim)
+        self.assertIsNot(shown[0].stim, shown[4].stim)
 
-        # 0  - 2  pecan
-        # 2  - 6  NULL
-        # 6  - 9  walnut
-        # 9  - 13 NULL
-        # 13 - 15 apricot
-        # 15 - 17 melon
-        
-        self.assertEqual(9, events.events[3].start)
-    
-    def test_create_null_events_creates_correct_durations(self):
+    def test_text_is_drawn_from_prebuilt_textures(self):
         win = visual.Window([800, 600], monitor='testMonitor')
-        events = event.EventList(win)
+        rendered = []
+        def render(win, text, color, wrap_width):
+            rendered.append(text)
+            return(visual.BufferImageStim(win))
+        textures = text_cache.TextTextureCache(win, render=render)
+        events = event.EventList(win, textures=textures)
         events.read_from_file('test_scripts/test_script.txt')
         events.create_null_events()
-        self.assertEqual(4, events.events[3].dur)
-        
-    def test_create_null_events_no_null_between_adjacent_non_nulls(self):
-        win = visual.Window([800, 600], monitor='testMonitor')
-        events = event.EventList(win)
-        events.read_from_file('test_scripts/test_script.txt')
-        events.create_null_events()
-        self.assertEqual('melon', events.events[5].stim_str)
-        
-    def test_create_null_events_does_not_create_overlapping_events(self):
-        win = visual.Window([800, 600], monitor='testMonitor')
-        events = event.EventList(win)
-        events.read_from_file('test_scripts/test_script_without_overlap.txt')
-        events.create_null_events()
-        self.assertFalse(events.has_overlapping_events())
-        
-    def test_has_overlapping_events_finds_overlapping_events_before_null_creation(self):
-        win = visual.Window([800, 600], monitor='testMonitor')
-        events = event.EventList(win)
-        events.read_from_file('test_scripts/test_script_with_overlap.txt')
-        self.assertTrue(events.has_overlapping_events())
-        
-    def test_has_overlapping_events_finds_overlapping_events_after_null_creation(self):
-        win = visual.Window([800, 600], monitor='testMonitor')
-        events = event.EventList(win)
-        events.read_from_file('test_scripts/test_script_with_overlap.txt')
-        events.create_null_events()
-        self.assertTrue(events.has_overlapping_events())
-        
+        textures.prerender(events.events)
+        shown = list(events.iter_materialized())
+        self.assertIs(textures.get('pecan', '#FFFFFF'), shown[0].stim)
+        self.assertIs(shown[1].stim, events.null_display().stim)
+        self.assertEqual(['pecan', '+', 'walnut', 'apricot', 'melon'], rendered)
+
+    def test_streamed_movie_shows_null_until_the_first_frame(self):
+        class FakeStream(object):
+            def __init__(self, path, buffer_frames):
+                self.frames = [None, None, 'frame 0', None]
+                self.ring = self
+                self.dropped = 0
+            def start(self):
+                pass
+            def frame_at(self, t):
+                return(self.frames.pop(0))
+            @property
+            def finished(self):
+                return(not self.frames)
+            def close(self):
+                pass
+        class FakeClock(object):
+            def getTime(self):
+                return(0.0)
+        class Null(object):
+            shown = 0
+            def display(self):
+                self.shown += 1
+        stream = event.MovieStream
+        event.MovieStream = FakeStream
+        try:
+            movie = event.StreamingMovieEvent(0, 1000000, 'clip.mp4', visual.Window())
+        finally:
+            event.MovieStream = stream
+        drawn = []
+        movie.stim.draw = lambda: drawn.append(movie.stim.image)
+        null = Null()
+        movie.display(FakeClock(), 1.0, null)
+        self.assertEqual(2, null.shown)
+        self.assertEqual(['frame 0', 'frame 0'], drawn)
+
 if __name__ == '__main__':
     unittest.main()
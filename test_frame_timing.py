@@ -0,0 +1,69 @@
+import os
+import shutil
+import tempfile
+import unittest
+
+import frame_timing
+
+class FakeClock(object):
+    def __init__(self):
+        self.t = 0.0
+
+    def getTime(self):
+        return(self.t)
+
+class FakeWindow(object):
+    def __init__(self, clock, intervals):
+        self.clock = clock
+        self.intervals = list(intervals)
+
+    def flip(self):
+        self.clock.t += self.intervals.pop(0)
+
+class TestFlipRecorder(unittest.TestCase):
+
+    def setUp(self):
+        self.clock = FakeClock()
+        # 50 Hz: 20 ms frames, with one 60 ms flip (two dropped frames)
+        self.win = FakeWindow(self.clock, [0.02, 0.02, 0.06, 0.02, 0.02])
+        self.recorder = frame_timing.FlipRecorder(self.clock, 50.0, capacity=2)
+        self.recorder.attach(self.win)
+
+    def test_records_every_flip_past_capacity(self):
+        for i in range(5):
+            self.win.flip()
+        self.assertEqual(5, self.recorder.count)
+        self.assertAlmostEqual(0.14, self.recorder.flip_times[4])
+
+    def test_counts_dropped_frames(self):
+        for i in range(5):
+            self.win.flip()
+        intervals = self.recorder.intervals()
+        self.assertEqual(2, self.recorder.dropped_frames(intervals))
+
+    def test_onset_error_is_first_flip_after_mark(self):
+        self.win.flip()
+        self.recorder.mark_onset(0, 'pecan', 0.03)
+        self.win.flip()
+        self.win.flip()
+        errors = self.recorder.onset_errors()
+        self.assertEqual(1, len(errors))
+        self.assertAlmostEqual(0.01, errors[0][4])
+
+    def test_write_report(self):
+        tmpdir = tempfile.mkdtemp()
+        try:
+            self.recorder.mark_onset(0, 'pecan', 0)
+            for i in range(5):
+                self.win.flip()
+            filename = os.path.join(tmpdir, 'timing.txt')
+            self.recorder.write_report(filename)
+            with open(filename) as report:
+                lines = report.read().splitlines()
+            self.assertIn('dropped_frames,2', lines)
+            self.assertIn('60,1', lines)
+        finally:
+            shutil.rmtree(tmpdir)
+
+if __name__ == '__main__':
+    unittest.main()
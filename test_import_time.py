@@ -0,0 +1,38 @@
+import sys
+import unittest
+
+import benchmark
+
+# Best-of-3 cumulative import time allowed for each module, in ms. These
+# leave plenty of room for a slow machine; importing PsychoPy alone takes
+# longer than any of them.
+IMPORT_BUDGETS_MS = {
+    'timeline': 100,
+    'event': 150,
+    'fmri_go': 500,
+    'run_plan': 1000,
+    'log_align': 1000,
+    'preflight': 1000
+}
+
+# Script parsing and the presentation script itself don't need numpy either
+NO_NUMPY = ['timeline', 'event', 'fmri_go']
+
+@unittest.skipIf(sys.version_info < (3, 7), "-X importtime needs Python 3.7")
+class TestImportTime(unittest.TestCase):
+
+    def test_modules_import_nothing_heavy(self):
+        for module in benchmark.IMPORT_MODULES:
+            profile = benchmark.import_profile(module)
+            heavy = benchmark.HEAVY_MODULES + (['numpy'] if module in NO_NUMPY else [])
+            self.assertEqual([], sorted(name for name in profile if name in heavy),
+                             "import {0} loads heavy modules".format(module))
+
+    def test_imports_stay_within_budget(self):
+        for module in benchmark.IMPORT_MODULES:
+            result = benchmark.time_import(module, repeat=3)
+            self.assertLess(result['ms'], IMPORT_BUDGETS_MS[module],
+                            "import {0} took {1:.1f} ms".format(module, result['ms']))
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,50 @@
+import unittest
+
+import input_pipeline
+from ipc_ring import RecordRing, SOURCE_KEYBOARD, encode_key
+
+class FakeWindow(object):
+    def flip(self):
+        pass
+
+class TestKeyPoller(unittest.TestCase):
+
+    def setUp(self):
+        self.pressed = []
+        self.ring = RecordRing(16)
+        self.poller = input_pipeline.KeyPoller(None, self.get_keys, self.ring)
+
+    def get_keys(self, timeStamped=None):
+        keys = self.pressed
+        self.pressed = []
+        return(keys)
+
+    def test_polls_after_every_flip(self):
+        win = FakeWindow()
+        self.poller.attach(win)
+        self.pressed = [('5', 0.01)]
+        win.flip()
+        self.pressed = [('1', 0.02), ('q', 0.03)]
+        win.flip()
+        self.assertEqual([
+            (0.01, SOURCE_KEYBOARD, encode_key('5')),
+            (0.02, SOURCE_KEYBOARD, encode_key('1')),
+            (0.03, SOURCE_KEYBOARD, encode_key('q'))
+        ], self.ring.drain())
+        self.assertEqual(['5', '1', 'q'], self.poller.take_event_keys())
+        self.assertEqual([], self.poller.take_event_keys())
+
+    def test_detach_stops_polling(self):
+        win = FakeWindow()
+        self.poller.attach(win)
+        self.poller.detach(win)
+        self.pressed = [('5', 0.01)]
+        win.flip()
+        self.assertEqual(0, len(self.ring))
+
+    def test_empty_polls_send_nothing(self):
+        self.poller.poll()
+        self.assertEqual(0, len(self.ring))
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,51 @@
+import multiprocessing
+import unittest
+
+import ipc_ring
+
+def produce(ring, n):
+    for i in range(n):
+        # Wait for room rather than dropping
+        while(len(ring) >= ring.capacity):
+            pass
+        ring.push(i * .001, ipc_ring.SOURCE_SERIAL, i)
+
+class TestRecordRing(unittest.TestCase):
+
+    def test_drains_records_in_order(self):
+        ring = ipc_ring.RecordRing(4)
+        ring.push(.5, ipc_ring.SOURCE_KEYBOARD, ipc_ring.encode_key('q'))
+        ring.push(.75, ipc_ring.SOURCE_SERIAL, ord('5'))
+        self.assertEqual(2, len(ring))
+        self.assertEqual([(.5, 1, ord('q')), (.75, 2, ord('5'))], ring.drain())
+        self.assertEqual([], ring.drain())
+
+    def test_drops_records_when_full(self):
+        ring = ipc_ring.RecordRing(2)
+        self.assertTrue(ring.push(0, 1, 1))
+        self.assertTrue(ring.push(0, 1, 2))
+        self.assertFalse(ring.push(0, 1, 3))
+        self.assertEqual(1, ring.dropped)
+        self.assertEqual([1, 2], [code for t, source, code in ring.drain()])
+        # Slots are reused once read
+        self.assertTrue(ring.push(0, 1, 4))
+        self.assertEqual([4], [code for t, source, code in ring.drain()])
+
+    def test_passes_records_between_processes(self):
+        ring = ipc_ring.RecordRing(64)
+        producer = multiprocessing.Process(target=produce, args=(ring, 1000))
+        producer.start()
+        codes = []
+        while(len(codes) < 1000):
+            codes += [code for t, source, code in ring.drain()]
+        producer.join()
+        self.assertEqual(list(range(1000)), codes)
+        self.assertEqual(0, ring.dropped)
+
+    def test_key_codes_round_trip(self):
+        for name in ['q', '5', 'space', 'num_7']:
+            self.assertEqual(name, ipc_ring.decode_key(ipc_ring.encode_key(name)))
+        self.assertEqual('?', ipc_ring.decode_key(ipc_ring.encode_key('f13')))
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,97 @@
+import os
+import shutil
+import tempfile
+import unittest
+
+import numpy
+
+import log_align
+import run_plan
+from log_writer import LogWriter
+
+class TestLogAlign(unittest.TestCase):
+
+    def setUp(self):
+        self.tmpdir = tempfile.mkdtemp()
+        self.script = os.path.join(self.tmpdir, 'script.txt')
+        shutil.copy('test_scripts/test_script_without_overlap.txt', self.script)
+
+    def tearDown(self):
+        shutil.rmtree(self.tmpdir)
+
+    def write_run(self, subject, run, responses, pulses, binary=False):
+        prefix = os.path.join(self.tmpdir, '{0}_run_{1}'.format(subject, run))
+        for filename, records in [(prefix + '_log.txt', responses),
+                                  (prefix + '_tr_log.txt', pulses)]:
+            writer = LogWriter(filename, binary=binary)
+            for t, value in records:
+                writer.write(t, value)
+            writer.close()
+        return(prefix)
+
+    def read_tsv(self, filename):
+        with open(filename) as tsv:
+            lines = tsv.read().splitlines()
+        header = lines[0].split('\t')
+        return([dict(zip(header, line.split('\t'))) for line in lines[1:]])
+
+    def test_assign(self):
+        starts = numpy.array([0.0, 1.0, 3.0])
+        ends = numpy.array([1.0, 2.0, 4.0])
+        times = numpy.array([-.5, 0.0, .99, 1.0, 2.5, 3.5, 9.0])
+        self.assertEqual([-1, 0, 0, 1, -1, 2, -1],
+                         log_align.assign(starts, ends, times).tolist())
+
+    def test_assign_finds_a_long_event_around_a_short_one(self):
+        # A movie from 0 to 10s, with cues at 2s and at 4s nested inside it
+        starts = numpy.array([0.0, 2.0, 4.0, 4.5, 12.0])
+        ends = numpy.array([10.0, 3.0, 4.5, 5.0, 13.0])
+        times = numpy.array([1.0, 2.5, 3.5, 4.2, 4.7, 6.0, 11.0, 12.5])
+        self.assertEqual([0, 1, 0, 2, 3, 0, -1, 4],
+                         log_align.assign(starts, ends, times).tolist())
+        self.assertEqual([-1], log_align.assign(starts[:0], ends[:0], times[:1]).tolist())
+
+    def test_aligns_responses_with_events_and_volumes(self):
+        prefix = self.write_run('s01', 1, [(1.25, '1'), (1.4, '2'), (3.6, '3')],
+                                [(1.0, '5'), (2.0, '5'), (3.0, '5'), (4.0, '5')])
+        plan = run_plan.load_plan(self.script)
+        summary = log_align.align_run(prefix + '_log.txt', plan)
+        self.assertEqual((3, 5, 0), (summary.responses, summary.volumes, summary.unmatched))
+
+        events = self.read_tsv(prefix + '_events.tsv')
+        pecan = [row for row in events if row['value'] == 'pecan'][1]
+        self.assertEqual(('1.000000', '0.500000', 'text', '1', '0.250000'),
+                         (pecan['onset'], pecan['duration'], pecan['trial_type'],
+                          pecan['response'], pecan['response_time']))
+        walnut = [row for row in events if row['value'] == 'walnut'][0]
+        self.assertEqual(('3', '0.100000'), (walnut['response'], walnut['response_time']))
+        self.assertEqual(3, len([row for row in events if row['trial_type'] == 'response']))
+        self.assertIn('null', [row['trial_type'] for row in events])
+
+        volumes = self.read_tsv(prefix + '_volumes.tsv')
+        self.assertEqual(['0', '2', '0', '1', '0'], [row['responses'] for row in volumes])
+        self.assertEqual(['pecan', 'pecan', 'pecan', 'pecan', 'pecan'],
+                         [row['stimulus'] for row in volumes])
+        self.assertEqual('1.000000', volumes[-1]['duration'])
+
+    def test_reads_binary_logs(self):
+        prefix = self.write_run('s01', 2, [(.1, 'num_1'), (.2, '2')], [(1.0, '5')],
+                                binary=True)
+        times, inputs = log_align.read_log(prefix + '_log.txt')
+        self.assertEqual([.1, .2], times.tolist())
+        self.assertEqual(['num_1', '2'], inputs.tolist())
+
+    def test_aligns_a_study_in_parallel(self):
+        for run in range(1, 5):
+            self.write_run('s01', run, [(.25, '1')], [(1.0, '5')])
+        with open(os.path.join(self.tmpdir, 's02_run_1_log.txt'), 'w') as log:
+            log.write('time,input\n')
+        problems = log_align.align_study([self.tmpdir], self.script, jobs=2, null_event=False)
+        # s02 has no TR log
+        self.assertEqual(1, problems)
+        for run in range(1, 5):
+            events = self.read_tsv(os.path.join(self.tmpdir, 's01_run_{0}_events.tsv'.format(run)))
+            self.assertNotIn('null', [row['trial_type'] for row in events])
+
+if __name__ == '__main__':
+    unittest.main()
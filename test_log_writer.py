@@ -0,0 +1,49 @@
+import os
+import shutil
+import tempfile
+import unittest
+
+import log_writer
+
+class TestLogWriter(unittest.TestCase):
+
+    def setUp(self):
+        self.tmpdir = tempfile.mkdtemp()
+        self.filename = os.path.join(self.tmpdir, 'subject_run_1_log.txt')
+
+    def tearDown(self):
+        shutil.rmtree(self.tmpdir)
+
+    def read_lines(self):
+        with open(self.filename) as logfile:
+            return(logfile.read().splitlines())
+
+    def test_buffers_until_flush_records(self):
+        writer = log_writer.LogWriter(self.filename, flush_records=3,
+                                      flush_interval=60)
+        writer.write(0.5, '1')
+        writer.write(1.5, '2')
+        self.assertEqual(['time,input'], self.read_lines())
+        writer.write(2.5, '3')
+        self.assertEqual(['time,input', '0.5,1', '1.5,2', '2.5,3'], self.read_lines())
+        writer.close()
+
+    def test_close_writes_remaining_records(self):
+        writer = log_writer.LogWriter(self.filename, flush_interval=60)
+        writer.write(0.5, '5')
+        writer.close()
+        self.assertEqual(['time,input', '0.5,5'], self.read_lines())
+
+    def test_binary_log_round_trip(self):
+        writer = log_writer.LogWriter(self.filename, binary=True, flush_records=2)
+        writer.write(0.25, '5')
+        writer.write(3.25, '5')
+        writer.write(4.125, 'space')
+        writer.close()
+        records = log_writer.read_binary_log(
+            os.path.join(self.tmpdir, 'subject_run_1_log.bin')
+        )
+        self.assertEqual([(0.25, '5'), (3.25, '5'), (4.125, 'space')], records)
+
+if __name__ == '__main__':
+    unittest.main()
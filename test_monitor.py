@@ -0,0 +1,69 @@
+import json
+import socket
+import unittest
+
+import monitor
+import scanner_emulator
+
+class TestRunStats(unittest.TestCase):
+
+    def feed(self, stats, schedule):
+        for t, char in schedule:
+            stats.pulse(t)
+
+    def test_measures_tr_and_drift(self):
+        stats = monitor.RunStats(2.0)
+        # The first pulse is the trigger, which the logger never sees
+        self.feed(stats, scanner_emulator.sync_pulse_schedule(100, 2.0, drift=1e-4)[1:])
+        snapshot = stats.snapshot(200.0)
+        self.assertEqual(99, snapshot['pulses'])
+        self.assertAlmostEqual(2.0002, snapshot['measured_tr'], places=6)
+        self.assertAlmostEqual(100, snapshot['drift_ppm'], places=1)
+        self.assertAlmostEqual(99 * .2, snapshot['offset_ms'], places=6)
+
+    def test_counts_missing_and_doubled_pulses(self):
+        stats = monitor.RunStats(2.0)
+        self.feed(stats, [(2.0, '5'), (2.005, '5'), (4.0, '5'), (10.0, '5')])
+        snapshot = stats.snapshot(10.5)
+        self.assertEqual(3, snapshot['pulses'])
+        self.assertEqual(1, snapshot['doubles'])
+        self.assertEqual(2, snapshot['missing'])
+        self.assertFalse(snapshot['late'])
+        self.assertTrue(stats.snapshot(14.0)['late'])
+
+    def test_response_rate_covers_the_last_minute(self):
+        stats = monitor.RunStats(2.0)
+        for t in range(0, 120, 2):
+            stats.response(float(t))
+        snapshot = stats.snapshot(120.0)
+        self.assertEqual(60, snapshot['responses'])
+        self.assertEqual(30, snapshot['responses_per_min'])
+
+    def test_formats_an_empty_run(self):
+        line = monitor.format_snapshot(monitor.RunStats(2.0).snapshot(0.0))
+        self.assertIn('TRs    0', line)
+
+class TestMonitor(unittest.TestCase):
+
+    def test_sends_snapshots_over_udp(self):
+        receiver = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+        receiver.bind(('127.0.0.1', 0))
+        receiver.settimeout(1)
+        try:
+            port = receiver.getsockname()[1]
+            run_monitor = monitor.Monitor(2.0, '5', [monitor.UdpView(port)], interval=1.0)
+            run_monitor.record(2.0, '5')
+            run_monitor.record(2.5, '1')
+            run_monitor.tick(2.5)
+            # Too soon for another update
+            run_monitor.tick(3.0)
+            run_monitor.close(3.0)
+            first = json.loads(receiver.recv(65536).decode('utf-8'))
+            last = json.loads(receiver.recv(65536).decode('utf-8'))
+            self.assertEqual((1, 1), (first['pulses'], first['responses']))
+            self.assertEqual(3.0, last['time'])
+        finally:
+            receiver.close()
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,93 @@
+import threading
+import time
+import unittest
+
+import movie_stream
+
+class FakeReader(object):
+    def __init__(self, nframes=100, fps=10.0):
+        self.nframes = nframes
+        self.fps = fps
+        self.read = 0
+        self.closed = False
+
+    def read_frame(self):
+        self.read += 1
+        return(self.read - 1)
+
+    def close(self):
+        self.closed = True
+
+def wait_for(condition, timeout=2.0):
+    give_up = time.time() + timeout
+    while(not condition() and time.time() < give_up):
+        time.sleep(.001)
+    return(condition())
+
+class TestFrameRing(unittest.TestCase):
+
+    def test_skips_late_frames(self):
+        ring = movie_stream.FrameRing(10)
+        for n in range(5):
+            ring.put(n * .1, n)
+        self.assertEqual(None, ring.frame_at(-.05))
+        self.assertEqual(0, ring.frame_at(0))
+        self.assertEqual(3, ring.frame_at(.35))
+        self.assertEqual(2, ring.dropped)
+        self.assertEqual(None, ring.frame_at(.35))
+
+    def test_put_blocks_while_full(self):
+        ring = movie_stream.FrameRing(2)
+        ring.put(0, 0)
+        ring.put(.1, 1)
+        added = threading.Event()
+        def put():
+            ring.put(.2, 2)
+            added.set()
+        threading.Thread(target=put).start()
+        self.assertFalse(added.wait(.05))
+        ring.frame_at(0)
+        self.assertTrue(added.wait(1))
+
+class TestMovieStream(unittest.TestCase):
+
+    def make_stream(self, reader, buffer_frames=4):
+        return(movie_stream.MovieStream('pecan.mp4', buffer_frames,
+                                        decoder=lambda path: reader,
+                                        convert=lambda frame: frame))
+
+    def test_decodes_only_buffer_frames_ahead(self):
+        reader = FakeReader()
+        stream = self.make_stream(reader)
+        stream.start()
+        try:
+            self.assertTrue(wait_for(lambda: len(stream.ring) == 4))
+            time.sleep(.02)
+            # One frame may be decoded and waiting for space
+            self.assertLessEqual(reader.read, 5)
+            self.assertEqual(2, stream.frame_at(.25))
+            self.assertTrue(wait_for(lambda: len(stream.ring) == 4))
+        finally:
+            stream.close()
+
+    def test_close_releases_the_decoder(self):
+        reader = FakeReader()
+        stream = self.make_stream(reader)
+        stream.start()
+        stream.close()
+        self.assertTrue(reader.closed)
+        self.assertEqual(0, len(stream.ring))
+
+    def test_finishes_after_last_frame(self):
+        reader = FakeReader(nframes=3)
+        stream = self.make_stream(reader)
+        stream.start()
+        self.assertTrue(wait_for(lambda: len(stream.ring) == 3))
+        self.assertFalse(stream.finished)
+        self.assertEqual(2, stream.frame_at(1))
+        self.assertTrue(wait_for(lambda: stream.finished))
+        self.assertTrue(wait_for(lambda: reader.closed))
+        stream.close()
+
+if __name__ == '__main__':
+    unittest.main()
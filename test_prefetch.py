@@ -0,0 +1,142 @@
+import math
+import os
+import shutil
+import struct
+import tempfile
+import threading
+import time
+import unittest
+
+import prefetch
+import timeline
+
+class FakeClock(object):
+    def __init__(self, t=0.0):
+        self.t = t
+
+    def getTime(self):
+        return(self.t)
+
+def chunk(chunk_id, body):
+    return(struct.pack('>4sI', chunk_id, len(body)) + body + b'\0' * (len(body) & 1))
+
+def write_aiff(path, frames, channels, bits, rate, compression=None):
+    """Writes PCM frames as AIFF, or as AIFF-C with a compression type."""
+    exponent = int(math.floor(math.log(rate, 2)))
+    comm = struct.pack('>hIhHQ', channels, len(frames) // (channels * bits // 8), bits,
+                       16383 + exponent, int(rate * 2 ** (63 - exponent)))
+    form = b'AIFF'
+    if(compression is not None):
+        comm += compression + b'\0\0'
+        form = b'AIFC'
+    body = form + chunk(b'COMM', comm) + chunk(b'SSND', struct.pack('>II', 0, 0) + frames)
+    with open(path, 'wb') as aiff_file:
+        aiff_file.write(chunk(b'FORM', body))
+
+class TestDecodeSound(unittest.TestCase):
+
+    def setUp(self):
+        self.tmpdir = tempfile.mkdtemp()
+        self.path = os.path.join(self.tmpdir, 'tone.aif')
+
+    def tearDown(self):
+        shutil.rmtree(self.tmpdir)
+
+    def test_decodes_aiff(self):
+        write_aiff(self.path, struct.pack('>4h', 0, 16384, -32768, 32767), 2, 16, 44100)
+        decoded = prefetch.decode_sound(self.path)
+        self.assertEqual(44100, decoded.sample_rate)
+        self.assertEqual([[0, .5], [-1, 32767 / 32768.0]], decoded.samples.tolist())
+
+    def test_decodes_little_endian_aiff_c(self):
+        write_aiff(self.path, struct.pack('<2h', 16384, -16384), 1, 16, 22050, b'sowt')
+        decoded = prefetch.decode_sound(self.path)
+        self.assertEqual(22050, decoded.sample_rate)
+        self.assertEqual([[.5], [-.5]], decoded.samples.tolist())
+
+    def test_decodes_signed_8_bit_aiff(self):
+        write_aiff(self.path, struct.pack('>3b', 0, 64, -128), 1, 8, 8000)
+        self.assertEqual([[0], [.5], [-1]], prefetch.decode_sound(self.path).samples.tolist())
+
+    def test_rejects_compressed_aiff_c(self):
+        write_aiff(self.path, b'\0' * 4, 1, 16, 8000, b'ulaw')
+        self.assertRaises(ValueError, prefetch.decode_sound, self.path)
+
+class TestPrefetcher(unittest.TestCase):
+
+    def setUp(self):
+        self.tmpdir = tempfile.mkdtemp()
+        self.movie = os.path.join(self.tmpdir, 'clip.mov')
+        with open(self.movie, 'wb') as movie_file:
+            movie_file.write(b'\0' * 1024)
+
+    def tearDown(self):
+        shutil.rmtree(self.tmpdir)
+
+    def make_prefetcher(self, stim_strs, depth=2, clock=None):
+        entries = [
+            timeline.parse_event_strings([str(i), '1', stim_str])
+            for i, stim_str in enumerate(stim_strs)
+        ]
+        if(clock is None):
+            clock = FakeClock()
+        return(prefetch.Prefetcher(entries, clock, depth=depth, workers=2))
+
+    def test_take_returns_prefetched_assets_in_order(self):
+        prefetcher = self.make_prefetcher([self.movie, '"pecan"', self.movie])
+        # Text is never prefetched, and a repeated file only once
+        self.assertTrue(prefetcher.wants(0))
+        self.assertFalse(prefetcher.wants(1))
+        self.assertFalse(prefetcher.wants(2))
+        prefetcher.start()
+        self.assertEqual(self.movie, prefetcher.take(0))
+        prefetcher.stop()
+
+    def test_failed_decode_returns_none(self):
+        missing = os.path.join(self.tmpdir, 'missing.mov')
+        prefetcher = self.make_prefetcher([missing, self.movie], depth=1)
+        prefetcher.start()
+        self.assertIsNone(prefetcher.take(0))
+        self.assertEqual(self.movie, prefetcher.take(1))
+        prefetcher.stop()
+
+    def test_waits_are_misses_only_when_ready_after_onset(self):
+        gates = {'a.mov': threading.Event(), 'b.mov': threading.Event()}
+        def decode(path):
+            gates[path].wait()
+            return(path)
+        decoders = dict(prefetch.DECODERS)
+        prefetch.DECODERS['movie'] = decode
+        try:
+            clock = FakeClock(1.5)
+            prefetcher = self.make_prefetcher(['a.mov', 'b.mov'], clock=clock)
+            prefetcher.start()
+            # Ready at 1.5s, in time for an onset at 2s
+            threading.Timer(.02, gates['a.mov'].set).start()
+            self.assertEqual('a.mov', prefetcher.take(0, onset=2.0))
+            self.assertEqual(([], 1), (prefetcher.misses, prefetcher.waits))
+            # Ready at 1.5s, late for an onset at 1s
+            threading.Timer(.02, gates['b.mov'].set).start()
+            self.assertEqual('b.mov', prefetcher.take(1, onset=1.0))
+            self.assertEqual(1, len(prefetcher.misses))
+            miss = prefetcher.misses[0]
+            self.assertEqual((1, 'b.mov', 1.0, 1.5), miss[:4])
+            self.assertTrue(miss.waited > 0)
+            prefetcher.stop()
+        finally:
+            prefetch.DECODERS.update(decoders)
+
+    def test_late_assets_are_misses_without_waiting(self):
+        clock = FakeClock(3.0)
+        prefetcher = self.make_prefetcher([self.movie], clock=clock)
+        prefetcher.start()
+        # Decoded at 3s, for an event at 2s, and only taken afterwards
+        while(0 not in prefetcher._ready):
+            time.sleep(.001)
+        self.assertEqual(self.movie, prefetcher.take(0, onset=2.0))
+        self.assertEqual([(0, self.movie, 2.0, 3.0, 0.0)], prefetcher.misses)
+        self.assertEqual(0, prefetcher.waits)
+        prefetcher.stop()
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,100 @@
+import os
+import shutil
+import struct
+import tempfile
+import unittest
+import wave
+
+import preflight
+from timeline import parse_event_strings
+
+class TestPreflight(unittest.TestCase):
+
+    def setUp(self):
+        self.tmpdir = tempfile.mkdtemp()
+        self.cache = os.path.join(self.tmpdir, 'cache.json')
+
+    def tearDown(self):
+        shutil.rmtree(self.tmpdir)
+
+    def path(self, filename):
+        return(os.path.join(self.tmpdir, filename))
+
+    def write_wav(self, filename, seconds, rate=8000):
+        writer = wave.open(self.path(filename), 'wb')
+        writer.setnchannels(1)
+        writer.setsampwidth(2)
+        writer.setframerate(rate)
+        writer.writeframes(struct.pack('<h', 0) * int(seconds * rate))
+        writer.close()
+
+    def write_script(self, filename, lines):
+        with open(self.path(filename), 'w') as script:
+            script.write('NULL,"+"\n')
+            for line in lines:
+                script.write(line.format(dir=self.tmpdir) + '\n')
+
+    def run_preflight(self):
+        return(preflight.preflight([self.tmpdir], jobs=2, cache_path=self.cache))
+
+    def messages(self, report):
+        return(sorted((p.level, os.path.basename(p.path.split(' ')[0])) for p in report.problems))
+
+    def test_reports_bad_scripts_and_media(self):
+        self.write_wav('long.wav', 2.0)
+        self.write_wav('short.wav', .5)
+        with open(self.path('broken.wav'), 'wb') as broken:
+            broken.write(b'not a wav file')
+        self.write_script('run1.txt', [
+            '0,1,{dir}/long.wav',
+            '1,1,{dir}/short.wav',
+            '2,1,{dir}/broken.wav',
+            '3,1,{dir}/missing.wav'
+        ])
+        self.write_script('run2.txt', ['0,1,{dir}/clip.xyz'])
+        report = self.run_preflight()
+        self.assertEqual(2, report.scripts)
+        self.assertEqual([('FAIL', 'broken.wav'), ('FAIL', 'missing.wav'),
+                          ('FAIL', 'run2.txt'), ('WARN', 'short.wav')],
+                         self.messages(report))
+
+    def test_checks_use_against_probe_results(self):
+        movie = parse_event_strings(['0', '10', 'clip.mp4'])
+        silent_movie = parse_event_strings(['0', '10', 'clip.mp4', 'noAudio'])
+        image = parse_event_strings(['0', '1', 'big.png'])
+        info = {'duration': 12.0, 'has_audio': False, 'width': 1920, 'height': 1080}
+        self.assertEqual(['FAIL'], [p.level for p in preflight.check_use(
+            'movie', 'clip.mp4', info, 's.txt', movie, (1280, 1024))])
+        self.assertEqual([], preflight.check_use(
+            'movie', 'clip.mp4', info, 's.txt', silent_movie, (1280, 1024)))
+        self.assertEqual(['WARN'], [p.level for p in preflight.check_use(
+            'image', 'big.png', info, 's.txt', image, (1280, 1024))])
+
+    def test_only_changed_files_are_checked_again(self):
+        self.write_wav('a.wav', 1.0)
+        self.write_wav('b.wav', 1.0)
+        self.write_script('run1.txt', ['0,1,{dir}/a.wav', '1,1,{dir}/b.wav'])
+        first = self.run_preflight()
+        self.assertEqual((2, 2), (first.hashed, first.probed))
+
+        again = self.run_preflight()
+        self.assertEqual((0, 0), (again.hashed, again.probed))
+
+        # Touched but unchanged: hashed again, but not probed
+        stat = os.stat(self.path('a.wav'))
+        os.utime(self.path('a.wav'), (stat.st_atime, stat.st_mtime + 10))
+        self.write_wav('b.wav', .5)
+        changed = self.run_preflight()
+        self.assertEqual((2, 1), (changed.hashed, changed.probed))
+        self.assertEqual([('WARN', 'b.wav')], self.messages(changed))
+
+    def test_cache_defaults_to_the_study_directory(self):
+        self.write_wav('a.wav', 1.0)
+        self.write_script('run1.txt', ['0,1,{dir}/a.wav'])
+        preflight.preflight([self.tmpdir], jobs=1)
+        self.assertTrue(os.path.exists(self.path(preflight.CACHE_FILENAME)))
+        self.assertEqual(self.path(preflight.CACHE_FILENAME),
+                         preflight.cache_path_for([self.path('run1.txt')]))
+
+if __name__ == '__main__':
+    unittest.main()
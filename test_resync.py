@@ -0,0 +1,110 @@
+import os
+import random
+import shutil
+import tempfile
+import threading
+import unittest
+
+import resync
+import scanner_emulator
+from serial_input import SerialReader
+from timing import get_time
+
+class TestResyncEngine(unittest.TestCase):
+
+    def feed(self, engine, schedule):
+        for t, char in schedule:
+            engine.pulse(t)
+
+    def test_follows_drift(self):
+        engine = resync.ResyncEngine(2.0)
+        self.feed(engine, scanner_emulator.sync_pulse_schedule(450, 2.0, drift=1e-4)[1:])
+        self.assertAlmostEqual(1.0001, engine.skew, places=9)
+        # 15 minutes in, the scanner is 90 ms behind the local clock
+        self.assertAlmostEqual(900.09, engine.to_local(900.0), places=6)
+        self.assertAlmostEqual(89.8, engine.corrections[-1].correction * 1000, places=6)
+
+    def test_ignores_outliers_and_doubled_pulses(self):
+        engine = resync.ResyncEngine(2.0)
+        rng = random.Random(1)
+        schedule = scanner_emulator.sync_pulse_schedule(100, 2.0, jitter=.0005, rng=rng)[1:]
+        # Pulse 51 arrives 20 ms late, and pulses 11 and 31 are doubled
+        schedule[50] = (schedule[50][0] + .02, '5')
+        schedule += [(schedule[10][0] + .005, '5'), (schedule[30][0] + .005, '5')]
+        self.feed(engine, sorted(schedule))
+        self.assertEqual(99, len(engine.corrections))
+        self.assertEqual([51], [c.number for c in engine.corrections if c.outlier])
+        self.assertAlmostEqual(1.0, engine.skew, places=4)
+        self.assertLess(abs(engine.to_local(200.0) - 200.0), .001)
+
+    def test_restarts_after_a_real_jump(self):
+        engine = resync.ResyncEngine(2.0)
+        self.feed(engine, [(2.0, '5'), (4.0, '5'), (6.01, '5'), (8.01, '5'), (10.01, '5')])
+        self.assertAlmostEqual(.01, engine.offset, places=6)
+        self.assertAlmostEqual(12.01, engine.to_local(12.0), places=6)
+
+    def test_estimates_skew_through_jitter(self):
+        # 10 minutes of 2s TRs, a scanner clock 1000 ppm slow and .5 ms of
+        # pulse jitter
+        tr = 2.0
+        drift = 1e-3
+        engine = resync.ResyncEngine(tr)
+        rng = random.Random(20)
+        self.feed(engine, scanner_emulator.sync_pulse_schedule(300, tr, jitter=.0005,
+                                                               drift=drift, rng=rng)[1:])
+        self.assertEqual([], [c.number for c in engine.corrections if c.outlier])
+        self.assertAlmostEqual(1 + drift, engine.skew, delta=1e-5)
+        # At the last pulse, and a TR past it
+        for scanner_time in [598.0, 600.0]:
+            self.assertAlmostEqual(scanner_time * (1 + drift), engine.to_local(scanner_time),
+                                   delta=.0005)
+
+    def test_write_log(self):
+        tmpdir = tempfile.mkdtemp()
+        try:
+            engine = resync.ResyncEngine(2.0)
+            self.feed(engine, [(2.001, '5'), (4.002, '5')])
+            filename = os.path.join(tmpdir, 'resync.txt')
+            engine.write_log(filename)
+            with open(filename) as log:
+                lines = log.read().splitlines()
+            self.assertEqual('tr,pulse_time,offset_ms,skew_ppm,correction_ms,outlier', lines[0])
+            self.assertEqual('2,4.002000,0.000,500.0,2.000,0', lines[2])
+        finally:
+            shutil.rmtree(tmpdir)
+
+class TestResyncWithEmulator(unittest.TestCase):
+
+    def test_fits_pulses_from_a_pty_scanner(self):
+        # A smoke test: the pulses get through a real pty and are fitted.
+        # Delivery through the pty jitters with the load on the machine, so
+        # the accuracy of the fit is tested on synthetic pulses above.
+        tr = .05
+        master_fd, slave_fd, slave_path = scanner_emulator.open_pty()
+        schedule = scanner_emulator.sync_pulse_schedule(41, tr, drift=2e-3)
+        engine = resync.ResyncEngine(tr)
+        try:
+            t0 = get_time()
+            writer = threading.Thread(target=scanner_emulator.emit,
+                                      args=(master_fd, schedule, t0))
+            writer.start()
+            reader = SerialReader(slave_fd, t0)
+            received = 0
+            while(received < len(schedule)):
+                for t, char in reader.read(timeout=1):
+                    received += 1
+                    # The first pulse is the trigger at time 0
+                    if(received > 1):
+                        engine.pulse(t)
+            writer.join()
+        finally:
+            os.close(master_fd)
+            os.close(slave_fd)
+        self.assertEqual(len(schedule), received)
+        self.assertTrue(engine.corrections)
+        last = engine.corrections[-1]
+        self.assertEqual((engine.offset, engine.skew), (last.offset, last.skew))
+        self.assertGreater(len(engine.points), 1)
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,72 @@
+import os
+import shutil
+import tempfile
+import unittest
+
+import run_plan
+import timeline
+
+class TestRunPlan(unittest.TestCase):
+
+    def setUp(self):
+        self.tmpdir = tempfile.mkdtemp()
+        self.script = os.path.join(self.tmpdir, 'script.txt')
+        shutil.copy('test_scripts/test_script_with_overlap.txt', self.script)
+
+    def tearDown(self):
+        shutil.rmtree(self.tmpdir)
+
+    def test_plan_fills_same_timeline_as_parsing(self):
+        parsed = timeline.Timeline()
+        parsed.read_from_file(self.script)
+        parsed.create_null_events()
+        planned = run_plan.load_plan(self.script).fill(timeline.Timeline())
+        self.assertEqual(
+            [(e.start, e.dur, e.kind, e.stim_str) for e in parsed.events],
+            [(e.start, e.dur, e.kind, e.stim_str) for e in planned.events]
+        )
+        self.assertEqual(parsed.total_dur, planned.total_dur)
+        self.assertEqual(1, len(planned.overlaps))
+        self.assertEqual('walnut', planned.overlaps[0].second.stim_str)
+
+    def test_load_plan_reuses_cache_until_script_changes(self):
+        run_plan.load_plan(self.script)
+        cached = run_plan.RunPlan.load(run_plan.plan_path_for(self.script))
+        self.assertTrue(cached.is_current(run_plan.hash_file(self.script)))
+        with open(self.script, 'a') as script:
+            script.write('9,1,"fig"\n')
+        self.assertFalse(cached.is_current(run_plan.hash_file(self.script)))
+        plan = run_plan.load_plan(self.script)
+        self.assertEqual('fig', plan.assets[plan.events['asset'][-1]][1])
+
+    def test_corrupt_plan_is_compiled_again(self):
+        path = run_plan.plan_path_for(self.script)
+        for contents in [b'', b'PK\x03\x04 truncated', b'not a plan']:
+            with open(path, 'wb') as plan_file:
+                plan_file.write(contents)
+            plan = run_plan.load_plan(self.script)
+            self.assertEqual(1, len(plan.overlaps))
+            self.assertTrue(run_plan.RunPlan.load(path).is_current(run_plan.hash_file(self.script)))
+
+    def test_unwritable_cache_is_skipped(self):
+        os.mkdir(run_plan.plan_path_for(self.script))
+        plan = run_plan.load_plan(self.script)
+        self.assertEqual(1, len(plan.overlaps))
+        self.assertEqual(['script.txt', 'script.txt.plan.npz'], sorted(os.listdir(self.tmpdir)))
+
+    def test_missing_assets_are_reported(self):
+        with open(self.script, 'a') as script:
+            script.write('9,1,missing.png\n')
+        plan = run_plan.compile_script(self.script)
+        self.assertEqual(['missing.png'], plan.missing_assets())
+        self.assertEqual(1, run_plan.precompile([self.tmpdir]))
+
+    def test_run_reports_are_not_scripts(self):
+        for report in ['s01_run_1_log.txt', 's01_run_1_timing.txt',
+                       's01_run_1_frames.txt', 's01_run_1_resync.txt']:
+            with open(os.path.join(self.tmpdir, report), 'w') as f:
+                f.write('index,stim\n')
+        self.assertEqual([self.script], run_plan.find_scripts([self.tmpdir]))
+
+if __name__ == '__main__':
+    unittest.main()
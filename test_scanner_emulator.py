@@ -0,0 +1,59 @@
+import os
+import random
+import unittest
+
+import scanner_emulator
+from serial_input import SerialReader
+from timing import get_time
+
+class TestScannerEmulator(unittest.TestCase):
+
+    def test_pulses_are_on_an_absolute_schedule(self):
+        schedule = scanner_emulator.sync_pulse_schedule(1000, 2.0)
+        self.assertEqual(1000, len(schedule))
+        self.assertEqual((1998.0, '5'), schedule[-1])
+
+    def test_jitter_is_bounded(self):
+        rng = random.Random(0)
+        schedule = scanner_emulator.sync_pulse_schedule(
+            200, 1.0, jitter=.01, max_jitter=.005, rng=rng
+        )
+        for n, (t, char) in enumerate(schedule):
+            self.assertLessEqual(abs(t - n), .005 + 1e-9)
+
+    def test_dropped_and_doubled_pulses(self):
+        self.assertEqual([], scanner_emulator.sync_pulse_schedule(10, 1.0, drop_prob=1))
+        doubled = scanner_emulator.sync_pulse_schedule(10, 1.0, double_prob=1)
+        self.assertEqual(20, len(doubled))
+
+    def test_responses_follow_onsets(self):
+        rng = random.Random(0)
+        schedule = scanner_emulator.response_schedule(
+            [0, 10, 20], response_prob=1, rng=rng
+        )
+        self.assertEqual(3, len(schedule))
+        for onset, (t, key) in zip([0, 10, 20], schedule):
+            self.assertTrue(onset < t < onset + 5)
+            self.assertIn(key, ['1', '2', '3', '4'])
+
+    def test_emit_through_pty(self):
+        master_fd, slave_fd, slave_path = scanner_emulator.open_pty()
+        try:
+            t0 = get_time()
+            emitted = scanner_emulator.emit(master_fd, [(0, '5'), (.02, '1')], t0)
+            records = []
+            reader = SerialReader(slave_fd, t0)
+            while(len(records) < 2):
+                records += reader.read(timeout=1)
+        finally:
+            os.close(master_fd)
+            os.close(slave_fd)
+        self.assertEqual(['5', '1'], [char for t, char in records])
+        # Writes are never early. How late they are depends on the load on
+        # the machine, so only a generous bound is checked.
+        self.assertLessEqual(emitted[0], emitted[1])
+        self.assertGreaterEqual(emitted[1], .02)
+        self.assertLess(emitted[1], .02 + .1)
+
+if __name__ == '__main__':
+    unittest.main()
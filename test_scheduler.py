@@ -0,0 +1,126 @@
+import os
+import random
+import shutil
+import tempfile
+import unittest
+
+import scheduler
+import timeline
+
+class FakeClock(object):
+    def __init__(self):
+        self.t = 0.0
+
+    def getTime(self):
+        return(self.t)
+
+class FakeWindow(object):
+    def __init__(self, clock, intervals):
+        self.clock = clock
+        self.intervals = list(intervals)
+        self.flips = 0
+
+    def flip(self):
+        self.clock.t += self.intervals.pop(0)
+        self.flips += 1
+
+def entries(durations):
+    return([timeline.parse_event_strings(['0', dur, '"pecan"']) for dur in durations])
+
+class TestFrameBudgets(unittest.TestCase):
+
+    def test_rounds_each_end_to_the_nearest_frame(self):
+        budgets = scheduler.frame_budgets(entries(['0.51', '1', '0.5']), 60.0)
+        # 0.51s is 30.6 frames, ending at frame 31; 1.51s ends at frame 91
+        self.assertEqual([(0, 31), (31, 91), (91, 121)],
+                         [(b.onset_frame, b.end_frame) for b in budgets])
+
+    def test_rounding_does_not_accumulate(self):
+        budgets = scheduler.frame_budgets(entries(['0.51'] * 1000), 60.0)
+        self.assertEqual(30600, budgets[-1].end_frame)
+
+class TestFrameClock(unittest.TestCase):
+
+    def setUp(self):
+        self.clock = FakeClock()
+        self.frame_clock = scheduler.FrameClock(self.clock, 50.0)
+        self.frame_clock.plan(entries(['0.1', '0.1']))
+
+    def run_event(self, index, win):
+        end_time = self.frame_clock.begin(index)
+        while(self.frame_clock.getTime() < end_time):
+            win.flip()
+
+    def test_shows_exactly_the_budgeted_frames_when_flips_are_late(self):
+        # Every flip returns 9 ms after the vsync, which would make a clock
+        # comparison overshoot by a frame
+        win = FakeWindow(self.clock, [.009] + [.02] * 20)
+        self.frame_clock.attach(win)
+        self.run_event(0, win)
+        self.assertEqual(5, win.flips)
+        self.run_event(1, win)
+        self.assertEqual(10, win.flips)
+        self.assertEqual({}, self.frame_clock.corrections)
+
+    def test_corrects_from_the_clock_after_dropped_frames(self):
+        # The third flip comes three frames late
+        win = FakeWindow(self.clock, [.005, .02, .06] + [.02] * 20)
+        self.frame_clock.attach(win)
+        self.run_event(0, win)
+        self.assertEqual(3, win.flips)
+        self.assertEqual({0: 2}, self.frame_clock.corrections)
+        self.run_event(1, win)
+        self.assertEqual(8, win.flips)
+
+    def test_first_flip_late_after_the_trigger(self):
+        # The first flip comes three frames after the trigger; the run stays
+        # locked to the trigger instead of starting three frames late
+        win = FakeWindow(self.clock, [.065] + [.02] * 20)
+        self.frame_clock.attach(win)
+        self.run_event(0, win)
+        self.assertEqual(2, win.flips)
+        self.assertEqual({0: 3}, self.frame_clock.corrections)
+        self.run_event(1, win)
+        self.assertEqual(7, win.flips)
+        self.assertAlmostEqual(.185, self.clock.t)
+
+    def test_vsync_phase_after_the_trigger_is_not_drift(self):
+        # 100s at 60 Hz, with the vsyncs landing about half a frame after
+        # the trigger and every flip returning up to .2 ms late or early
+        period = 1 / 60.0
+        rng = random.Random(13)
+        for phase in [.45, .48, .49, .5, .51, .52, .55]:
+            clock = FakeClock()
+            frame_clock = scheduler.FrameClock(clock, 60.0)
+            budgets = frame_clock.plan(entries(['10'] * 10))
+            flips = 0
+            for budget in budgets:
+                end_time = frame_clock.begin(budget.index)
+                while(frame_clock.getTime() < end_time):
+                    clock.t = (phase + flips) * period + rng.uniform(-.0002, .0002)
+                    frame_clock.count_flip(clock.t)
+                    flips += 1
+            self.assertEqual({}, frame_clock.corrections, phase)
+            self.assertEqual(6000, flips)
+            self.assertEqual(budgets[-1].end_frame, frame_clock.frame)
+
+    def test_time_of_matches_the_budgeted_frames(self):
+        budgets = self.frame_clock.plan(entries(['0.51', '0.5']))
+        self.assertAlmostEqual(budgets[0].end_frame * .02, self.frame_clock.time_of(510000))
+        self.assertAlmostEqual(.52, self.frame_clock.time_of(510000))
+
+    def test_write_report(self):
+        tmpdir = tempfile.mkdtemp()
+        try:
+            frame_clock = scheduler.FrameClock(self.clock, 60.0)
+            frame_clock.plan(entries(['0.51']))
+            filename = os.path.join(tmpdir, 'frames.txt')
+            frame_clock.write_report(filename)
+            with open(filename) as report:
+                lines = report.read().splitlines()
+            self.assertIn('0,pecan,0.000000,0.000000,0.000,0.510000,31,6.667,0', lines)
+        finally:
+            shutil.rmtree(tmpdir)
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,37 @@
+import os
+import tty
+import unittest
+
+import serial_input
+import timing
+
+class TestSerialReader(unittest.TestCase):
+
+    def setUp(self):
+        # A pty pair stands in for the serial adapter: the scanner writes to
+        # master, and we read from slave like a serial port.
+        self.master, self.slave = os.openpty()
+        tty.setraw(self.slave)
+        self.t0 = timing.get_time()
+        self.reader = serial_input.SerialReader(self.slave, self.t0)
+
+    def tearDown(self):
+        os.close(self.master)
+        os.close(self.slave)
+
+    def test_read_times_out_with_no_input(self):
+        self.assertEqual([], self.reader.read(timeout=.01))
+
+    def test_read_returns_burst_in_one_call(self):
+        os.write(self.master, b'5123')
+        records = self.reader.read(timeout=1)
+        self.assertEqual(['5', '1', '2', '3'], [char for t, char in records])
+
+    def test_timestamps_are_relative_to_t0(self):
+        os.write(self.master, b'5')
+        records = self.reader.read(timeout=1)
+        t_now = timing.get_time() - self.t0
+        self.assertTrue(0 <= records[0][0] <= t_now)
+
+if __name__ == '__main__':
+    unittest.main()
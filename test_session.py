@@ -0,0 +1,30 @@
+import unittest
+
+import session
+
+class TestParseRunNumbers(unittest.TestCase):
+
+    def test_single_run(self):
+        self.assertEqual([2], session.parse_run_numbers(u'2'))
+
+    def test_lists_and_ranges_keep_their_order(self):
+        self.assertEqual([3, 1, 2, 5], session.parse_run_numbers('3, 1-2,5'))
+
+    def test_rejects_empty_input(self):
+        self.assertRaises(ValueError, session.parse_run_numbers, '')
+
+class TestPreloader(unittest.TestCase):
+
+    def test_returns_the_result(self):
+        preloader = session.Preloader(lambda a, b: a + b, 1, 2)
+        self.assertEqual(3, preloader.result())
+        self.assertTrue(preloader.done())
+
+    def test_reraises_errors(self):
+        def load():
+            raise IOError("missing script")
+        preloader = session.Preloader(load)
+        self.assertRaises(IOError, preloader.result)
+
+if __name__ == '__main__':
+    unittest.main()
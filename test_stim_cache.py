@@ -0,0 +1,66 @@
+import stim_cache
+import unittest
+
+class TestStimulusCache(unittest.TestCase):
+
+    def test_get_reuses_stim_for_same_key(self):
+        cache = stim_cache.StimulusCache()
+        key = stim_cache.stim_key('text', 'pecan', '#FFFFFF')
+        first = cache.get(key, object)
+        second = cache.get(key, object)
+        self.assertIs(first, second)
+        self.assertEqual(1, cache.hits)
+        self.assertEqual(1, cache.misses)
+
+    def test_get_distinguishes_text_color(self):
+        cache = stim_cache.StimulusCache()
+        white = cache.get(stim_cache.stim_key('text', 'pecan', '#FFFFFF'), object)
+        red = cache.get(stim_cache.stim_key('text', 'pecan', '#FF0000'), object)
+        self.assertIsNot(white, red)
+
+    def test_evicts_least_recently_used_when_over_budget(self):
+        cache = stim_cache.StimulusCache(budget=2 * stim_cache.TEXT_STIM_COST)
+        pecan = stim_cache.stim_key('text', 'pecan')
+        walnut = stim_cache.stim_key('text', 'walnut')
+        melon = stim_cache.stim_key('text', 'melon')
+        cache.get(pecan, object)
+        cache.get(walnut, object)
+        cache.get(pecan, object)
+        cache.get(melon, object)
+        self.assertIn(pecan, cache)
+        self.assertNotIn(walnut, cache)
+        self.assertIn(melon, cache)
+        self.assertEqual(2 * stim_cache.TEXT_STIM_COST, cache.size)
+
+    def test_evicted_stims_are_released(self):
+        released = []
+        cache = stim_cache.StimulusCache(budget=stim_cache.TEXT_STIM_COST,
+                                         release=released.append)
+        pecan = cache.get(stim_cache.stim_key('text', 'pecan'), object)
+        cache.get(stim_cache.stim_key('text', 'walnut'), object)
+        self.assertEqual([pecan], released)
+        cache.discard(stim_cache.stim_key('text', 'walnut'))
+        self.assertEqual([pecan], released)
+
+    def test_keeps_the_newest_entries_over_budget(self):
+        released = []
+        cache = stim_cache.StimulusCache(budget=stim_cache.TEXT_STIM_COST, keep_newest=3,
+                                         release=released.append)
+        for text in ['pecan', 'walnut', 'melon', 'fig']:
+            cache.get(stim_cache.stim_key('text', text), object)
+        self.assertEqual(3, len(cache))
+        self.assertEqual(1, len(released))
+        self.assertNotIn(stim_cache.stim_key('text', 'pecan'), cache)
+
+    def test_release_stim_stops_movies(self):
+        class FakeMovie(object):
+            stopped = False
+            def stop(self):
+                self.stopped = True
+        movie = FakeMovie()
+        stim_cache.release_stim(movie)
+        stim_cache.release_stim(object())
+        self.assertTrue(movie.stopped)
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,50 @@
+import collections
+import unittest
+
+import text_cache
+from timeline import parse_event_strings
+
+FakeWindow = collections.namedtuple('FakeWindow', ['size'])
+FakeTextStim = collections.namedtuple('FakeTextStim', ['boundingBox'])
+
+class TestTextTextureCache(unittest.TestCase):
+
+    def setUp(self):
+        self.rendered = []
+        self.textures = text_cache.TextTextureCache(FakeWindow((800, 600)), render=self.render)
+
+    def render(self, win, text, color, wrap_width):
+        self.rendered.append((text, color))
+        return(('texture', text, color))
+
+    def entries(self, lines):
+        return([parse_event_strings(line.split(',')) for line in lines])
+
+    def test_renders_each_text_once(self):
+        entries = self.entries(['0,1,"pecan"', '1,1,"+"', '2,1,"pecan"', '3,1,"+"',
+                                '4,1,"pecan",#FF0000', '5,1,image.png'])
+        self.textures.prerender(entries)
+        self.assertEqual([('pecan', '#FFFFFF'), ('+', '#FFFFFF'), ('pecan', '#FF0000')],
+                         self.rendered)
+        for i in range(1000):
+            self.textures.get('pecan', '#FFFFFF')
+        self.assertEqual(3, len(self.rendered))
+        self.assertEqual(1000, self.textures.hits)
+
+    def test_forget_keeps_the_next_runs_text(self):
+        self.textures.prerender(self.entries(['0,1,"pecan"', '1,1,"walnut"']))
+        self.textures.forget(keep=[entry.key() for entry in self.entries(['0,1,"walnut"'])])
+        self.assertEqual(1, len(self.textures))
+        self.textures.get('walnut', '#FFFFFF')
+        self.assertEqual(2, len(self.rendered))
+
+    def test_text_rect_covers_the_bounding_box(self):
+        win = FakeWindow((800, 600))
+        self.assertEqual((-.26, .1, .26, -.1),
+                         text_cache.text_rect(FakeTextStim((200, 52)), win))
+        # Never more than the window
+        self.assertEqual(1.0, text_cache.text_rect(FakeTextStim((2000, 52)), win)[2])
+        self.assertEqual((-1, 1, 1, -1), text_cache.text_rect(object(), win))
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,101 @@
+import timeline
+import unittest
+
+class TestTimeline(unittest.TestCase):
+
+    def test_create_null_events_creates_correct_start_times(self):
+        events = timeline.Timeline()
+        events.read_from_file('test_scripts/test_script.txt')
+        events.create_null_events()
+        # 0  - 2  pecan
+        # 2  - 6  NULL
+        # 6  - 9  walnut
+        # 9  - 13 NULL
+        # 13 - 15 apricot
+        # 15 - 17 melon
+        self.assertEqual(9, events.events[3].start)
+
+    def test_create_null_events_creates_correct_durations(self):
+        events = timeline.Timeline()
+        events.read_from_file('test_scripts/test_script.txt')
+        events.create_null_events()
+        self.assertEqual(4, events.events[3].dur)
+        self.assertEqual('+', events.events[3].stim_str)
+
+    def test_create_null_events_no_null_between_adjacent_non_nulls(self):
+        events = timeline.Timeline()
+        events.read_from_file('test_scripts/test_script.txt')
+        events.create_null_events()
+        self.assertEqual('melon', events.events[5].stim_str)
+
+    def test_create_null_events_does_not_create_overlapping_events(self):
+        events = timeline.Timeline()
+        events.read_from_file('test_scripts/test_script_without_overlap.txt')
+        events.create_null_events()
+        self.assertFalse(events.has_overlapping_events())
+
+    def test_has_overlapping_events_finds_overlapping_events_before_null_creation(self):
+        events = timeline.Timeline()
+        events.read_from_file('test_scripts/test_script_with_overlap.txt')
+        self.assertTrue(events.has_overlapping_events())
+
+    def test_has_overlapping_events_finds_overlapping_events_after_null_creation(self):
+        events = timeline.Timeline()
+        events.read_from_file('test_scripts/test_script_with_overlap.txt')
+        events.create_null_events()
+        self.assertTrue(events.has_overlapping_events())
+
+    def test_has_overlapping_events_reports_conflicting_pairs(self):
+        events = timeline.Timeline()
+        events.read_from_file('test_scripts/test_script_with_overlap.txt')
+        overlaps = events.has_overlapping_events()
+        # 4,0.51,"pecan" runs past the start of 4.5,0.5,"walnut"
+        self.assertEqual(1, len(overlaps))
+        self.assertEqual(4, overlaps[0].first.start)
+        self.assertEqual('walnut', overlaps[0].second.stim_str)
+
+    def test_create_null_events_records_overlaps_and_duration(self):
+        events = timeline.Timeline()
+        events.read_from_file('test_scripts/test_script.txt')
+        events.create_null_events()
+        self.assertEqual([], events.overlaps)
+        self.assertEqual(17, events.total_dur)
+        self.assertEqual(17, events.dur())
+
+    def test_has_overlapping_events_stops_early(self):
+        events = timeline.Timeline()
+        events.read_from_file('test_scripts/test_script_with_overlap.txt')
+        events.events.append(timeline.parse_event_strings(['4.6', '1', '"fig"']))
+        self.assertEqual(2, len(events.has_overlapping_events()))
+        self.assertEqual(1, len(events.has_overlapping_events(stop_early=True)))
+
+    def test_parse_event_strings_identifies_kinds(self):
+        movie = timeline.parse_event_strings(['0', '1', 'clip.mov', 'noAudio'])
+        self.assertEqual('movie', movie.kind)
+        self.assertTrue(movie.no_audio)
+        text = timeline.parse_event_strings(['0', '1', '"fig"', '#FF0000'])
+        self.assertEqual('text', text.kind)
+        self.assertEqual('#FF0000', text.color)
+        self.assertEqual('image', timeline.parse_event_strings(['0', '1', 'a.png']).kind)
+        self.assertEqual('sound', timeline.parse_event_strings(['0', '1', 'a.wav']).kind)
+
+    def test_parse_event_strings_rejects_unknown_extension(self):
+        self.assertRaises(ValueError, timeline.parse_event_strings,
+                          ['0', '1', 'notes.doc'])
+
+    def test_times_are_exact_integer_microseconds(self):
+        entry = timeline.parse_event_strings(['4', '0.51', '"pecan"'])
+        self.assertEqual(4000000, entry.start_us)
+        self.assertEqual(510000, entry.dur_us)
+        events = timeline.Timeline()
+        events.events = [
+            timeline.parse_event_strings(['{0}.{1}'.format(i // 10, i % 10), '0.1', '"pecan"'])
+            for i in range(10000)
+        ]
+        self.assertEqual(1000000000, events.dur_us())
+
+    def test_rejects_times_finer_than_a_microsecond(self):
+        self.assertRaises(ValueError, timeline.to_us, '0.0000001')
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,30 @@
+import time
+import unittest
+
+import timing
+
+class WallClock(object):
+    def __init__(self):
+        self.t0 = time.time()
+
+    def getTime(self):
+        return(time.time() - self.t0)
+
+class TestWaitUntil(unittest.TestCase):
+
+    def test_returns_at_deadline_and_polls_while_waiting(self):
+        clock = WallClock()
+        polls = []
+        timing.wait_until(clock, 0.05, poll=lambda: polls.append(clock.getTime()))
+        finished = clock.getTime()
+        self.assertGreaterEqual(finished, 0.05)
+        self.assertLess(finished, 0.06)
+        self.assertGreater(len(polls), 5)
+
+    def test_returns_immediately_after_deadline(self):
+        clock = WallClock()
+        timing.wait_until(clock, -1)
+        self.assertLess(clock.getTime(), 0.01)
+
+if __name__ == '__main__':
+    unittest.main()
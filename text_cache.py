@@ -0,0 +1,95 @@
+"""
+Renders each distinct text stimulus once, when a run is loaded, into a
+texture that is drawn as an image from then on. A TextStim lays out and
+rasterizes its glyphs when it is built; a script with thousands of word
+trials (and a fixation cross shown between them) would otherwise pay that
+for every event.
+"""
+
+# Matches the TextStim settings TextEvent has always used
+DEFAULT_WRAP_WIDTH = 2
+
+# Room left around the text's bounding box when capturing it, in pixels
+PADDING_PX = 4
+
+def text_rect(text_stim, win):
+    """
+    The rectangle (left, top, right, bottom, in norm units) around a
+    centered TextStim. Without a bounding box, the whole window.
+    """
+    box = getattr(text_stim, 'boundingBox', None)
+    if(box is None):
+        return((-1, 1, 1, -1))
+    # A full window is 2 norm units across, so half the size in norm units
+    # is the size in pixels over the window size
+    half_width = min(1.0, (box[0] + 2 * PADDING_PX) / float(win.size[0]))
+    half_height = min(1.0, (box[1] + 2 * PADDING_PX) / float(win.size[1]))
+    return((-half_width, half_height, half_width, -half_height))
+
+def render_text(win, text, color, wrap_width):
+    """
+    Draws a TextStim into the back buffer, captures the part it covers as a
+    BufferImageStim and clears the buffer again, so nothing is left for the
+    next flip.
+    """
+    from psychopy import visual
+    text_stim = visual.TextStim(win, pos=[0,0], text=text, color=color,
+                                wrapWidth=wrap_width)
+    texture = visual.BufferImageStim(win, rect=text_rect(text_stim, win),
+                                     stim=[text_stim])
+    win.clearBuffer()
+    return(texture)
+
+class TextTextureCache(object):
+    """
+    Holds one prebuilt texture per (text, color, wrap width). get() renders
+    on a miss, so it always works, but prerender() does all the rendering
+    while a run is loaded. It has to be called from the thread that owns
+    the window.
+    """
+    def __init__(self, win, wrap_width=DEFAULT_WRAP_WIDTH, render=render_text):
+        self.win = win
+        self.wrap_width = wrap_width
+        self.render = render
+        self.rendered = 0
+        self.hits = 0
+        self._textures = {}
+
+    def __len__(self):
+        return(len(self._textures))
+
+    def key(self, text, color):
+        return((text, color, self.wrap_width))
+
+    def get(self, text, color):
+        key = self.key(text, color)
+        texture = self._textures.get(key)
+        if(texture is None):
+            texture = self.render(self.win, text, color, self.wrap_width)
+            self._textures[key] = texture
+            self.rendered += 1
+        else:
+            self.hits += 1
+        return(texture)
+
+    def prerender(self, entries):
+        """Renders the text of every timeline entry not already rendered."""
+        for entry in entries:
+            if(entry.kind == 'text' and self.key(entry.stim_str, entry.color) not in self._textures):
+                self.get(entry.stim_str, entry.color)
+
+    def forget(self, keep=()):
+        """
+        Drops every texture except those for the stimulus keys (as in
+        stim_cache.stim_key) in keep.
+        """
+        kept = set(self.key(stim_str, color)
+                   for kind, stim_str, color, no_audio in keep if kind == 'text')
+        for key in list(self._textures):
+            if(key not in kept):
+                del self._textures[key]
+
+    def report(self):
+        print("Text textures: {0} rendered, {1} reused, {2} held".format(
+            self.rendered, self.hits, len(self._textures)
+        ))
@@ -0,0 +1,239 @@
+"""
+The timeline of an experiment script: when each event starts, how long it
+lasts, what kind of stimulus it shows and what that stimulus is. Nothing in
+this module touches PsychoPy, so scripts can be parsed and validated without
+a window. event.py turns timeline events into displayable stimuli.
+"""
+import os
+import decimal
+import collections
+
+from stim_cache import stim_key
+
+MOVIE_EXTENSIONS = ['.mp4', '.mov']
+IMAGE_EXTENSIONS = ['.jpg', '.jpeg', '.tif', '.png']
+SOUND_EXTENSIONS = ['.wav', '.aif']
+
+# Times are kept as integer microseconds once parsed, so sums and
+# differences are exact and cheap, and never drift the way floats would.
+US_PER_S = 1000000
+
+def to_us(seconds):
+    """
+    Converts seconds (a string from a script, or a Decimal) to integer
+    microseconds, exactly. Raises ValueError for finer times.
+    """
+    us = decimal.Decimal(seconds) * US_PER_S
+    if(us != us.to_integral_value()):
+        raise ValueError("{0}s is not a whole number of microseconds".format(seconds))
+    return(int(us))
+
+def from_us(us):
+    """Converts integer microseconds back to exact Decimal seconds."""
+    if(us is None):
+        return(None)
+    return(decimal.Decimal(us) / US_PER_S)
+
+# One entry in the report returned by Timeline.has_overlapping_events().
+# `first` is the earlier event that is still running when `second` starts.
+Overlap = collections.namedtuple('Overlap', ['first', 'second'])
+
+class TimelineEvent(object):
+    """
+    A single line of a script. start_us and dur_us are integer microseconds.
+    kind is one of 'text', 'image', 'sound' or 'movie', and stim_str is the
+    text to show or the path of the file. color only applies to text, and
+    no_audio only to movies.
+    """
+    __slots__ = ['start_us', 'dur_us', 'kind', 'stim_str', 'color', 'no_audio']
+
+    def __init__(self, start_us, dur_us, kind, stim_str, color=None, no_audio=False):
+        self.start_us = start_us
+        self.dur_us = dur_us
+        self.kind = kind
+        self.stim_str = stim_str
+        self.color = color
+        self.no_audio = no_audio
+
+    @property
+    def start(self):
+        """Start time in exact Decimal seconds."""
+        return(from_us(self.start_us))
+
+    @property
+    def dur(self):
+        """Duration in exact Decimal seconds."""
+        return(from_us(self.dur_us))
+
+    def key(self):
+        """The StimulusCache key for this event's stimulus."""
+        return(stim_key(self.kind, self.stim_str, self.color, self.no_audio))
+
+    def __repr__(self):
+        return("TimelineEvent({0}, {1}, {2!r}, {3!r})".format(
+            self.start, self.dur, self.kind, self.stim_str
+        ))
+
+def parse_event_strings(event_strings):
+    """
+    Takes an array of 'event strings,' usually parsed from an experiment
+    script, figures out what kind of stimulus it describes, and returns a
+    TimelineEvent. Start and duration are given in seconds and stored as
+    integer microseconds. Raises ValueError if the stimulus can't be
+    identified.
+    """
+    if(event_strings[0] != None):
+        event_start = to_us(event_strings[0])
+    else:
+        event_start = None
+
+    if(event_strings[1] != None):
+        event_dur = to_us(event_strings[1])
+    else:
+        event_dur = None
+
+    stim_strings = event_strings[2:]
+
+    # Are we dealing with a text stim or a file stim?
+    # If the stim begins and ends with double quotes, then it's text.
+    if((stim_strings[0][0] == '"') and (stim_strings[0][-1] == '"')):
+        # If the following field begins with a hash, then it's colored text
+        if(len(stim_strings) == 2 and stim_strings[1][0]=='#'):
+            text_color = stim_strings[1]
+        else:
+            text_color = '#FFFFFF'
+        return(TimelineEvent(
+            event_start, event_dur, 'text',
+            stim_strings[0][1:-1], # Strip the quotes
+            color=text_color
+        ))
+    # If we do not begin and end with quotes, then we assume we are dealing
+    # with a file stim.
+    elif((stim_strings[0][0] != '"') and (stim_strings[0][-1] != '"')):
+        filename, stim_ext = os.path.splitext(stim_strings[0])
+        if(stim_ext in MOVIE_EXTENSIONS):
+            no_audio = (len(stim_strings) == 2 and stim_strings[1] == "noAudio")
+            return(TimelineEvent(
+                event_start, event_dur, 'movie', stim_strings[0],
+                no_audio=no_audio
+            ))
+        elif(stim_ext in IMAGE_EXTENSIONS):
+            return(TimelineEvent(event_start, event_dur, 'image', stim_strings[0]))
+        elif(stim_ext in SOUND_EXTENSIONS):
+            return(TimelineEvent(event_start, event_dur, 'sound', stim_strings[0]))
+        else:
+            raise ValueError("stim_ext not found: {0} (stim_strings: {1})".format(
+                stim_ext, stim_strings
+            ))
+    else:
+        raise ValueError("Confusing stim_strings: {0}".format(stim_strings))
+
+class Timeline(object):
+    def __init__(self):
+        self.events = []
+        self.null_event = None
+        # Filled in by create_null_events()
+        self.overlaps = []
+        self.total_dur_us = None
+
+    @property
+    def total_dur(self):
+        return(from_us(self.total_dur_us))
+
+    def read_from_file(self, path):
+        """Parse the script file and populate the event array"""
+        with open(path) as script:
+            lines = [line.strip() for line in script]
+        for line_number, line in enumerate(lines, 1):
+            splitline = line.split(',')
+            if(splitline[0] == "NULL"):
+                self.null_event = splitline[1]
+            else:
+                try:
+                    self.events.append(parse_event_strings(splitline))
+                except (ValueError, IndexError, decimal.InvalidOperation) as e:
+                    raise ValueError("{0}, line {1}: {2}".format(
+                        path, line_number, e
+                    ))
+        # Sort once, after everything has been parsed
+        self.sort_by_start()
+
+    def sort_by_start(self):
+        self.events.sort(key=lambda event: event.start_us)
+
+    def null_entry(self, start_us=None, dur_us=None):
+        """Returns a TimelineEvent for the script's NULL stimulus."""
+        entry = parse_event_strings([None, None, self.null_event])
+        entry.start_us = start_us
+        entry.dur_us = dur_us
+        return(entry)
+
+    def sweep(self):
+        """
+        Walks the (sorted) event list once, yielding a
+        (previous_event, previous_end, event) triple for each event.
+        previous_end is the latest end time (in microseconds) of any earlier
+        event and previous_event is the event that ends then. For the first
+        event both are None.
+        """
+        previous_event = None
+        previous_end = None
+        for event in self.events:
+            yield (previous_event, previous_end, event)
+            event_end = event.start_us + event.dur_us
+            if(previous_end is None or event_end > previous_end):
+                previous_event = event
+                previous_end = event_end
+
+    def dur_us(self):
+        """Returns the latest end time of any event, without re-sorting."""
+        end = None
+        for event in self.events:
+            event_end = event.start_us + event.dur_us
+            if(end is None or event_end > end):
+                end = event_end
+        return(end)
+
+    def dur(self):
+        return(from_us(self.dur_us()))
+
+    def create_null_events(self):
+        """
+        Fills every gap between events with a null event. The nulls are merged
+        into place during a single pass over the sorted list, which also
+        records any overlapping events (self.overlaps) and the total duration
+        of the list (self.total_dur_us).
+        """
+        merged = []
+        overlaps = []
+        end = None
+        for previous_event, previous_end, event in self.sweep():
+            if(previous_end is not None):
+                null_dur = event.start_us - previous_end
+                if(null_dur > 0):
+                    merged.append(self.null_entry(previous_end, null_dur))
+                elif(null_dur < 0):
+                    print("WARNING: Overlapping events detected while creating null events")
+                    print("overlap = {0}".format(from_us(-null_dur)))
+                    overlaps.append(Overlap(previous_event, event))
+            merged.append(event)
+            event_end = event.start_us + event.dur_us
+            if(end is None or event_end > end):
+                end = event_end
+        self.events = merged
+        self.overlaps = overlaps
+        self.total_dur_us = end
+
+    def has_overlapping_events(self, stop_early=False):
+        """
+        Returns a list of Overlaps, one for every event that starts before an
+        earlier event has ended. The list is empty (and so false) if nothing
+        overlaps. With stop_early, the search ends at the first overlap found.
+        """
+        overlaps = []
+        for previous_event, previous_end, event in self.sweep():
+            if(previous_end is not None and previous_end > event.start_us):
+                overlaps.append(Overlap(previous_event, event))
+                if(stop_early):
+                    break
+        return(overlaps)
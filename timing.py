@@ -0,0 +1,36 @@
+import time
+
+# High-resolution monotonic timer. PsychoPy's clocks are built on the same
+# timer, so times from here can be put on a PsychoPy clock by subtracting
+# the get_time() of the clock's zero (see run_clock_origin).
+try:
+    from time import perf_counter as get_time
+except ImportError:
+    # Python 2: the same timer PsychoPy falls back to
+    from timeit import default_timer as get_time
+
+def run_clock_origin(clock):
+    """
+    Returns the get_time() at which the PsychoPy clock read zero, so another
+    process can compute clock time as get_time() - origin.
+    """
+    return(get_time() - clock.getTime())
+
+def wait_until(clock, deadline, poll=None, poll_interval=.005, spin=.002):
+    """
+    Waits until clock.getTime() reaches deadline without redrawing anything.
+    Sleeps in steps of at most poll_interval seconds, calling poll() (if
+    given) on every wake-up so input is still collected. The last `spin`
+    seconds are busy-waited, because sleep() can overshoot by a millisecond
+    or more.
+    """
+    deadline = float(deadline)
+    while(True):
+        if(poll is not None):
+            poll()
+        remaining = deadline - clock.getTime()
+        if(remaining <= spin):
+            break
+        time.sleep(min(poll_interval, remaining - spin))
+    while(clock.getTime() < deadline):
+        pass